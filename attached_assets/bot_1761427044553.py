@@ -1,28 +1,51 @@
 import logging
 import os
-import sqlite3
+import sys
 import asyncio
-import uuid
-import json
 import csv
 from datetime import datetime, timedelta
-from io import BytesIO
+from pathlib import Path
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.error import TelegramError
+from telegram.error import BadRequest, TelegramError
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
     MessageHandler,
     ContextTypes,
     ConversationHandler,
-    CallbackQueryHandler,
     filters,
 )
 from telegram.helpers import escape_markdown
 from dotenv import load_dotenv
-import aiohttp
-import qrcode
+
+# Бот запускается из attached_assets/, общий пакет vpnbot лежит в корне проекта
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from vpnbot.allocator import SYNC_INTERVAL, allocator
+from vpnbot.broadcast import Broadcaster
+from vpnbot.callbacks import CallbackRoutes
+from vpnbot.cryptobot import CryptoBotAPI
+from vpnbot.db import Database
+from vpnbot.delivery import FLUSH_INTERVAL, STATUS_NAMES, DeliveryTracker
+from vpnbot.health import PROBE_INTERVAL, health_monitor
+from vpnbot.invoices import PAYMENT_SQL, POLL_INTERVAL, WEBHOOK_FALLBACK_INTERVAL, poll_pending_invoices
+from vpnbot.inventory import TICK_INTERVAL, panel_inventory
+from vpnbot.key_pool import FILL_INTERVAL, key_pool
+from vpnbot.keyboards import CHECK_INTERVAL as KEYBOARD_CHECK_INTERVAL, KeyboardCache
+from vpnbot.revocation import RETRY_INTERVAL as REVOKE_RETRY_INTERVAL, parse_user_ids, retry_pending_revocations, revoke_users
+from vpnbot.migrations import migrate
+from vpnbot.outbound import TRANSACTIONAL, OutboundScheduler
+from vpnbot.qr import QrCache
+from vpnbot.queries import (
+    ACTIVE_SUBSCRIPTIONS_SQL, FIND_PROFILE_BY_KEY_SQL, FIND_USER_BY_USERNAME_SQL, REFERRAL_COUNT_SQL, TICKET_USER_SQL
+)
+from vpnbot.outbox import WORKERS, OutboxWorker, complete_in_transaction, enqueue, job_payload, provisioning_stats
+from vpnbot.reconcile import reconcile_all
+from vpnbot.reminders import INTERVAL as REMINDER_INTERVAL, send_expiry_reminders
+from vpnbot.updates import CONCURRENT_UPDATES as DEFAULT_CONCURRENT_UPDATES, PerUserUpdateProcessor, serve_webhook
+from vpnbot.users import UserCache
+from vpnbot.webhooks import WEBHOOK_PATH, CryptoPayWebhook
+from vpnbot.xui import xui_clients
 
 # =======================================
 # ===           НАСТРОЙКИ             ===
@@ -35,11 +58,29 @@ ADMIN_IDS = [int(admin_id) for admin_id in ADMIN_ID_STR.split(',')] if ADMIN_ID_
 GROUP_ID_STR = os.getenv("GROUP_ID")
 GROUP_ID = int(GROUP_ID_STR) if GROUP_ID_STR else 0
 CRYPTO_BOT_TOKEN = os.getenv("CRYPTO_BOT_TOKEN")
+# Вебхук CryptoBot об оплате; без порта оплату подтверждает фоновый опрос счетов
+CRYPTO_WEBHOOK_HOST = os.getenv("CRYPTO_WEBHOOK_HOST", "0.0.0.0")
+CRYPTO_WEBHOOK_PORT = int(os.getenv("CRYPTO_WEBHOOK_PORT") or 0)
+CRYPTO_WEBHOOK_PATH = os.getenv("CRYPTO_WEBHOOK_PATH", WEBHOOK_PATH)
+# Сколько ключей выдается параллельно (обработчиков очереди выдачи)
+PROVISIONING_WORKERS = int(os.getenv("PROVISIONING_WORKERS") or WORKERS)
+# Режим вебхука Telegram: публичный URL (https://домен/путь); пусто - long polling
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL")
+TELEGRAM_WEBHOOK_HOST = os.getenv("TELEGRAM_WEBHOOK_HOST", "0.0.0.0")
+TELEGRAM_WEBHOOK_PORT = int(os.getenv("TELEGRAM_WEBHOOK_PORT") or 8443)
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET")
+# Сколько обновлений разных пользователей обрабатывается одновременно
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES") or DEFAULT_CONCURRENT_UPDATES)
 MIN_RUB_DEPOSIT = 130
 # НОВЫЕ ПАРАМЕТРЫ ДЛЯ ПРОБНОГО ПЕРИОДА
 TRIAL_DAYS = 1
 TRIAL_GB = 1
 
+DB_PATH = "vpn_platform.db"
+db = Database(DB_PATH)
+keyboard_cache = KeyboardCache(db)
+user_cache = UserCache(db)
+
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
@@ -67,7 +108,8 @@ logger = logging.getLogger(__name__)
     STATE_ADMIN_TARIFFS_MENU, STATE_ADMIN_EDIT_TARIFF, STATE_ADMIN_EDIT_TARIFF_INPUT,
     STATE_ADMIN_PROMO_MENU, STATE_ADMIN_ADD_PROMO_CODE, STATE_ADMIN_ADD_PROMO_DISCOUNT,
     STATE_ADMIN_ADD_PROMO_USES,
-) = range(53)
+    STATE_ADMIN_BULK_REVOKE_INPUT,
+) = range(47)
 
 # !!! ВАЖНО: Тарифы теперь управляются через базу данных, этот словарь больше не используется для отображения !!!
 # Он оставлен для обратной совместимости в редких случаях, но основная логика переписана.
@@ -79,243 +121,13 @@ PRICES = {
     "12_months": {"name": "1 Год", "price": 1000, "months": 12, "days": 366, "gb": 12000},
 }
 
-# =======================================
-# ===    КЛАСС ДЛЯ РАБОТЫ С API 3X-UI ===
-# =======================================
-class XUI_API:
-    def __init__(self, base_url, username, password):
-        self.base_url = base_url.rstrip('/')
-        self.username = username
-        self.password = password
-        self._session = aiohttp.ClientSession()
-        self.session_cookie = None
-        self.login_lock = asyncio.Lock()
-
-    async def close(self):
-        if self._session and not self._session.closed:
-            await self._session.close()
-
-    async def login(self):
-        """Проверяет доступность панели и правильность данных для входа."""
-        url = f"{self.base_url}/login"
-        login_payload = {"username": self.username, "password": self.password}
-        try:
-            async with self._session.post(url, data=login_payload, timeout=10) as response:
-                if response.status == 200 and 'session' in response.cookies:
-                    logger.info(f"Панель {self.base_url} доступна, авторизация успешна.")
-                    return True
-                else:
-                    logger.error(f"Панель {self.base_url} недоступна или данные неверны. Статус: {response.status}")
-                    return False
-        except Exception as e:
-            logger.error(f"Не удалось подключиться к панели {self.base_url}: {e}")
-            return False
-        """Просто проверяет, что панель доступна и отвечает."""
-        url = f"{self.base_url}/login"
-        try:
-            async with self._session.get(url, timeout=10) as response:
-                if response.status == 200:
-                    logger.info(f"Панель {self.base_url} доступна.")
-                    return True
-                else:
-                    logger.error(f"Панель {self.base_url} недоступна. Статус: {response.status}")
-                    return False
-        except Exception as e:
-            logger.error(f"Не удалось подключиться к панели {self.base_url}: {e}")
-            return False
-    
-    async def _api_request(self, method, endpoint, **kwargs):
-    # Шаг 1: Авторизация для получения сессии
-        login_payload = {"username": self.username, "password": self.password}
-        login_url = f"{self.base_url}/login"
-    
-    # Используем одну сессию для логина и последующего запроса
-    # aiohttp автоматически сохранит cookie внутри этой сессии
-        try:
-            async with self._session.post(login_url, data=login_payload, timeout=10) as login_response:
-                if login_response.status != 200:
-                    logger.error(f"Ошибка авторизации в 3X-UI ({self.base_url}): Статус {login_response.status}")
-                    return None
-                # Проверяем, что ответ содержит cookie, даже если он нестандартный
-                if not self._session.cookie_jar:
-                    logger.error(f"Панель {self.base_url} не вернула cookie после успешного логина.")
-                    return None
-                logger.info(f"Успешно получен cookie сессии от {self.base_url}")
-
-            # Шаг 2: Выполнение основного запроса с использованием cookie из сессии
-            url = f"{self.base_url}{endpoint}"
-            async with self._session.request(method, url, timeout=15, **kwargs) as response:
-                if response.status != 200:
-                    logger.error(f"Ошибка в API запросе к {endpoint}: {response.status}, {await response.text()}")
-                    return None
-                return await response.json()
-
-        except Exception as e:
-            logger.error(f"Исключение при выполнении API запроса к {endpoint}: {e}")
-            return None
-    
-    async def _handle_response(self, response, endpoint):
-        if response.status != 200:
-            logger.error(f"Ошибка в API запросе к {endpoint} на {self.base_url}: {response.status}, {await response.text()}")
-            return None
-        return await response.json()
-
-    async def add_vless_client(self, inbound_id: int, user_id: int, days: int, gb: int, flow: str = "xtls-rprx-vision"):
-        client_uuid = str(uuid.uuid4())
-        email = f"user_{user_id}_{datetime.now().strftime('%Y%m%d%H%M')}"
-        expire_time = int((datetime.now() + timedelta(days=days)).timestamp() * 1000)
-        total_gb = gb * 1024 * 1024 * 1024
-
-        client = {
-            "id": client_uuid, "email": email, "flow": flow,
-            "totalGB": total_gb, "expiryTime": expire_time, "enable": True,
-            "tgId": str(user_id), "subId": ""
-        }
-        settings = {"clients": [client]}
-        payload = {"id": inbound_id, "settings": json.dumps(settings)}
-
-        response = await self._api_request("POST", "/panel/api/inbounds/addClient", json=payload)
-
-        if response and response.get("success"):
-            logger.info(f"Успешно создан VLESS клиент {client_uuid} для пользователя {user_id} в inbound {inbound_id} на {self.base_url}")
-            return {"uuid": client_uuid, "email": email}
-        else:
-            logger.error(f"Не удалось создать VLESS клиента для {user_id} на {self.base_url}. Ответ панели: {response}")
-            return None
-
-    async def delete_client(self, inbound_id: int, client_uuid: str):
-        endpoint = f"/panel/api/inbounds/{inbound_id}/delClient/{client_uuid}"
-        response = await self._api_request("POST", endpoint)
-
-        if response and response.get("success"):
-            logger.info(f"Успешно удален клиент {client_uuid} из inbound {inbound_id} на {self.base_url}")
-            return True
-        else:
-            logger.error(f"Не удалось удалить клиента {client_uuid} на {self.base_url}. Ответ панели: {response}")
-            return False
-
-# =======================================
-# ===          БАЗА ДАННЫХ            ===
-# =======================================
-def init_db():
-    with sqlite3.connect("vpn_platform.db") as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY, username TEXT, subscription_type TEXT,
-            expires_at TEXT, referrer_id INTEGER, referral_balance REAL DEFAULT 0,
-            main_balance REAL DEFAULT 0, has_used_trial INTEGER DEFAULT 0, has_used_trial INTEGER DEFAULT 0
-        )""")
-        
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS servers (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT UNIQUE NOT NULL, panel_url TEXT NOT NULL,
-            panel_username TEXT NOT NULL, panel_password TEXT NOT NULL,
-            vless_address TEXT NOT NULL, vless_port INTEGER NOT NULL,
-            vless_inbound_id INTEGER NOT NULL, vless_sni TEXT NOT NULL,
-            vless_flow TEXT NOT NULL, vless_public_key TEXT NOT NULL,
-            vless_short_id TEXT NOT NULL, is_active INTEGER DEFAULT 1
-        )""")
-        
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS vpn_profiles (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            assigned_to_user_id INTEGER NOT NULL, server_id INTEGER NOT NULL,
-            config_link TEXT NOT NULL, client_uuid TEXT NOT NULL,
-            inbound_id INTEGER NOT NULL, created_at TEXT NOT NULL,
-            FOREIGN KEY (server_id) REFERENCES servers (id) ON DELETE CASCADE
-        )""")
-
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS tariffs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT UNIQUE NOT NULL, name TEXT NOT NULL,
-            price REAL NOT NULL, days INTEGER NOT NULL, gb INTEGER NOT NULL, is_active INTEGER DEFAULT 1
-        )""")
-
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS promocodes (
-            code TEXT PRIMARY KEY, discount_percent INTEGER NOT NULL,
-            max_uses INTEGER NOT NULL, uses_count INTEGER DEFAULT 0, is_active INTEGER DEFAULT 1
-        )""")
-        
-        # Заполнение тарифов из старого словаря, если таблица пуста
-        if cursor.execute("SELECT COUNT(*) FROM tariffs").fetchone()[0] == 0:
-            for key, data in PRICES.items():
-                cursor.execute(
-                    "INSERT INTO tariffs (key, name, price, days, gb) VALUES (?, ?, ?, ?, ?)",
-                    (key, data['name'], data['price'], data['days'], data['gb'])
-                )
-            logger.info("Таблица тарифов успешно заполнена изначальными значениями.")
-
-
-        # НОВЫЕ ТАБЛИЦЫ
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS tariffs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT UNIQUE NOT NULL, name TEXT NOT NULL,
-            price REAL NOT NULL, days INTEGER NOT NULL, gb INTEGER NOT NULL, is_active INTEGER DEFAULT 1
-        )""")
-
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS promocodes (
-            code TEXT PRIMARY KEY, discount_percent INTEGER NOT NULL,
-            max_uses INTEGER NOT NULL, uses_count INTEGER DEFAULT 0, is_active INTEGER DEFAULT 1
-        )""")
-        
-        # Заполнение тарифов из старого словаря, если таблица пуста
-        if cursor.execute("SELECT COUNT(*) FROM tariffs").fetchone()[0] == 0:
-            for key, data in PRICES.items():
-                cursor.execute(
-                    "INSERT INTO tariffs (key, name, price, days, gb) VALUES (?, ?, ?, ?, ?)",
-                    (key, data['name'], data['price'], data['days'], data['gb'])
-                )
-            logger.info("Таблица тарифов успешно заполнена изначальными значениями.")
-
-        cursor.execute("CREATE TABLE IF NOT EXISTS support_tickets (user_id INTEGER PRIMARY KEY, thread_id INTEGER)")
-        cursor.execute("CREATE TABLE IF NOT EXISTS payments (invoice_id INTEGER PRIMARY KEY, user_id INTEGER, tariff_key TEXT, amount REAL, currency TEXT, status TEXT DEFAULT 'waiting', payment_type TEXT DEFAULT 'subscription')")
-        cursor.execute("CREATE TABLE IF NOT EXISTS referrals (id INTEGER PRIMARY KEY AUTOINCREMENT, referrer_id INTEGER, referred_id INTEGER, created_at TEXT)")
-        cursor.execute("CREATE TABLE IF NOT EXISTS bot_texts (key TEXT PRIMARY KEY, value TEXT)")
-
-        default_texts = {
-            "start_message": "👋 Привет, {first_name}!\nЭто бот для покупки ARMT-VPN.\nУ нас самые выгодные цены, качественные протоколы и огромные скорости.\nПо вопросам обращайтесь в поддержку.\nВыберите действие:",
-            "buy_vpn_header": "Выберите тариф:",
-            "select_payment_method_header": "Выберите способ оплаты:",
-            "sbp_info_text": "Для оплаты по СБП, пожалуйста, нажмите кнопку ниже. Мы создадим для вас тикет, и оператор вышлет реквизиты для оплаты тарифа *{tariff_name}*.",
-            "select_currency_header": "Выберите валюту для оплаты:",
-            "instructions_main": "Здесь вы найдете инструкции по установке и подключению нашего VPN на различных устройствах. Выберите вашу операционную систему:",
-            "instructions_ios": "Инструкция для iOS:\n1. Скачайте приложение Outline из App Store.\n2. Скопируйте ключ доступа, который вы получили от бота.\n3. Откройте Outline, приложение автоматически определит ключ в буфере обмена и предложит добавить сервер.\n4. Нажмите 'Подключить'. Готово!",
-            "instructions_android": "Инструкция для Android:\n1. Скачайте приложение Outline из Google Play.\n2. Скопируйте ключ доступа, который вы получили от бота.\n3. Откройте Outline, приложение автоматически определит ключ в буфере обмена и предложит добавить сервер.\n4. Нажмите 'Подключить'. Готово!",
-            "instructions_windows": "Инструкция для Windows:\n1. Скачайте клиент Outline с официального сайта.\n2. Установите программу.\n3. Скопируйте ключ доступа, который вы получили от бота.\n4. Откройте Outline и вставьте ключ в поле для добавления сервера.\n5. Нажмите 'Подключить'. Готово!",
-            "instructions_macos": "Инструкция для macOS:\n1. Скачайте клиент Outline из App Store или с официального сайта.\n2. Установите программу.\n3. Скопируйте ключ доступа, который вы получили от бота.\n4. Откройте Outline и вставьте ключ в поле для добавления сервера.\n5. Нажмите 'Подключить'. Готово!",
-            "referral_message": "🤝 **Реферальная система**\n\nПриглашайте друзей и получайте *10%* с каждой их покупки на свой реферальный баланс!\n\n💰 Ваш реферальный баланс: *{balance}* ₽\n👥 Приглашено пользователей: *{count}*\n\n🔗 Ваша реферальная ссылка для приглашения:\n`{link}`",
-            "balance_menu_text": "💰 **Ваш баланс**\n\nОсновной баланс: *{main_balance:.2f} ₽*\nРеферальный баланс: *{ref_balance:.2f} ₽*\n\nОбщий доступный баланс для оплаты: **{total_balance:.2f} ₽**",
-            "last_used_server_index": "-1"
-        }
-        for key, value in default_texts.items():
-            cursor.execute("INSERT OR IGNORE INTO bot_texts (key, value) VALUES (?, ?)", (key, value))
-
-        try:
-            cursor.execute("ALTER TABLE users ADD COLUMN main_balance REAL DEFAULT 0")
-        except sqlite3.OperationalError:
-            pass
-        try:
-            cursor.execute("ALTER TABLE users ADD COLUMN has_used_trial INTEGER DEFAULT 0")
-        except sqlite3.OperationalError:
-            pass
-        
-        conn.commit()
-    logger.info("База данных инициализирована.")
-
 # =======================================
 # ===    ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ      ===
 # =======================================
 async def get_text(key: str, context: ContextTypes.DEFAULT_TYPE, **kwargs) -> str:
     if 'texts' not in context.bot_data:
-        context.bot_data['texts'] = {}
-        with sqlite3.connect("vpn_platform.db") as conn:
-            rows = conn.cursor().execute("SELECT key, value FROM bot_texts").fetchall()
-            for row_key, value in rows:
-                context.bot_data['texts'][row_key] = value
+        rows = await db.fetchall("SELECT key, value FROM bot_texts")
+        context.bot_data['texts'] = {row_key: value for row_key, value in rows}
 
     text_template = context.bot_data.get('texts', {}).get(key, f"⚠️ Текст для '{key}' не найден.")
     try:
@@ -325,53 +137,56 @@ async def get_text(key: str, context: ContextTypes.DEFAULT_TYPE, **kwargs) -> st
         return text_template
 
 async def set_text(key: str, value: str, context: ContextTypes.DEFAULT_TYPE):
-    with sqlite3.connect("vpn_platform.db") as conn:
-        conn.cursor().execute("UPDATE bot_texts SET value = ? WHERE key = ?", (value, key))
-        conn.commit()
+    await db.execute("UPDATE bot_texts SET value = ? WHERE key = ?", (value, key))
     if 'texts' in context.bot_data:
         del context.bot_data['texts']
+    keyboard_cache.invalidate()
 
-async def create_and_assign_vpn_profile_from_panel(user_id: int, username: str, tariff_key: str, context: ContextTypes.DEFAULT_TYPE, payment_amount: float = None) -> str | None:
-    with sqlite3.connect("vpn_platform.db") as conn:
-        conn.row_factory = sqlite3.Row
-        servers = conn.cursor().execute("SELECT * FROM servers WHERE is_active = 1").fetchall()
-    
-    if not servers:
-        logger.critical("КРИТИЧЕСКАЯ ОШИБКА: В базе данных нет ни одного активного сервера!")
-        for admin_id in ADMIN_IDS:
-            try:
-                await context.bot.send_message(admin_id, "‼️ **ОШИБКА ВЫДАЧИ КЛЮЧА** ‼️\n\nВ базе нет активных серверов! Добавьте сервер через админ-панель. Выдача ключей остановлена.", parse_mode="Markdown")
-            except Exception: pass
-        return None
-
-    last_index_str = await get_text("last_used_server_index", context)
-    next_index = (int(last_index_str) + 1) % len(servers)
-    selected_server = servers[next_index]
-    await set_text("last_used_server_index", str(next_index), context)
+async def create_and_assign_vpn_profile_from_panel(user_id: int, username: str, tariff_key: str, context: ContextTypes.DEFAULT_TYPE, payment_amount: float = None, on_commit=None) -> str | None:
+    """on_commit(conn, config_link) вызывается в транзакции, записывающей профиль.
 
-    logger.info(f"Выбран сервер '{selected_server['name']}' (ID: {selected_server['id']}) для пользователя {user_id}")
-    
-    api = XUI_API(selected_server['panel_url'], selected_server['panel_username'], selected_server['panel_password'])
-    
+    Если ключ выдать не удалось, бросает RuntimeError с причиной.
+    """
+    await allocator.ensure_loaded(db)
     tariff = PRICES[tariff_key]
-    client_data = await api.add_vless_client(
-        inbound_id=selected_server['vless_inbound_id'], user_id=user_id,
-        days=tariff['days'], gb=tariff['gb'], flow=selected_server['vless_flow']
-    )
-    await api.close()
+
+    # Разомкнутые автоматом панели пропускаем; если выбранная панель не
+    # выдала ключ, один раз пробуем другой сервер в рамках той же покупки.
+    failed_servers = []
+    client_data = None
+    for _ in range(2):
+        selected_server = allocator.acquire(exclude=health_monitor.unavailable() | {s['id'] for s in failed_servers})
+        if selected_server is None:
+            break
+
+        logger.info(f"Выбран сервер '{selected_server['name']}' (ID: {selected_server['id']}) для пользователя {user_id}")
+        # Ключ берется из пула сервера; без него одновременные покупки
+        # на тот же сервер уходят в панель одним запросом
+        with provisioning_stats.measure("panel"):
+            client_data = await key_pool.issue(db, selected_server, user_id, tariff['days'], tariff['gb'])
+        if client_data:
+            health_monitor.record_success(selected_server['id'])
+            break
+
+        allocator.release(selected_server['id'])
+        health_monitor.record_failure(selected_server['id'])
+        failed_servers.append(selected_server)
+        logger.error(f"Не удалось создать профиль через API для пользователя {user_id} на сервере {selected_server['name']}")
+
+    # Админов не уведомляем: задача выдачи повторяется, и о провале после
+    # последней попытки с этой причиной сообщит provisioning_job_failed
+    if not client_data and not failed_servers:
+        if allocator.has_servers():
+            # Серверы есть, но автомат разомкнут на всех панелях
+            logger.critical("КРИТИЧЕСКАЯ ОШИБКА: все панели недоступны!")
+            raise RuntimeError("все панели недоступны")
+        logger.critical("КРИТИЧЕСКАЯ ОШИБКА: В базе данных нет ни одного активного сервера!")
+        raise RuntimeError("в базе нет активных серверов, добавьте сервер через админ-панель")
 
     if not client_data:
-        logger.critical(f"Не удалось создать профиль через API для пользователя {user_id} на сервере {selected_server['name']}!")
-        for admin_id in ADMIN_IDS:
-            try:
-                await context.bot.send_message(
-                    chat_id=admin_id,
-                    text=f"‼️ **ОШИБКА ВЫДАЧИ** ‼️\n\nНе удалось создать ключ для @{username} (ID: `{user_id}`) на сервере *{selected_server['name']}*. Проверьте логи бота и доступность панели.",
-                    parse_mode="Markdown"
-                )
-            except Exception as e:
-                logger.error(f"Не удалось отправить уведомление админу {admin_id}: {e}")
-        return None
+        server_names = ", ".join(s['name'] for s in failed_servers)
+        logger.critical(f"Не удалось создать профиль через API для пользователя {user_id} на серверах: {server_names}!")
+        raise RuntimeError(f"панели серверов {server_names} не создали ключ")
 
     client_uuid = client_data['uuid']
     client_email = client_data['email'] # Получаем email, чтобы использовать в названии
@@ -392,10 +207,8 @@ async def create_and_assign_vpn_profile_from_panel(user_id: int, username: str,
         f"&flow={selected_server['vless_flow']}#{remarks}"
     )
 
-    with sqlite3.connect("vpn_platform.db") as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT expires_at FROM users WHERE user_id = ?", (user_id,))
-        current_sub = cursor.fetchone()
+    def save_profile(conn):
+        current_sub = conn.execute("SELECT expires_at FROM users WHERE telegram_id = ?", (user_id,)).fetchone()
         start_date = datetime.now()
         if current_sub and current_sub[0]:
             try:
@@ -406,61 +219,56 @@ async def create_and_assign_vpn_profile_from_panel(user_id: int, username: str,
         expires_at = start_date + timedelta(days=tariff['days'])
         expires_at_str = expires_at.strftime('%Y-%m-%d %H:%M:%S')
 
-        cursor.execute(
-            "INSERT INTO users (user_id, username, subscription_type, expires_at) VALUES (?, ?, ?, ?) ON CONFLICT(user_id) DO UPDATE SET expires_at = ?, username = ?",
+        conn.execute(
+            "INSERT INTO users (telegram_id, telegram_username, subscription_type, expires_at) VALUES (?, ?, ?, ?) ON CONFLICT(telegram_id) DO UPDATE SET expires_at = ?, telegram_username = ?",
             (user_id, username, tariff_key, expires_at_str, expires_at_str, username)
         )
 
         now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        cursor.execute(
-            "INSERT INTO vpn_profiles (assigned_to_user_id, server_id, config_link, client_uuid, inbound_id, created_at) VALUES (?, ?, ?, ?, ?, ?)",
-            (user_id, selected_server['id'], config_link, client_uuid, selected_server['vless_inbound_id'], now_str)
+        conn.execute(
+            "INSERT INTO vpn_profiles (user_id, server_id, config_link, client_uuid, inbound_id, created_at) SELECT id, ?, ?, ?, ?, ? FROM users WHERE telegram_id = ?",
+            (selected_server['id'], config_link, client_uuid, selected_server['vless_inbound_id'], now_str, user_id)
         )
         
+        referral = None
         if payment_amount:
-            referrer_id_row = cursor.execute("SELECT referrer_id FROM users WHERE user_id = ?", (user_id,)).fetchone()
-            if referrer_id_row and referrer_id_row[0]:
-                referrer_id = referrer_id_row[0]
+            referrer = conn.execute(
+                "SELECT r.id, r.telegram_id FROM users u JOIN users r ON r.id = u.referrer_id WHERE u.telegram_id = ?", (user_id,)
+            ).fetchone()
+            if referrer:
                 bonus = payment_amount * 0.10
-                cursor.execute("UPDATE users SET referral_balance = referral_balance + ? WHERE user_id = ?", (bonus, referrer_id))
-                try:
-                    await context.bot.send_message(referrer_id, f"🎉 Вам начислен реферальный бонус *{bonus:.2f} ₽*!", parse_mode="Markdown")
-                except Exception as e:
-                    logger.warning(f"Не удалось уведомить {referrer_id} о реферальном бонусе: {e}")
+                conn.execute("UPDATE users SET referral_balance = referral_balance + ? WHERE id = ?", (bonus, referrer[0]))
+                if referrer[1]:
+                    referral = referrer[1], bonus
+        if on_commit is not None:
+            on_commit(conn, config_link)
+        return referral
 
-        conn.commit()
+    try:
+        with provisioning_stats.measure("db"):
+            referral = await db.transaction(save_profile)
+    except Exception:
+        allocator.release(selected_server['id'])
+        raise
+    allocator.commit(selected_server['id'])
+    user_cache.invalidate(user_id)
+    if referral:
+        referrer_id, bonus = referral
+        user_cache.invalidate(referrer_id)
+        try:
+            await context.bot.send_message(referrer_id, f"🎉 Вам начислен реферальный бонус *{bonus:.2f} ₽*!", parse_mode="Markdown", rate_limit_args=TRANSACTIONAL)
+        except Exception as e:
+            logger.warning(f"Не удалось уведомить {referrer_id} о реферальном бонусе: {e}")
 
     logger.info(f"Пользователю {user_id} выдан профиль с сервера {selected_server['name']}. UUID: {client_uuid}.")
     return config_link
 
 
-# =======================================
-# ===      API КЛАСС CRYPTOBOT         ===
-# =======================================
-class CryptoBotAPI:
-    def __init__(self, token):
-        self.base_url = "https://pay.crypt.bot/api"
-        self.headers = {"Crypto-Pay-API-Token": token} if token else {}
-
-    async def get_exchange_rates(self):
-        async with aiohttp.ClientSession() as s:
-            async with s.get(f"{self.base_url}/getExchangeRates", headers=self.headers) as r:
-                return await r.json()
-
-    async def create_invoice(self, asset, amount, params=None):
-        payload = {"asset": asset, "amount": amount, "expires_in": 3600}
-        if params:
-            payload.update(params)
-        async with aiohttp.ClientSession() as s:
-            async with s.post(f"{self.base_url}/createInvoice", headers=self.headers, json=payload) as r:
-                return await r.json()
-
-    async def get_invoices(self, invoice_ids):
-        async with aiohttp.ClientSession() as s:
-            async with s.get(f"{self.base_url}/getInvoices", headers=self.headers, params={"invoice_ids": invoice_ids}) as r:
-                return await r.json()
-
 cryptobot = CryptoBotAPI(CRYPTO_BOT_TOKEN)
+crypto_webhook = None
+bot_application = None
+# Счета пополнения, о которых админам уже сообщили, что нет курса
+rate_alerted_invoices = set()
 
 # =======================================
 # ===      ОСНОВНЫЕ ХЭНДЛЕРЫ          ===
@@ -469,35 +277,12 @@ cryptobot = CryptoBotAPI(CRYPTO_BOT_TOKEN)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.effective_user
-    with sqlite3.connect("vpn_platform.db") as conn:
-        cursor = conn.cursor()
-        existing_user = cursor.execute("SELECT user_id, has_used_trial FROM users WHERE user_id = ?", (user.id,)).fetchone()
-        if not existing_user:
-            cursor.execute("INSERT INTO users (user_id, username, referrer_id) VALUES (?, ?, ?)", (user.id, user.username, None))
-            has_used_trial = 0
-        else:
-            cursor.execute("UPDATE users SET username = ? WHERE user_id = ?", (user.username, user.id))
-            has_used_trial = existing_user[1]
-        conn.commit()
-
-    keyboard = [
-        [InlineKeyboardButton("🛒 Купить VPN", callback_data="buy_vpn")],
-    ]
-    # Показываем кнопку триала, если пользователь ее не использовал
-    if not has_used_trial:
-        keyboard.insert(1, [InlineKeyboardButton("🚀 Попробовать бесплатно", callback_data="get_trial")])
-
-    keyboard.extend([
-        [InlineKeyboardButton("💰 Баланс", callback_data="balance_menu")],
-        [InlineKeyboardButton("🔑 Мой VPN", callback_data="my_vpn")],
-        [InlineKeyboardButton("📖 Инструкция", callback_data="instructions")],
-        [InlineKeyboardButton("💬 Поддержка", callback_data="support")]
-    ])
-    if user.id in ADMIN_IDS:
-        keyboard.append([InlineKeyboardButton("👑 Админ-панель", callback_data="admin_panel")])
+    # touch снимает отметку недоступности в базе; еще не записанная отметка не должна вернуть ее при flush
+    delivery_tracker.forget(user.id)
+    has_used_trial = (await user_cache.touch(user.id, user.username))['has_used_trial']
 
     message_text = await get_text("start_message", context, first_name=escape_markdown(user.first_name))
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = keyboard_cache.main_menu(has_used_trial, user.id in ADMIN_IDS)
 
     if update.callback_query:
         await update.callback_query.answer()
@@ -512,25 +297,30 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 # =======================================
 # ===        ПРОЦЕСС ПОКУПКИ          ===
 # =======================================
+async def tariffs_keyboard():
+    """Клавиатура активных тарифов или None, если их нет (тогда не кэшируется)."""
+    tariffs = await db.fetchall("SELECT * FROM tariffs WHERE is_active = 1 ORDER BY price")
+    if not tariffs:
+        return None
+
+    keyboard = []
+    for tariff in tariffs:
+        keyboard.append([InlineKeyboardButton(f"{tariff['name']} - {tariff['price']}₽", callback_data=f"tariff_{tariff['key']}")])
+
+    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="main_menu")])
+    return InlineKeyboardMarkup(keyboard)
+
 async def select_tariff(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
 
-    with sqlite3.connect("vpn_platform.db") as conn:
-        conn.row_factory = sqlite3.Row
-        tariffs = conn.cursor().execute("SELECT * FROM tariffs WHERE is_active = 1 ORDER BY price").fetchall()
-
-    if not tariffs:
+    reply_markup = await keyboard_cache.get_async("tariffs", tariffs_keyboard)
+    if reply_markup is None:
         await query.edit_message_text("На данный момент нет доступных тарифов. Пожалуйста, зайдите позже.")
         return STATE_MAIN_MENU
-    
-    keyboard = []
-    for tariff in tariffs:
-        keyboard.append([InlineKeyboardButton(f"{tariff['name']} - {tariff['price']}₽", callback_data=f"tariff_{tariff['key']}")])
 
-    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="main_menu")])
     text = await get_text("buy_vpn_header", context)
-    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+    await query.edit_message_text(text, reply_markup=reply_markup)
     return STATE_AWAIT_PROMOCODE # Переход к вводу промокода
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -549,8 +339,7 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 async def select_payment_method(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    if query.data.startswith("tariff_"):
-        context.user_data['tariff_key'] = query.data.split("tariff_")[1]
+    context.user_data['tariff_key'] = context.callback_params['tariff_key']
 
     tariff_key = context.user_data.get('tariff_key')
     if not tariff_key:
@@ -559,11 +348,10 @@ async def select_payment_method(update: Update, context: ContextTypes.DEFAULT_TY
 
     tariff_price = PRICES[tariff_key]['price']
     user_id = query.from_user.id
-    with sqlite3.connect("vpn_platform.db") as conn:
-        balances = conn.cursor().execute("SELECT main_balance, referral_balance FROM users WHERE user_id = ?", (user_id,)).fetchone()
+    balances = await user_cache.get(user_id)
 
-    main_balance = balances[0] if balances else 0
-    ref_balance = balances[1] if balances else 0
+    main_balance = balances['main_balance'] if balances else 0
+    ref_balance = balances['referral_balance'] if balances else 0
     total_balance = main_balance + ref_balance
 
     keyboard = []
@@ -614,7 +402,7 @@ async def select_currency(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 async def create_payment(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    currency = query.data.split("currency_")[1]
+    currency = context.callback_params['currency']
     tariff_key = context.user_data.get('tariff_key')
     if not tariff_key:
         await query.edit_message_text("❌ Ошибка: не удалось определить тариф. Попробуйте начать сначала.")
@@ -625,27 +413,20 @@ async def create_payment(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     await query.answer()
     await query.edit_message_text("⏳ Создаю счет...")
 
-    rates = await cryptobot.get_exchange_rates()
-    if not rates or not rates.get("ok"):
-        await query.edit_message_text("❌ Не удалось получить курсы валют.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="pay_crypto")]]))
-        return STATE_AWAIT_PAYMENT
-
-    rate = next((r for r in rates["result"] if r["source"] == currency and r["target"] == "RUB"), None)
+    rate = await cryptobot.get_rate(currency, "RUB")
     if not rate:
-        await query.edit_message_text(f"❌ Не удалось найти курс для {currency}/RUB.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="pay_crypto")]]))
+        await query.edit_message_text(f"❌ Не удалось получить курс {currency}/RUB.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="pay_crypto")]]))
         return STATE_AWAIT_PAYMENT
 
-    amount_crypto = f"{amount_rub / float(rate['rate']):.8f}"
+    amount_crypto = f"{amount_rub / rate:.8f}"
     invoice = await cryptobot.create_invoice(asset=currency, amount=amount_crypto)
 
     if invoice and invoice.get("ok"):
         res = invoice["result"]
-        with sqlite3.connect("vpn_platform.db") as conn:
-            conn.cursor().execute(
-                "INSERT INTO payments (invoice_id, user_id, tariff_key, amount, currency, payment_type) VALUES (?, ?, ?, ?, ?, 'subscription')",
-                (res['invoice_id'], query.from_user.id, tariff_key, amount_rub, currency)
-            )
-            conn.commit()
+        await db.execute(
+            "INSERT INTO payments (invoice_id, user_id, tariff_key, amount, currency, payment_type, created_at) VALUES (?, ?, ?, ?, ?, 'subscription', ?)",
+            (res['invoice_id'], query.from_user.id, tariff_key, amount_rub, currency, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        )
         keyboard = [
             [InlineKeyboardButton("Оплатить", url=res['pay_url'])],
             [InlineKeyboardButton("✅ Я оплатил", callback_data=f"check_{res['invoice_id']}")],
@@ -664,67 +445,201 @@ async def create_payment(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return STATE_AWAIT_PAYMENT
 
 
+async def fulfill_invoice(invoice, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """Зачисляет оплаченный счет CryptoBot: выдает подписку или пополняет баланс.
+
+    Вызывается из вебхука и из кнопки «Я оплатил». Статус в payments
+    меняется условным UPDATE, поэтому счет обрабатывается ровно один раз.
+    Возвращает False, если счет не найден или уже обработан.
+    """
+    invoice_id = int(invoice['invoice_id'])
+    payment = await db.fetchone(
+        PAYMENT_SQL, (invoice_id,)
+    )
+    if not payment or payment['status'] == 'paid':
+        return False
+    user_id = payment['user_id']
+
+    if payment['payment_type'] == 'balance':
+        rate = await cryptobot.get_rate(invoice['asset'], "RUB")
+        if not rate:
+            # Счет остается waiting: следующий опрос зачислит его, когда курс появится
+            logger.critical(f"Не удалось получить курс для {invoice['asset']}/RUB. Invoice_id: {invoice_id}")
+            if invoice_id not in rate_alerted_invoices:
+                rate_alerted_invoices.add(invoice_id)
+                for admin_id in ADMIN_IDS:
+                    try:
+                        await context.bot.send_message(
+                            admin_id, f"‼️ Нет курса {invoice['asset']}/RUB: оплаченный счет `{invoice_id}` пользователя `{user_id}` пока не зачислен на баланс.",
+                            parse_mode="Markdown", rate_limit_args=TRANSACTIONAL
+                        )
+                    except Exception as e:
+                        logger.error(f"Не удалось отправить уведомление админу {admin_id}: {e}")
+            return False
+        rate_alerted_invoices.discard(invoice_id)
+        amount_rub = float(invoice['amount']) * rate
+
+        def credit_balance(conn):
+            if conn.execute("UPDATE payments SET status = 'paid' WHERE invoice_id = ? AND status != 'paid'", (invoice_id,)).rowcount == 0:
+                return False
+            conn.execute("UPDATE users SET main_balance = main_balance + ? WHERE telegram_id = ?", (amount_rub, user_id))
+            return True
+
+        if not await db.transaction(credit_balance):
+            return False
+        user_cache.invalidate(user_id)
+        await context.bot.send_message(user_id, f"✅ Ваш баланс успешно пополнен на *{amount_rub:.2f} ₽*.", parse_mode="Markdown", rate_limit_args=TRANSACTIONAL)
+        return True
+
+    # Оплата и задача выдачи записываются вместе: ключ выдаст очередь, даже
+    # если бот упадет сразу после этой транзакции.
+    def mark_paid(conn):
+        if conn.execute("UPDATE payments SET status = 'paid' WHERE invoice_id = ? AND status != 'paid'", (invoice_id,)).rowcount == 0:
+            return False
+        enqueue(conn, f"invoice:{invoice_id}", user_id, payment['tariff_key'], payment['amount'])
+        return True
+
+    if not await db.transaction(mark_paid):
+        return False
+    provisioning_worker.notify()
+    await context.bot.send_message(user_id, "✅ Оплата прошла успешно! Выдаю вам доступ...", rate_limit_args=TRANSACTIONAL)
+    return True
+
+
+async def provisioning_job_handler(job):
+    """Выдает ключ по задаче из provisioning_jobs и отправляет его пользователю.
+
+    kind: subscription - оплата счета, balance - покупка с баланса,
+    grant - выдача администратором.
+    """
+    context = ContextTypes.DEFAULT_TYPE(bot_application)
+    payload = job_payload(job)
+    user_id = job['user_id']
+    username = payload.get('username') or await db.fetchval("SELECT telegram_username FROM users WHERE telegram_id = ?", (user_id,))
+    config_link = await create_and_assign_vpn_profile_from_panel(
+        user_id, username, job['tariff_key'], context, payment_amount=job['amount'],
+        on_commit=lambda conn, link: complete_in_transaction(conn, job, link)
+    )
+    if not config_link:
+        raise RuntimeError("не удалось создать профиль на панели")
+
+    with provisioning_stats.measure("delivery"):
+        if job['kind'] == 'grant':
+            try:
+                await context.bot.send_message(user_id, f"🎉 Администратор продлил/выдал вам подписку!\n\nВаш ключ для подключения:\n`{config_link}`", parse_mode="Markdown", rate_limit_args=TRANSACTIONAL)
+                await context.bot.send_message(payload['admin_id'], f"✅ Профиль по тарифу '{PRICES[job['tariff_key']]['name']}' выдан пользователю {username} ({user_id}).", rate_limit_args=TRANSACTIONAL)
+            except Exception as e:
+                await context.bot.send_message(payload['admin_id'], f"⚠️ Профиль для {user_id} выдан, но не удалось уведомить пользователя: {e}", rate_limit_args=TRANSACTIONAL)
+        elif job['kind'] == 'balance':
+            await context.bot.send_message(user_id, f"✅ Оплата с баланса прошла успешно!\n\n🎉 Ваш VPN готов!\n\nВаш ключ для подключения:\n`{config_link}`", parse_mode="Markdown", rate_limit_args=TRANSACTIONAL)
+        else:
+            await context.bot.send_message(user_id, f"🎉 Ваш VPN готов!\n\nВаш ключ для подключения:\n`{config_link}`", parse_mode="Markdown", rate_limit_args=TRANSACTIONAL)
+
+
+def refund_failed_job(conn, job):
+    """Возвращает списанное с баланса в транзакции, помечающей задачу failed."""
+    if job['kind'] != 'balance':
+        return
+    payload = job_payload(job)
+    conn.execute(
+        "UPDATE users SET main_balance = main_balance + ?, referral_balance = referral_balance + ? WHERE telegram_id = ?",
+        (payload['spent_main'], payload['spent_ref'], job['user_id'])
+    )
+    conn.execute("UPDATE provisioning_jobs SET result = 'refunded' WHERE id = ?", (job['id'],))
+
+
+async def provisioning_job_failed(job, error):
+    payload = job_payload(job)
+    if job['kind'] == 'grant':
+        await bot_application.bot.send_message(payload['admin_id'], f"❌ Ошибка! Не удалось создать профиль для {job['user_id']} через API панели: {error}", rate_limit_args=TRANSACTIONAL)
+        return
+    if job['kind'] == 'balance':
+        # Средства уже возвращены в refund_failed_job
+        user_cache.invalidate(job['user_id'])
+        await bot_application.bot.send_message(job['user_id'], "❌ Произошла ошибка при создании профиля VPN. Средства возвращены на ваш баланс. Мы уже уведомлены и скоро свяжемся с вами.", rate_limit_args=TRANSACTIONAL)
+    else:
+        await bot_application.bot.send_message(job['user_id'], "✅ Оплата прошла, но произошла ошибка при создании профиля VPN. Мы уже уведомлены и скоро свяжемся с вами.", rate_limit_args=TRANSACTIONAL)
+    for admin_id in ADMIN_IDS:
+        try:
+            await bot_application.bot.send_message(
+                admin_id, f"‼️ Задача выдачи `{job['idempotency_key']}` для ID `{job['user_id']}` не выполнена: {error}", parse_mode="Markdown", rate_limit_args=TRANSACTIONAL
+            )
+        except Exception as e:
+            logger.error(f"Не удалось отправить уведомление админу {admin_id}: {e}")
+
+
+provisioning_worker = OutboxWorker(
+    db, provisioning_job_handler, on_failed=provisioning_job_failed, on_failed_in_transaction=refund_failed_job,
+    workers=PROVISIONING_WORKERS
+)
+delivery_tracker = DeliveryTracker(db)
+
+
+async def user_unreachable(chat_id, status):
+    # Следующий /start должен увидеть отметку и снять ее
+    user_cache.update(chat_id, delivery_status=status)
+    await delivery_tracker.record(chat_id, status)
+
+
+outbound = OutboundScheduler(on_unreachable=user_unreachable)
+broadcaster = Broadcaster(db)
+qr_cache = QrCache(db)
+
+
+async def crypto_webhook_invoice_paid(invoice):
+    """Оплата из вебхука CryptoBot: зачисляем, не дожидаясь кнопки «Я оплатил»."""
+    await fulfill_invoice(invoice, ContextTypes.DEFAULT_TYPE(bot_application))
+
+
+async def invoice_poll_job(context: ContextTypes.DEFAULT_TYPE):
+    """Проверяет все ожидающие счета пачками и зачисляет оплаченные."""
+    await poll_pending_invoices(db, cryptobot, lambda invoice: fulfill_invoice(invoice, context))
+
+
 async def check_payment(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    invoice_id = int(query.data.split("_")[1])
+    invoice_id = context.callback_params['invoice_id']
     await query.answer("Проверяем статус платежа...")
 
-    res = await cryptobot.get_invoices(invoice_ids=str(invoice_id))
-    if res and res.get("ok") and res["result"]["items"]:
-        item = res["result"]["items"][0]
-        if item["status"] == "paid":
-            await query.edit_message_text("✅ Оплата прошла успешно! Выдаю вам доступ...")
-            with sqlite3.connect("vpn_platform.db") as conn:
-                cursor = conn.cursor()
-                payment_info = cursor.execute("SELECT tariff_key, amount, status FROM payments WHERE invoice_id = ?", (invoice_id,)).fetchone()
-                if not payment_info or payment_info[2] == 'paid':
-                    await query.answer("Этот платеж уже обработан.", show_alert=True)
-                    return STATE_AWAIT_PAYMENT
-                cursor.execute("UPDATE payments SET status = 'paid' WHERE invoice_id = ?", (invoice_id,))
-                conn.commit()
-
-            tariff_key, amount, _ = payment_info
-            config_link = await create_and_assign_vpn_profile_from_panel(query.from_user.id, query.from_user.username, tariff_key, context, payment_amount=amount)
-            
-            if config_link:
-                await query.message.reply_text(f"🎉 Ваш VPN готов!\n\nВаш ключ для подключения:\n`{config_link}`", parse_mode="Markdown")
-            else:
-                await query.message.reply_text("✅ Оплата прошла, но произошла ошибка при создании профиля VPN. Мы уже уведомлены и скоро свяжемся с вами.")
-            return await start(query, context)
-        elif item["status"] == 'expired':
-            await context.bot.send_message(query.from_user.id, "⚠️ Срок действия счета истек. Пожалуйста, создайте новый.")
-            return await select_currency(query, context)
-        else:
-            await context.bot.send_message(query.from_user.id, "⚠️ Платеж еще не подтвержден. Попробуйте снова через минуту.")
-            return STATE_AWAIT_PAYMENT
+    # Статус обновляют вебхук и фоновый опрос CryptoBot, кнопка только читает его
+    status = await db.fetchval("SELECT status FROM payments WHERE invoice_id = ?", (invoice_id,))
+    if status == 'paid':
+        await query.edit_message_text("✅ Оплата получена, ключ отправлен вам отдельным сообщением.")
+        return await start(query, context)
+    elif status == 'expired':
+        await context.bot.send_message(query.from_user.id, "⚠️ Срок действия счета истек. Пожалуйста, создайте новый.")
+        return await select_currency(query, context)
+    elif status is None:
+        await context.bot.send_message(query.from_user.id, "❌ Счет не найден.")
+        return STATE_AWAIT_PAYMENT
     else:
-        logger.error(f"Ошибка проверки счета CryptoBot: {res}")
-        await context.bot.send_message(query.from_user.id, "❌ Не удалось проверить статус платежа.")
+        await context.bot.send_message(query.from_user.id, "⚠️ Платеж еще не подтвержден. Ключ придет автоматически в течение минуты после оплаты.")
         return STATE_AWAIT_PAYMENT
 
 # =======================================
 # ===        БАЛАНС ПОЛЬЗОВАТЕЛЯ      ===
 # =======================================
+def balance_keyboard():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("💎 Пополнить криптой", callback_data="balance_crypto")],
+        [InlineKeyboardButton(f"💳 Пополнить в рублях (от {MIN_RUB_DEPOSIT}₽)", callback_data="balance_rub")],
+        [InlineKeyboardButton("⬅️ Назад", callback_data="main_menu")]
+    ])
+
 async def balance_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
 
-    with sqlite3.connect("vpn_platform.db") as conn:
-        balances = conn.cursor().execute("SELECT main_balance, referral_balance FROM users WHERE user_id = ?", (user_id,)).fetchone()
+    balances = await user_cache.get(user_id)
 
-    main_balance = balances[0] if balances else 0
-    ref_balance = balances[1] if balances else 0
+    main_balance = balances['main_balance'] if balances else 0
+    ref_balance = balances['referral_balance'] if balances else 0
     total_balance = main_balance + ref_balance
 
     text = await get_text("balance_menu_text", context, main_balance=main_balance, ref_balance=ref_balance, total_balance=total_balance)
 
-    keyboard = [
-        [InlineKeyboardButton("💎 Пополнить криптой", callback_data="balance_crypto")],
-        [InlineKeyboardButton(f"💳 Пополнить в рублях (от {MIN_RUB_DEPOSIT}₽)", callback_data="balance_rub")],
-        [InlineKeyboardButton("⬅️ Назад", callback_data="main_menu")]
-    ]
-    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+    await query.edit_message_text(text, reply_markup=keyboard_cache.get("balance_menu", balance_keyboard), parse_mode="Markdown")
     return STATE_BALANCE_MENU
 
 async def balance_ask_crypto_amount(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -750,21 +665,16 @@ async def balance_create_crypto_invoice(update: Update, context: ContextTypes.DE
 
     await update.message.reply_text("⏳ Проверяю сумму и создаю счет...")
 
-    rates = await cryptobot.get_exchange_rates()
-    if not rates or not rates.get("ok"):
-        await update.message.reply_text("❌ Не удалось получить курсы валют для проверки суммы. Попробуйте позже.")
-        return STATE_BALANCE_CRYPTO_AMOUNT
-
-    rate_to_usd = next((r for r in rates["result"] if r["source"] == currency and r["target"] == "USD"), None)
+    rate_to_usd = await cryptobot.get_rate(currency, "USD")
     if not rate_to_usd:
-        await update.message.reply_text(f"❌ Не удалось найти курс для {currency}/USD. Попробуйте другую валюту.")
+        await update.message.reply_text(f"❌ Не удалось получить курс {currency}/USD. Попробуйте позже.")
         return STATE_BALANCE_CRYPTO_AMOUNT
 
-    amount_in_usd = amount * float(rate_to_usd['rate'])
+    amount_in_usd = amount * rate_to_usd
     min_amount_usd = 0.01
 
     if amount_in_usd < min_amount_usd:
-        min_amount_in_crypto = min_amount_usd / float(rate_to_usd['rate'])
+        min_amount_in_crypto = min_amount_usd / rate_to_usd
         await update.message.reply_text(
             f"❌ Сумма слишком мала.\n\nМинимальная сумма для пополнения эквивалентна ${min_amount_usd}.\n"
             f"Пожалуйста, введите сумму больше, чем примерно **{min_amount_in_crypto:.6f} {currency}**."
@@ -775,12 +685,10 @@ async def balance_create_crypto_invoice(update: Update, context: ContextTypes.DE
 
     if invoice and invoice.get("ok"):
         res = invoice["result"]
-        with sqlite3.connect("vpn_platform.db") as conn:
-            conn.cursor().execute(
-                "INSERT INTO payments (invoice_id, user_id, amount, currency, payment_type) VALUES (?, ?, ?, ?, 'balance')",
-                (res['invoice_id'], update.effective_user.id, amount, currency)
-            )
-            conn.commit()
+        await db.execute(
+            "INSERT INTO payments (invoice_id, user_id, amount, currency, payment_type, created_at) VALUES (?, ?, ?, ?, 'balance', ?)",
+            (res['invoice_id'], update.effective_user.id, amount, currency, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        )
         keyboard = [
             [InlineKeyboardButton("Оплатить", url=res['pay_url'])],
             [InlineKeyboardButton("✅ Я оплатил", callback_data=f"check_balance_{res['invoice_id']}")],
@@ -801,57 +709,21 @@ async def balance_create_crypto_invoice(update: Update, context: ContextTypes.DE
 
 async def check_balance_payment(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    invoice_id = int(query.data.split("_")[2])
+    invoice_id = context.callback_params['invoice_id']
     await query.answer("Проверяем статус платежа...")
 
-    res = await cryptobot.get_invoices(invoice_ids=str(invoice_id))
-    if res and res.get("ok") and res["result"]["items"]:
-        item = res["result"]["items"][0]
-        if item["status"] == "paid":
-            with sqlite3.connect("vpn_platform.db") as conn:
-                payment_status = conn.cursor().execute("SELECT status FROM payments WHERE invoice_id = ?", (invoice_id,)).fetchone()
-
-            if payment_status and payment_status[0] == 'paid':
-                await query.answer("Этот платеж уже зачислен.", show_alert=True)
-                return STATE_BALANCE_AWAIT_CRYPTO_PAYMENT
-
-            await query.edit_message_text("✅ Оплата прошла успешно! Зачисляю средства на ваш баланс...")
-
-            paid_amount_crypto = float(item['amount'])
-            paid_currency = item['asset']
-
-            rates = await cryptobot.get_exchange_rates()
-            if not rates or not rates.get("ok"):
-                logger.critical(f"Не удалось получить курсы валют для зачисления баланса. Invoice_id: {invoice_id}")
-                await query.message.reply_text("❌ Критическая ошибка: не удалось получить курсы валют. Администраторы уведомлены.")
-                return await start(update, context)
-
-            rate_info = next((r for r in rates["result"] if r["source"] == paid_currency and r["target"] == "RUB"), None)
-
-            if not rate_info:
-                logger.critical(f"Не удалось получить курс для {paid_currency}/RUB. Invoice_id: {invoice_id}")
-                await query.message.reply_text("❌ Критическая ошибка: не удалось получить курс валюты. Средства не зачислены. Администраторы уведомлены.")
-                return await start(update, context)
-
-            amount_rub = paid_amount_crypto * float(rate_info['rate'])
-
-            with sqlite3.connect("vpn_platform.db") as conn:
-                cursor = conn.cursor()
-                cursor.execute("UPDATE payments SET status = 'paid' WHERE invoice_id = ?", (invoice_id,))
-                cursor.execute("UPDATE users SET main_balance = main_balance + ? WHERE user_id = ?", (amount_rub, query.from_user.id))
-                conn.commit()
-
-            await query.message.reply_text(f"✅ Ваш баланс успешно пополнен на *{amount_rub:.2f} ₽*.", parse_mode="Markdown")
-            return await start(update, context)
-        elif item["status"] == 'expired':
-            await context.bot.send_message(query.from_user.id, "⚠️ Срок действия счета истек. Пожалуйста, создайте новый.")
-            return STATE_BALANCE_AWAIT_CRYPTO_PAYMENT
-        else:
-            await context.bot.send_message(query.from_user.id, "⚠️ Платеж еще не подтвержден. Попробуйте снова через минуту.")
-            return STATE_BALANCE_AWAIT_CRYPTO_PAYMENT
+    status = await db.fetchval("SELECT status FROM payments WHERE invoice_id = ?", (invoice_id,))
+    if status == 'paid':
+        await query.edit_message_text("✅ Платеж зачислен на ваш баланс.")
+        return await start(update, context)
+    elif status == 'expired':
+        await context.bot.send_message(query.from_user.id, "⚠️ Срок действия счета истек. Пожалуйста, создайте новый.")
+        return STATE_BALANCE_AWAIT_CRYPTO_PAYMENT
+    elif status is None:
+        await context.bot.send_message(query.from_user.id, "❌ Счет не найден.")
+        return STATE_BALANCE_AWAIT_CRYPTO_PAYMENT
     else:
-        logger.error(f"Ошибка проверки счета пополнения CryptoBot: {res}")
-        await context.bot.send_message(query.from_user.id, "❌ Не удалось проверить статус платежа.")
+        await context.bot.send_message(query.from_user.id, "⚠️ Платеж еще не подтвержден. Средства зачислятся автоматически в течение минуты после оплаты.")
         return STATE_BALANCE_AWAIT_CRYPTO_PAYMENT
 
 
@@ -900,27 +772,31 @@ async def balance_create_rub_ticket(update: Update, context: ContextTypes.DEFAUL
 async def my_vpn(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    with sqlite3.connect("vpn_platform.db") as conn:
-        cursor = conn.cursor()
-        sub = cursor.execute("SELECT expires_at FROM users WHERE user_id = ?", (query.from_user.id,)).fetchone()
-        profiles = cursor.execute("SELECT id, config_link FROM vpn_profiles WHERE assigned_to_user_id = ?", (query.from_user.id,)).fetchall()
+    sub = await user_cache.get(query.from_user.id)
+    profiles = await user_cache.profiles(query.from_user.id)
 
     text = "У вас нет активных подписок."
     keyboard = []
     
-    if sub and sub[0]:
+    if sub and sub['expires_at']:
         try:
-            expires_dt = datetime.strptime(sub[0], '%Y-%m-%d %H:%M:%S')
+            expires_dt = datetime.strptime(sub['expires_at'], '%Y-%m-%d %H:%M:%S')
             if expires_dt > datetime.now():
                 text = f"🔑 Ваша подписка активна до: **{expires_dt.strftime('%d.%m.%Y %H:%M')}**\n\n"
                 if profiles:
                     text += f"Количество устройств: **{len(profiles)}/5**\n\n"
                     text += "Выберите устройство, чтобы получить QR-код и ключ подключения:"
                     
-                    for i, (profile_id, _) in enumerate(profiles, 1):
+                    for i, (profile_id, server_id, client_uuid) in enumerate(profiles, 1):
+                        label = f"📱 Устройство #{i}"
+                        panel_client = panel_inventory.get(client_uuid)
+                        if panel_client is not None:
+                            label += f" · {panel_client.used_bytes / 1024 ** 3:.2f} ГБ"
+                        elif client_uuid and panel_inventory.missing_on_panel(server_id, client_uuid):
+                            label += " · ⚠️ не найден на сервере"
                         keyboard.append([
                             InlineKeyboardButton(
-                                f"📱 Устройство #{i}", 
+                                label, 
                                 callback_data=f"vpn_device_{profile_id}"
                             )
                         ])
@@ -942,14 +818,12 @@ async def show_vpn_device(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     query = update.callback_query
     await query.answer()
     
-    profile_id = int(query.data.split("vpn_device_")[1])
+    profile_id = context.callback_params['profile_id']
     
-    with sqlite3.connect("vpn_platform.db") as conn:
-        cursor = conn.cursor()
-        profile = cursor.execute(
-            "SELECT config_link, assigned_to_user_id FROM vpn_profiles WHERE id = ?", 
-            (profile_id,)
-        ).fetchone()
+    profile = await db.fetchone(
+        "SELECT p.config_link, u.telegram_id FROM vpn_profiles p JOIN users u ON p.user_id = u.id WHERE p.id = ? AND p.pending_revoke = 0", 
+        (profile_id,)
+    )
     
     if not profile or profile[1] != query.from_user.id:
         await query.edit_message_text(
@@ -960,20 +834,6 @@ async def show_vpn_device(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     
     config_link = profile[0]
     
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_M,
-        box_size=10,
-        border=4,
-    )
-    qr.add_data(config_link)
-    qr.make(fit=True)
-    
-    img = qr.make_image(fill_color="black", back_color="white")
-    bio = BytesIO()
-    img.save(bio, 'PNG')
-    bio.seek(0)
-    
     caption = (
         f"🔑 **Ключ подключения:**\n\n"
         f"`{config_link}`\n\n"
@@ -981,11 +841,7 @@ async def show_vpn_device(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         f"📋 Или скопируйте ключ выше и вставьте в приложение"
     )
     
-    await query.message.reply_photo(
-        photo=bio,
-        caption=caption,
-        parse_mode="Markdown"
-    )
+    await qr_cache.reply(query.message, config_link, caption=caption, parse_mode="Markdown")
     
     keyboard = [
         [InlineKeyboardButton("⬅️ Назад к устройствам", callback_data="my_vpn")]
@@ -999,22 +855,25 @@ async def show_vpn_device(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     return STATE_MAIN_MENU
 
 
-async def instructions_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    query = update.callback_query
-    await query.answer()
-    keyboard = [
+def instructions_keyboard():
+    return InlineKeyboardMarkup([
         [InlineKeyboardButton("📱 iOS", callback_data="instr_ios"), InlineKeyboardButton("🤖 Android", callback_data="instr_android")],
         [InlineKeyboardButton("💻 Windows", callback_data="instr_windows"), InlineKeyboardButton(" macOS", callback_data="instr_macos")],
         [InlineKeyboardButton("⬅️ Назад", callback_data="main_menu")]
-    ]
+    ])
+
+
+async def instructions_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
     text = await get_text("instructions_main", context)
-    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+    await query.edit_message_text(text, reply_markup=keyboard_cache.get("instructions", instructions_keyboard), parse_mode="Markdown")
     return STATE_INSTRUCTIONS
 
 
 async def show_instruction(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    platform = query.data.split("instr_")[1]
+    platform = context.callback_params['platform']
     await query.answer()
     text = await get_text(f"instructions_{platform}", context)
     keyboard = [[InlineKeyboardButton("⬅️ Назад к выбору", callback_data="instructions")]]
@@ -1029,11 +888,8 @@ async def referral_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     bot_username = (await context.bot.get_me()).username
     referral_link = f"https://t.me/{bot_username}?start={user_id}"
 
-    with sqlite3.connect("vpn_platform.db") as conn:
-        cursor = conn.cursor()
-        balance_row = cursor.execute("SELECT referral_balance FROM users WHERE user_id = ?", (user_id,)).fetchone()
-        balance = balance_row[0] if balance_row else 0
-        count, = cursor.execute("SELECT COUNT(*) FROM referrals WHERE referrer_id = ?", (user_id,)).fetchone()
+    balance = await db.fetchval("SELECT referral_balance FROM users WHERE telegram_id = ?", (user_id,), default=0)
+    count = await db.fetchval(REFERRAL_COUNT_SQL, (user_id,))
 
     text = await get_text("referral_message", context, balance=f"{balance:.2f}", count=count, link=referral_link)
 
@@ -1060,15 +916,11 @@ async def pay_from_balance(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 
     await query.edit_message_text("⏳ Проверяю балансы и оформляю подписку...")
 
-    with sqlite3.connect("vpn_platform.db") as conn:
-        cursor = conn.cursor()
-        balances = cursor.execute("SELECT main_balance, referral_balance FROM users WHERE user_id = ?", (user_id,)).fetchone()
+    def charge_balance(conn):
+        balances = conn.execute("SELECT main_balance, referral_balance FROM users WHERE telegram_id = ?", (user_id,)).fetchone()
         main_balance, ref_balance = balances if balances else (0, 0)
-        total_balance = main_balance + ref_balance
-
-        if total_balance < tariff_price:
-            await query.edit_message_text(f"❌ Недостаточно средств. Ваш общий баланс: {total_balance:.2f} ₽. Требуется: {tariff_price} ₽.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ В меню", callback_data="main_menu")]]))
-            return STATE_MAIN_MENU
+        if main_balance + ref_balance < tariff_price:
+            return main_balance, ref_balance, False
 
         spent_from_ref = min(ref_balance, tariff_price)
         remaining_cost = tariff_price - spent_from_ref
@@ -1076,19 +928,24 @@ async def pay_from_balance(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         new_ref_balance = ref_balance - spent_from_ref
         new_main_balance = main_balance - spent_from_main
 
-        cursor.execute("UPDATE users SET main_balance = ?, referral_balance = ? WHERE user_id = ?", (new_main_balance, new_ref_balance, user_id))
-        conn.commit()
-
-    config_link = await create_and_assign_vpn_profile_from_panel(user_id, username, tariff_key, context)
+        conn.execute("UPDATE users SET main_balance = ?, referral_balance = ? WHERE telegram_id = ?", (new_main_balance, new_ref_balance, user_id))
+        # Списание и задача выдачи - одна транзакция; при неудаче выдачи
+        # очередь вернет ровно списанные суммы.
+        enqueue(
+            conn, f"balance:{query.id}", user_id, tariff_key, kind="balance",
+            payload={"username": username, "spent_main": spent_from_main, "spent_ref": spent_from_ref}
+        )
+        return new_main_balance, new_ref_balance, True
 
-    if config_link:
-        await query.message.reply_text(f"✅ Оплата с баланса прошла успешно!\n\n🎉 Ваш VPN готов!\n\nВаш ключ для подключения:\n`{config_link}`", parse_mode="Markdown")
-    else:
-        with sqlite3.connect("vpn_platform.db") as conn:
-            conn.cursor().execute("UPDATE users SET main_balance = ?, referral_balance = ? WHERE user_id = ?", (main_balance, ref_balance, user_id))
-            conn.commit()
-        await query.message.reply_text("❌ Произошла ошибка при создании профиля VPN. Средства возвращены на ваш баланс. Мы уже уведомлены и скоро свяжемся с вами.")
+    main_balance, ref_balance, charged = await db.transaction(charge_balance)
+    user_cache.update(user_id, main_balance=main_balance, referral_balance=ref_balance)
+    if not charged:
+        total_balance = main_balance + ref_balance
+        await query.edit_message_text(f"❌ Недостаточно средств. Ваш общий баланс: {total_balance:.2f} ₽. Требуется: {tariff_price} ₽.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ В меню", callback_data="main_menu")]]))
+        return STATE_MAIN_MENU
 
+    provisioning_worker.notify()
+    await query.message.reply_text("⏳ Оплата с баланса прошла. Создаю ключ, он придет следующим сообщением.")
     return await start(update, context)
 
 
@@ -1099,8 +956,8 @@ async def pay_from_balance(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 
 # ===      АДМИН-ПАНЕЛЬ (НОВАЯ)         ===
 # =======================================
-async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    keyboard = [
+def admin_panel_keyboard():
+    return InlineKeyboardMarkup([
         [InlineKeyboardButton("📊 Статистика", callback_data="admin_stats")],
         [InlineKeyboardButton("✅ Выдать подписку", callback_data="admin_grant_start")],
         [InlineKeyboardButton("🔧 Управление серверами", callback_data="admin_servers_menu")],
@@ -1109,10 +966,15 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
         [InlineKeyboardButton("🔎 Найти по ключу", callback_data="admin_find_by_key")],
         [InlineKeyboardButton("✏️ Редактировать тексты", callback_data="admin_edit_text")],
         [InlineKeyboardButton("📢 Рассылка", callback_data="admin_broadcast_start")],
+        [InlineKeyboardButton("📵 Недоступные пользователи", callback_data="admin_delivery")],
         [InlineKeyboardButton("🚫 Отозвать подписку", callback_data="admin_revoke_start")],
+        [InlineKeyboardButton("🚫 Массовый отзыв", callback_data="admin_bulk_revoke")],
         [InlineKeyboardButton("⬅️ Назад в меню", callback_data="main_menu")]
-    ]
-    markup = InlineKeyboardMarkup(keyboard)
+    ])
+
+
+async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    markup = keyboard_cache.get("admin_panel", admin_panel_keyboard)
     message_text = "👑 **Админ-панель**"
     if update.callback_query:
         await update.callback_query.answer()
@@ -1140,20 +1002,31 @@ async def _return_to_admin_panel_after_action(update: Update, context: ContextTy
 async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    with sqlite3.connect("vpn_platform.db") as conn:
-        c = conn.cursor()
-        total_users = c.execute("SELECT COUNT(*) FROM users").fetchone()[0]
-        active_subs = c.execute("SELECT COUNT(*) FROM users WHERE expires_at IS NOT NULL AND expires_at > ?", (datetime.now().strftime('%Y-%m-%d %H:%M:%S'),)).fetchone()[0]
-        total_profiles = c.execute("SELECT COUNT(*) FROM vpn_profiles").fetchone()[0]
-        active_servers = c.execute("SELECT COUNT(*) FROM servers WHERE is_active = 1").fetchone()[0]
-        total_servers = c.execute("SELECT COUNT(*) FROM servers").fetchone()[0]
+    def collect_stats(conn):
+        return (
+            conn.execute("SELECT COUNT(*) FROM users").fetchone()[0],
+            conn.execute(ACTIVE_SUBSCRIPTIONS_SQL, (datetime.now().strftime('%Y-%m-%d %H:%M:%S'),)).fetchone()[0],
+            conn.execute("SELECT COUNT(*) FROM vpn_profiles").fetchone()[0],
+            conn.execute("SELECT COUNT(*) FROM servers WHERE is_active = 1").fetchone()[0],
+            conn.execute("SELECT COUNT(*) FROM servers").fetchone()[0],
+        )
+
+    total_users, active_subs, total_profiles, active_servers, total_servers = await db.run(collect_stats)
+    depth = await provisioning_worker.depth()
 
     text = (
         f"📊 **Статистика бота:**\n\n"
         f"👥 Всего пользователей: {total_users}\n"
         f"✅ Активных подписок: {active_subs}\n"
         f"🔑 Всего создано ключей: {total_profiles}\n"
-        f"🖥 Активных серверов: {active_servers} из {total_servers}"
+        f"🖥 Активных серверов: {active_servers} из {total_servers}\n\n"
+        f"📦 Очередь выдачи ({provisioning_worker.workers} обработчиков): ожидают {depth['pending']}, "
+        f"выполняются {depth['running']}, с ошибкой {depth['failed']}\n"
+        f"⏱ Этапы выдачи:\n{provisioning_stats.describe()}\n\n"
+        f"🗝 Пул ключей: {await key_pool.describe(db)}\n\n"
+        f"📤 Исходящие сообщения: {outbound.describe()}\n\n"
+        f"🔳 QR-коды: {qr_cache.describe()}\n\n"
+        f"👤 Кэш пользователей: {user_cache.describe()}"
     )
     await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="admin_panel")]]), parse_mode="Markdown")
     return STATE_ADMIN_PANEL
@@ -1175,7 +1048,7 @@ async def grant_sub_get_id(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 
 async def grant_sub_get_tariff_and_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    tariff_key = query.data.split("grant_")[1]
+    tariff_key = context.callback_params['tariff_key']
     user_id = context.user_data['grant_user_id']
     await query.edit_message_text(f"Создаю профиль VLESS по тарифу '{PRICES[tariff_key]['name']}' для {user_id}...")
 
@@ -1186,21 +1059,39 @@ async def grant_sub_get_tariff_and_confirm(update: Update, context: ContextTypes
     except Exception:
         pass
 
-    config_link = await create_and_assign_vpn_profile_from_panel(user_id, username, tariff_key, context)
+    await db.transaction(
+        enqueue, f"grant:{query.id}", user_id, tariff_key, None, "grant",
+        {"username": username, "admin_id": query.from_user.id}
+    )
+    provisioning_worker.notify()
+    await query.edit_message_text(f"⏳ Выдача по тарифу '{PRICES[tariff_key]['name']}' для {username} ({user_id}) поставлена в очередь. Результат придет отдельным сообщением.")
 
-    if config_link:
-        await query.edit_message_text(f"✅ Профиль по тарифу '{PRICES[tariff_key]['name']}' выдан пользователю {username} ({user_id}).")
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=f"🎉 Администратор продлил/выдал вам подписку!\n\nВаш ключ для подключения:\n`{config_link}`",
-                parse_mode="Markdown"
-            )
-        except Exception as e:
-            await query.message.reply_text(f"⚠️ Не удалось уведомить пользователя: {e}")
-    else:
-        await query.edit_message_text(f"❌ Ошибка! Не удалось создать профиль через API панели. Проверьте логи или добавьте сервер.")
+    return await _return_to_admin_panel_after_action(update, context)
 
+async def admin_delivery(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    await delivery_tracker.flush()
+    counts = await delivery_tracker.counts()
+    lines = [f"• {STATUS_NAMES.get(status, status)}: {count}" for status, count in counts.items()]
+    text = (
+        "📵 **Недоступные пользователи**\n\n"
+        + ("\n".join(lines) if lines else "Таких нет.")
+        + "\n\nРассылки и напоминания их пропускают. Статус снимается, когда пользователь снова нажимает /start."
+    )
+    keyboard = []
+    if counts:
+        keyboard.append([InlineKeyboardButton("🔄 Сбросить всем", callback_data="admin_delivery_reset_all")])
+    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="admin_panel")])
+    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+    return STATE_ADMIN_PANEL
+
+async def admin_delivery_reset_all(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    reset = await delivery_tracker.reset()
+    logger.info(f"Админ {query.from_user.id} сбросил статус доставки {reset} пользователям")
+    await query.edit_message_text(f"✅ Статус доставки сброшен {reset} пользователям.")
     return await _return_to_admin_panel_after_action(update, context)
 
 async def broadcast_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -1208,23 +1099,31 @@ async def broadcast_start(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     return STATE_ADMIN_BROADCAST_MESSAGE
 
 async def broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    await update.message.reply_text("Начинаю рассылку...")
-    with sqlite3.connect("vpn_platform.db") as conn:
-        users = conn.cursor().execute("SELECT user_id FROM users").fetchall()
-
-    success, fail = 0, 0
-    for user_id, in users:
-        try:
-            await context.bot.send_message(chat_id=user_id, text=update.message.text, parse_mode="Markdown")
-            success += 1
-            await asyncio.sleep(0.1)
-        except Exception as e:
-            fail += 1
-            logger.warning(f"Рассылка: не удалось отправить {user_id}: {e}")
-
-    await update.message.reply_text(f"✅ Рассылка завершена!\n\nОтправлено: {success}\nНе удалось: {fail}")
+    text = update.message.text
+    # Предпросмотр заодно проверяет разметку: с ошибкой Markdown не дошло бы ни одно сообщение
+    try:
+        await update.message.reply_text(text, parse_mode="Markdown")
+    except BadRequest as e:
+        await update.message.reply_text(f"❌ Ошибка разметки: {e}\nИсправьте сообщение и отправьте снова. /cancel для отмены.")
+        return STATE_ADMIN_BROADCAST_MESSAGE
+
+    progress = await update.message.reply_text("⏳ Рассылка поставлена в очередь...")
+    broadcast_id = await broadcaster.create(text, "Markdown", update.effective_user.id, progress.chat_id, progress.message_id)
+    logger.info(f"Админ {update.effective_user.id} запустил рассылку #{broadcast_id}")
+    await update.message.reply_text(f"📢 Рассылка #{broadcast_id} идет в фоне, прогресс обновляется в сообщении выше.")
     return await _return_to_admin_panel_after_action(update, context)
 
+async def broadcast_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if query.from_user.id not in ADMIN_IDS:
+        await query.answer()
+        return
+    broadcast_id = context.callback_params['broadcast_id']
+    if await broadcaster.cancel(broadcast_id):
+        await query.answer("Рассылка остановится после текущей пачки")
+    else:
+        await query.answer("Рассылка уже завершена")
+
 async def revoke_sub_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await update.callback_query.edit_message_text("Введите ID пользователя для отзыва подписки. /cancel для отмены.")
     return STATE_ADMIN_REVOKE_ID
@@ -1236,8 +1135,7 @@ async def revoke_sub_get_id(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text("Неверный ID. Попробуйте еще раз.")
         return STATE_ADMIN_REVOKE_ID
 
-    with sqlite3.connect("vpn_platform.db") as conn:
-        user_data = conn.cursor().execute("SELECT username, expires_at FROM users WHERE user_id = ?", (user_id,)).fetchone()
+    user_data = await db.fetchone("SELECT telegram_username, expires_at FROM users WHERE telegram_id = ?", (user_id,))
 
     if user_data and user_data[1] and datetime.strptime(user_data[1], '%Y-%m-%d %H:%M:%S') > datetime.now():
         username, expires_at = user_data
@@ -1264,28 +1162,20 @@ async def revoke_sub_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     await query.edit_message_text(f"Отзываю подписку для {user_id} и удаляю ключи с серверов...")
     
-    deleted_count = 0
-    with sqlite3.connect("vpn_platform.db") as conn:
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-        
-        profiles_to_delete = c.execute(
-            "SELECT p.client_uuid, p.inbound_id, s.panel_url, s.panel_username, s.panel_password "
-            "FROM vpn_profiles p JOIN servers s ON p.server_id = s.id "
-            "WHERE p.assigned_to_user_id = ?", (user_id,)
-        ).fetchall()
-        
-        for profile in profiles_to_delete:
-            api = XUI_API(profile['panel_url'], profile['panel_username'], profile['panel_password'])
-            if await api.delete_client(profile['inbound_id'], profile['client_uuid']):
-                deleted_count += 1
-            await api.close()
-        
-        c.execute("UPDATE users SET expires_at = NULL, subscription_type = NULL WHERE user_id = ?", (user_id,))
-        c.execute("DELETE FROM vpn_profiles WHERE assigned_to_user_id = ?", (user_id,))
-        conn.commit()
-
-    await query.edit_message_text(f"✅ Подписка для {user_id} отозвана. Удалено ключей с панелей: {deleted_count}.")
+    report = await revoke_users(db, xui_clients, [user_id], skip_servers=health_monitor.unavailable())
+    allocator.invalidate()
+    user_cache.invalidate(user_id)
+    for link in report.links:
+        await qr_cache.evict(link)
+    deleted_count = report.deleted
+
+    if report.partial_users:
+        await query.edit_message_text(
+            f"⚠️ Подписка для {user_id} отозвана частично: удалено ключей с панелей {deleted_count}, "
+            f"не удалено {report.failed}. Оставшиеся ключи бот попробует удалить повторно."
+        )
+    else:
+        await query.edit_message_text(f"✅ Подписка для {user_id} отозвана. Удалено ключей с панелей: {deleted_count}.")
     try:
         await context.bot.send_message(chat_id=user_id, text="Администратор отозвал вашу подписку.")
     except Exception as e:
@@ -1293,6 +1183,36 @@ async def revoke_sub_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     return await _return_to_admin_panel_after_action(update, context)
 
+async def bulk_revoke_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    await update.callback_query.answer()
+    await update.callback_query.edit_message_text(
+        "Отправьте список ID пользователей (через пробел, запятую или с новой строки) "
+        "или файл .txt/.csv со списком. /cancel для отмены."
+    )
+    return STATE_ADMIN_BULK_REVOKE_INPUT
+
+async def bulk_revoke_process(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    if update.message.document:
+        file = await update.message.document.get_file()
+        text = (await file.download_as_bytearray()).decode("utf-8", errors="ignore")
+    else:
+        text = update.message.text
+    user_ids = parse_user_ids(text)
+    if not user_ids:
+        await update.message.reply_text("Не найдено ни одного ID. Попробуйте еще раз.")
+        return STATE_ADMIN_BULK_REVOKE_INPUT
+
+    await update.message.reply_text(f"Отзываю подписки у {len(user_ids)} пользователей...")
+    report = await revoke_users(db, xui_clients, user_ids, skip_servers=health_monitor.unavailable())
+    allocator.invalidate()
+    for user_id in user_ids:
+        user_cache.invalidate(user_id)
+    for link in report.links:
+        await qr_cache.evict(link)
+    status = "⚠️ Массовый отзыв завершен частично." if report.partial_users else "✅ Массовый отзыв завершен."
+    await update.message.reply_text(f"{status}\n\n{report}")
+    return await _return_to_admin_panel_after_action(update, context)
+
 async def admin_find_user_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await update.callback_query.answer()
     await update.callback_query.edit_message_text("Введите юзернейм (например, @username) или ID пользователя для поиска.")
@@ -1301,26 +1221,23 @@ async def admin_find_user_start(update: Update, context: ContextTypes.DEFAULT_TY
 async def admin_find_user_process(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     search_query = update.message.text.strip()
 
-    with sqlite3.connect("vpn_platform.db") as conn:
-        cursor = conn.cursor()
-        if search_query.startswith('@'):
-            user_data_tuple = cursor.execute("SELECT user_id, username, subscription_type, expires_at, referrer_id, referral_balance, main_balance FROM users WHERE username = ?", (search_query[1:],)).fetchone()
-        elif search_query.isdigit():
-            user_data_tuple = cursor.execute("SELECT user_id, username, subscription_type, expires_at, referrer_id, referral_balance, main_balance FROM users WHERE user_id = ?", (int(search_query),)).fetchone()
-        else:
-            await update.message.reply_text("Неверный формат. Введите юзернейм (с @) или числовой ID.")
-            return STATE_ADMIN_FIND_USER_INPUT
+    if search_query.startswith('@'):
+        user_data_tuple = await db.fetchone(FIND_USER_BY_USERNAME_SQL, (search_query[1:],))
+    elif search_query.isdigit():
+        user_data_tuple = await db.fetchone("SELECT telegram_id, telegram_username, subscription_type, expires_at, referrer_id, referral_balance, main_balance, delivery_status, delivery_failed_at FROM users WHERE telegram_id = ?", (int(search_query),))
+    else:
+        await update.message.reply_text("Неверный формат. Введите юзернейм (с @) или числовой ID.")
+        return STATE_ADMIN_FIND_USER_INPUT
 
     if not user_data_tuple:
         await update.message.reply_text("Пользователь не найден в базе данных.")
         return await _return_to_admin_panel_after_action(update, context)
 
-    (user_id, username, sub_type, expires_at, _, ref_balance, main_balance) = user_data_tuple
+    (user_id, username, sub_type, expires_at, _, ref_balance, main_balance, delivery_status, delivery_failed_at) = user_data_tuple
     context.user_data['found_user_id'] = user_id
     context.user_data['found_user_username'] = username
 
-    with sqlite3.connect("vpn_platform.db") as conn:
-        ref_count = conn.cursor().execute("SELECT COUNT(*) FROM referrals WHERE referrer_id = ?", (user_id,)).fetchone()[0]
+    ref_count = await db.fetchval(REFERRAL_COUNT_SQL, (user_id,))
 
     expires_text = "Нет"
     if expires_at:
@@ -1344,9 +1261,19 @@ async def admin_find_user_process(update: Update, context: ContextTypes.DEFAULT_
         [InlineKeyboardButton("✉️ Отправить сообщение", callback_data="admin_send_message")],
         [InlineKeyboardButton("⬅️ В админ-панель", callback_data="admin_panel")]
     ]
+    if delivery_status:
+        text += f"\n\n📵 **Недоступен:** {STATUS_NAMES.get(delivery_status, delivery_status)} ({delivery_failed_at})"
+        keyboard.insert(1, [InlineKeyboardButton("🔄 Сбросить статус доставки", callback_data="admin_delivery_reset_user")])
     await update.message.reply_text(text, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(keyboard))
     return STATE_ADMIN_USER_PROFILE
 
+async def admin_delivery_reset_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    await delivery_tracker.reset(context.user_data.get('found_user_id'))
+    await query.edit_message_text(f"✅ Пользователь {context.user_data.get('found_user_id')} снова получает рассылки и напоминания.")
+    return await _return_to_admin_panel_after_action(update, context)
+
 async def admin_send_message_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     username = context.user_data.get('found_user_username', 'пользователю')
@@ -1396,18 +1323,16 @@ async def admin_credit_balance_process(update: Update, context: ContextTypes.DEF
         await update.message.reply_text("Неверная сумма. Введите число, например, 150.")
         return STATE_ADMIN_CREDIT_BALANCE_AMOUNT
 
-    with sqlite3.connect("vpn_platform.db") as conn:
-        cursor = conn.cursor()
-        cursor.execute("UPDATE users SET main_balance = main_balance + ? WHERE user_id = ?", (amount, user_id))
-        if cursor.rowcount == 0:
-            await update.message.reply_text(f"⚠️ Пользователь с ID {user_id} не найден. Баланс не начислен.")
-        else:
-            conn.commit()
-            await update.message.reply_text(f"✅ Баланс пользователя {user_id} успешно пополнен на {amount:.2f} ₽.")
-            try:
-                await context.bot.send_message(user_id, f"🎉 Администратор пополнил ваш основной баланс на *{amount:.2f} ₽*!", parse_mode="Markdown")
-            except Exception:
-                await update.message.reply_text("⚠️ Не удалось уведомить пользователя.")
+    updated = await db.execute("UPDATE users SET main_balance = main_balance + ? WHERE telegram_id = ?", (amount, user_id))
+    user_cache.invalidate(user_id)
+    if updated == 0:
+        await update.message.reply_text(f"⚠️ Пользователь с ID {user_id} не найден. Баланс не начислен.")
+    else:
+        await update.message.reply_text(f"✅ Баланс пользователя {user_id} успешно пополнен на {amount:.2f} ₽.")
+        try:
+            await context.bot.send_message(user_id, f"🎉 Администратор пополнил ваш основной баланс на *{amount:.2f} ₽*!", parse_mode="Markdown")
+        except Exception:
+            await update.message.reply_text("⚠️ Не удалось уведомить пользователя.")
 
     return await _return_to_admin_panel_after_action(update, context)
 
@@ -1418,21 +1343,24 @@ async def admin_find_by_key_start(update: Update, context: ContextTypes.DEFAULT_
 
 async def admin_find_by_key_process(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     config_link = update.message.text.strip()
-    with sqlite3.connect("vpn_platform.db") as conn:
-        conn.row_factory = sqlite3.Row
-        profile_data = conn.cursor().execute(
-            "SELECT p.*, s.name as server_name "
-            "FROM vpn_profiles p JOIN servers s ON p.server_id = s.id "
-            "WHERE p.config_link = ?", (config_link,)
-        ).fetchone()
+    profile_data = await db.fetchone(
+        FIND_PROFILE_BY_KEY_SQL, (config_link,)
+    )
 
     if not profile_data:
-        await update.message.reply_text("Этот ключ не найден в базе данных бота.")
+        panel_client = panel_inventory.by_config_link(config_link)
+        if panel_client is None:
+            await update.message.reply_text("Этот ключ не найден в базе данных бота.")
+        else:
+            await update.message.reply_text(
+                f"Ключа нет в базе бота, но он есть на панели сервера ID {panel_client.server_id}:\n"
+                f"email: {panel_client.email}, tgId: {panel_client.tg_id or 'не указан'}, "
+                f"inbound: {panel_client.inbound_id}, трафик: {panel_client.used_bytes / 1024 ** 3:.2f} ГБ"
+            )
         return await _return_to_admin_panel_after_action(update, context)
 
-    user_id = profile_data['assigned_to_user_id']
-    with sqlite3.connect("vpn_platform.db") as conn:
-        user_data = conn.cursor().execute("SELECT username, expires_at, subscription_type FROM users WHERE user_id = ?", (user_id,)).fetchone()
+    user_id = profile_data['telegram_id']
+    user_data = await db.fetchone("SELECT telegram_username, expires_at, subscription_type FROM users WHERE telegram_id = ?", (user_id,))
 
     if user_data:
         username, expires_at, sub_type = user_data
@@ -1453,8 +1381,7 @@ async def admin_find_by_key_process(update: Update, context: ContextTypes.DEFAUL
 
 async def admin_edit_text_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await update.callback_query.answer()
-    with sqlite3.connect("vpn_platform.db") as conn:
-        texts = conn.cursor().execute("SELECT key FROM bot_texts ORDER BY key").fetchall()
+    texts = await db.fetchall("SELECT key FROM bot_texts ORDER BY key")
 
     keyboard = [[InlineKeyboardButton(key, callback_data=f"edittext_{key}")] for key, in texts if not key.startswith("last_used")]
     keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="admin_panel")])
@@ -1463,7 +1390,7 @@ async def admin_edit_text_list(update: Update, context: ContextTypes.DEFAULT_TYP
 
 async def admin_edit_text_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    text_key = query.data.split("edittext_")[1]
+    text_key = context.callback_params['text_key']
     context.user_data['text_key_to_edit'] = text_key
     current_text = await get_text(text_key, context)
     await query.answer()
@@ -1498,14 +1425,15 @@ async def admin_servers_menu(update: Update, context: ContextTypes.DEFAULT_TYPE)
     query = update.callback_query
     await query.answer()
 
-    with sqlite3.connect("vpn_platform.db") as conn:
-        conn.row_factory = sqlite3.Row
-        servers = conn.cursor().execute("SELECT id, name, is_active FROM servers ORDER BY name").fetchall()
+    servers = await db.fetchall("SELECT id, name, is_active FROM servers ORDER BY name")
+    unavailable = health_monitor.unavailable()
     
-    text = "🔧 **Управление серверами**\n\nЗдесь вы можете добавлять и настраивать панели 3X-UI, на которых бот будет создавать ключи."
+    text = "🔧 **Управление серверами**\n\nЗдесь вы можете добавлять и настраивать панели 3X-UI, на которых бот будет создавать ключи.\n🟠 - панель не отвечает на проверки и временно исключена из выдачи."
     keyboard = []
     for server in servers:
         status_icon = "🟢" if server['is_active'] else "🔴"
+        if server['is_active'] and server['id'] in unavailable:
+            status_icon = "🟠"
         keyboard.append([
             InlineKeyboardButton(f"{status_icon} {server['name']}", callback_data=f"server_view_{server['id']}")
         ])
@@ -1518,18 +1446,19 @@ async def admin_servers_menu(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def admin_view_server(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    server_id = int(query.data.split('_')[-1])
+    server_id = context.callback_params['server_id']
     context.user_data['server_id'] = server_id
 
-    with sqlite3.connect("vpn_platform.db") as conn:
-        conn.row_factory = sqlite3.Row
-        server = conn.cursor().execute("SELECT * FROM servers WHERE id = ?", (server_id,)).fetchone()
+    server = await db.fetchone("SELECT * FROM servers WHERE id = ?", (server_id,))
 
     if not server:
         await query.answer("Сервер не найден", show_alert=True)
         return await admin_servers_menu(update, context)
 
     status_text = "🟢 Активен (на нем создаются ключи)" if server['is_active'] else "🔴 Отключен (новые ключи не создаются)"
+    clients = allocator.clients(server_id)
+    if clients is None:
+        clients = await db.fetchval("SELECT COUNT(*) FROM vpn_profiles WHERE server_id = ?", (server_id,), default=0)
     text = (
         f"**Просмотр сервера: `{server['name']}`**\n\n"
         f"**Статус:** {status_text}\n"
@@ -1537,7 +1466,9 @@ async def admin_view_server(update: Update, context: ContextTypes.DEFAULT_TYPE)
         f"**Внешний адрес:** `{server['vless_address']}:{server['vless_port']}`\n"
         f"**Inbound ID:** `{server['vless_inbound_id']}`\n"
         f"**SNI:** `{server['vless_sni']}`\n"
-        f"**Flow:** `{server['vless_flow']}`"
+        f"**Flow:** `{server['vless_flow']}`\n"
+        f"**Клиентов:** {clients} (вес емкости: {server['capacity_weight']})\n"
+        f"**Проверки панели:** {health_monitor.describe(server_id)}"
     )
     
     toggle_text = "🔴 Отключить" if server['is_active'] else "🟢 Включить"
@@ -1552,23 +1483,18 @@ async def admin_view_server(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def admin_toggle_server_status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    server_id = int(query.data.split('_')[-1])
-    with sqlite3.connect("vpn_platform.db") as conn:
-        c = conn.cursor()
-        current_status = c.execute("SELECT is_active FROM servers WHERE id = ?", (server_id,)).fetchone()[0]
-        c.execute("UPDATE servers SET is_active = ? WHERE id = ?", (not current_status, server_id))
-        conn.commit()
+    server_id = context.callback_params['server_id']
+    await db.execute("UPDATE servers SET is_active = NOT is_active WHERE id = ?", (server_id,))
+    allocator.invalidate()
     await query.answer("Статус изменен!")
     return await admin_view_server(update, context)
 
 async def admin_delete_server(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    server_id = int(query.data.split('_')[-1])
-    with sqlite3.connect("vpn_platform.db") as conn:
-        conn.cursor().execute("DELETE FROM servers WHERE id = ?", (server_id,))
-        conn.commit()
+    server_id = context.callback_params['server_id']
+    await db.execute("DELETE FROM servers WHERE id = ?", (server_id,))
+    allocator.invalidate()
     await query.answer("Сервер удален!", show_alert=True)
-    query.data = "admin_servers_menu"
     return await admin_servers_menu(update, context)
 
 # --- ConversationHandler для добавления сервера ---
@@ -1617,15 +1543,14 @@ async def server_add_finish(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['server_data']['sid'] = update.message.text
     data = context.user_data['server_data']
     try:
-        with sqlite3.connect("vpn_platform.db") as conn:
-            conn.cursor().execute(
-                """INSERT INTO servers (name, panel_url, panel_username, panel_password, vless_address, 
-                vless_port, vless_inbound_id, vless_sni, vless_flow, vless_public_key, vless_short_id) 
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                (data['name'], data['url'], data['user'], data['pass'], data['address'],
-                int(data['port']), int(data['inbound_id']), data['sni'], data['flow'], data['pbk'], data['sid'])
-            )
-            conn.commit()
+        await db.execute(
+            """INSERT INTO servers (name, panel_url, panel_username, panel_password, vless_address, 
+            vless_port, vless_inbound_id, vless_sni, vless_flow, vless_public_key, vless_short_id) 
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (data['name'], data['url'], data['user'], data['pass'], data['address'],
+            int(data['port']), int(data['inbound_id']), data['sni'], data['flow'], data['pbk'], data['sid'])
+        )
+        allocator.invalidate()
         await update.message.reply_text(f"✅ Сервер '{data['name']}' успешно добавлен!")
     except Exception as e:
         await update.message.reply_text(f"❌ Произошла ошибка при добавлении сервера: {e}")
@@ -1655,16 +1580,15 @@ async def _create_support_ticket(update: Update, context: ContextTypes.DEFAULT_T
     query = update.callback_query
     user = query.from_user
     await query.answer()
-    with sqlite3.connect("vpn_platform.db") as conn:
-        ticket = conn.cursor().execute("SELECT thread_id FROM support_tickets WHERE user_id = ?", (user.id,)).fetchone()
-        if ticket:
-            try:
-                await query.edit_message_text(
-                    "Вы уже находитесь в чате с поддержкой. Просто продолжайте писать сюда.\n\n"
-                    "Чтобы завершить чат, введите /close_chat"
-                )
-            except TelegramError: pass
-            return STATE_SUPPORT_CHAT
+    ticket = await db.fetchone("SELECT thread_id FROM support_threads WHERE user_id = ?", (user.id,))
+    if ticket:
+        try:
+            await query.edit_message_text(
+                "Вы уже находитесь в чате с поддержкой. Просто продолжайте писать сюда.\n\n"
+                "Чтобы завершить чат, введите /close_chat"
+            )
+        except TelegramError: pass
+        return STATE_SUPPORT_CHAT
     try:
         await query.edit_message_text("⏳ Создаем чат с поддержкой, пожалуйста, подождите...")
     except TelegramError: pass
@@ -1677,9 +1601,7 @@ async def _create_support_ticket(update: Update, context: ContextTypes.DEFAULT_T
         await query.edit_message_text("❌ Не удалось создать чат. Проблема на стороне группы поддержки. Администраторы уведомлены.")
         return STATE_MAIN_MENU
     try:
-        with sqlite3.connect("vpn_platform.db") as conn:
-            conn.cursor().execute("INSERT OR REPLACE INTO support_tickets (user_id, thread_id) VALUES (?, ?)", (user.id, thread_id))
-            conn.commit()
+        await db.execute("INSERT OR REPLACE INTO support_threads (user_id, thread_id) VALUES (?, ?)", (user.id, thread_id))
 
         await context.bot.send_message(chat_id=GROUP_ID, message_thread_id=thread_id, text=initial_message_for_admin, parse_mode="MarkdownV2")
         final_message_for_user = (
@@ -1744,11 +1666,7 @@ async def support_start_rub_deposit(update: Update, context: ContextTypes.DEFAUL
 
 async def forward_to_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    thread_id = None
-    with sqlite3.connect("vpn_platform.db") as conn:
-        ticket_row = conn.cursor().execute("SELECT thread_id FROM support_tickets WHERE user_id = ?", (user_id,)).fetchone()
-        if ticket_row:
-            thread_id = ticket_row[0]
+    thread_id = await db.fetchval("SELECT thread_id FROM support_threads WHERE user_id = ?", (user_id,))
     if thread_id:
         try:
             await update.message.copy(chat_id=GROUP_ID, message_thread_id=thread_id)
@@ -1763,8 +1681,7 @@ async def forward_to_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     thread_id = update.message.message_thread_id
     if update.message.text and update.message.text.startswith('/'): return
-    with sqlite3.connect("vpn_platform.db") as conn:
-        ticket = conn.cursor().execute("SELECT user_id FROM support_tickets WHERE thread_id = ?", (thread_id,)).fetchone()
+    ticket = await db.fetchone(TICKET_USER_SQL, (thread_id,))
     if ticket:
         user_id = ticket[0]
         try:
@@ -1775,41 +1692,45 @@ async def forward_to_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def close_chat_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = update.effective_user.id
-    with sqlite3.connect("vpn_platform.db") as conn:
-        c = conn.cursor()
-        ticket = c.execute("SELECT thread_id FROM support_tickets WHERE user_id = ?", (user_id,)).fetchone()
+    def close_ticket(conn):
+        ticket = conn.execute("SELECT thread_id FROM support_threads WHERE user_id = ?", (user_id,)).fetchone()
         if ticket:
-            thread_id = ticket[0]
-            c.execute("DELETE FROM support_tickets WHERE user_id = ?", (user_id,))
-            conn.commit()
-            try:
-                await context.bot.send_message(chat_id=GROUP_ID, message_thread_id=thread_id, text="🔒 Пользователь завершил чат.")
-            except TelegramError as e:
-                logger.warning(f"Не удалось отправить сообщение о закрытии чата в группу {GROUP_ID}: {e}")
-            await update.message.reply_text("Чат с поддержкой закрыт. Вы можете начать новый в любой момент из главного меню.")
-        else:
-            await update.message.reply_text("У вас нет активного чата с поддержкой.")
+            conn.execute("DELETE FROM support_threads WHERE user_id = ?", (user_id,))
+        return ticket
+
+    ticket = await db.transaction(close_ticket)
+    if ticket:
+        thread_id = ticket[0]
+        try:
+            await context.bot.send_message(chat_id=GROUP_ID, message_thread_id=thread_id, text="🔒 Пользователь завершил чат.")
+        except TelegramError as e:
+            logger.warning(f"Не удалось отправить сообщение о закрытии чата в группу {GROUP_ID}: {e}")
+        await update.message.reply_text("Чат с поддержкой закрыт. Вы можете начать новый в любой момент из главного меню.")
+    else:
+        await update.message.reply_text("У вас нет активного чата с поддержкой.")
     return await start(update, context)
 
 async def close_chat_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not (update.message and update.message.chat.id == GROUP_ID and update.message.is_topic_message):
         return
     thread_id = update.message.message_thread_id
-    with sqlite3.connect("vpn_platform.db") as conn:
-        c = conn.cursor()
-        ticket = c.execute("SELECT user_id FROM support_tickets WHERE thread_id = ?", (thread_id,)).fetchone()
+    def close_ticket(conn):
+        ticket = conn.execute(TICKET_USER_SQL, (thread_id,)).fetchone()
         if ticket:
-            user_id = ticket[0]
-            admin_name = update.effective_user.first_name
-            c.execute("DELETE FROM support_tickets WHERE thread_id = ?", (thread_id,))
-            conn.commit()
-            await context.bot.send_message(chat_id=GROUP_ID, message_thread_id=thread_id, text=f"🔒 Чат закрыт администратором ({admin_name}).")
-            try:
-                await context.bot.send_message(chat_id=user_id, text="Администратор закрыл ваш чат с поддержкой.")
-            except Exception as e:
-                logger.warning(f"Не удалось уведомить пользователя {user_id} о закрытии чата: {e}")
-        else:
-            await update.message.reply_text("Этот тикет уже закрыт или не существует в базе данных.", quote=True)
+            conn.execute("DELETE FROM support_threads WHERE thread_id = ?", (thread_id,))
+        return ticket
+
+    ticket = await db.transaction(close_ticket)
+    if ticket:
+        user_id = ticket[0]
+        admin_name = update.effective_user.first_name
+        await context.bot.send_message(chat_id=GROUP_ID, message_thread_id=thread_id, text=f"🔒 Чат закрыт администратором ({admin_name}).")
+        try:
+            await context.bot.send_message(chat_id=user_id, text="Администратор закрыл ваш чат с поддержкой.")
+        except Exception as e:
+            logger.warning(f"Не удалось уведомить пользователя {user_id} о закрытии чата: {e}")
+    else:
+        await update.message.reply_text("Этот тикет уже закрыт или не существует в базе данных.", quote=True)
 
 # =======================================
 
@@ -1817,68 +1738,134 @@ async def close_chat_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ===      УВЕДОМЛЕНИЯ ОБ ОКОНЧАНИИ   ===
 # =======================================
 async def subscription_reminder_job(context: ContextTypes.DEFAULT_TYPE):
-    logger.info("Запущена задача проверки истекающих подписок.")
-    now = datetime.now()
-    three_days_later = (now + timedelta(days=3)).strftime('%Y-%m-%d %H:%M:%S')
-    one_day_later = (now + timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S')
-
-    with sqlite3.connect("vpn_platform.db") as conn:
-        cursor = conn.cursor()
-        # Находим тех, у кого подписка истекает через 2-3 дня
-        expiring_in_3_days = cursor.execute(
-            "SELECT user_id, expires_at FROM users WHERE expires_at BETWEEN ? AND ?",
-            (now.strftime('%Y-%m-%d %H:%M:%S'), three_days_later)
-        ).fetchall()
-        
-        # Находим тех, у кого подписка истекает в течение 24 часов
-        expiring_in_1_day = cursor.execute(
-            "SELECT user_id, expires_at FROM users WHERE expires_at BETWEEN ? AND ?",
-            (now.strftime('%Y-%m-%d %H:%M:%S'), one_day_later)
-        ).fetchall()
+    """Напоминает об окончании подписки за 3 дня и за сутки, каждое напоминание - один раз."""
+    await send_expiry_reminders(db, context.bot)
 
-    users_reminded = set()
 
-    for user_id, expires_at_str in expiring_in_1_day:
-        if user_id in users_reminded: continue
-        try:
-            expires_dt = datetime.strptime(expires_at_str, '%Y-%m-%d %H:%M:%S')
-            message = f"❗️ Ваша подписка на VPN истекает менее чем через 24 часа ({expires_dt.strftime('%d.%m.%Y в %H:%M')}).\n\nНе забудьте продлить ее, чтобы не потерять доступ!"
-            await context.bot.send_message(chat_id=user_id, text=message)
-            users_reminded.add(user_id)
-            await asyncio.sleep(0.2)
-        except Exception as e:
-            logger.warning(f"Не удалось отправить уведомление за 1 день пользователю {user_id}: {e}")
+async def exchange_rates_job(context: ContextTypes.DEFAULT_TYPE):
+    """Обновляет кеш курсов CryptoBot, чтобы счета не ждали getExchangeRates."""
+    await cryptobot.refresh_rates()
+
+
+async def allocator_sync_job(context: ContextTypes.DEFAULT_TYPE):
+    """Пересчитывает клиентов на серверах по vpn_profiles."""
+    await allocator.refresh(db)
+
+
+async def server_health_job(context: ContextTypes.DEFAULT_TYPE):
+    """Проверяет доступность всех панелей 3X-UI."""
+    await health_monitor.probe_all(db, xui_clients)
+
+
+async def delivery_flush_job(context: ContextTypes.DEFAULT_TYPE):
+    """Записывает накопленные отметки о недоступных пользователях."""
+    await delivery_tracker.flush()
+
+
+async def panel_inventory_job(context: ContextTypes.DEFAULT_TYPE):
+    """Обновляет локальный индекс клиентов на самых давно проверенных панелях."""
+    await panel_inventory.refresh_due(db, xui_clients, skip_servers=health_monitor.unavailable())
+
+
+async def key_pool_job(context: ContextTypes.DEFAULT_TYPE):
+    """Дополняет пулы заранее созданных ключей на доступных серверах."""
+    await key_pool.refill(db, skip_servers=health_monitor.unavailable())
+
 
-    for user_id, expires_at_str in expiring_in_3_days:
-        if user_id in users_reminded: continue
+async def keyboard_cache_job(context: ContextTypes.DEFAULT_TYPE):
+    """Сбрасывает кэши текстов и клавиатур после правок bot_texts и tariffs в веб-панели."""
+    if await keyboard_cache.check():
+        context.bot_data.pop('texts', None)
+
+
+async def pending_revoke_job(context: ContextTypes.DEFAULT_TYPE):
+    """Повторяет удаление с панелей ключей, отзыв которых не завершился."""
+    report = await retry_pending_revocations(db, xui_clients, skip_servers=health_monitor.unavailable())
+    if report.deleted:
+        allocator.invalidate()
+
+
+async def reconcile_job(context: ContextTypes.DEFAULT_TYPE):
+    """Сверяет vpn_profiles с панелями и присылает админам отчет о расхождениях.
+
+    Ничего не исправляет: для этого есть python -m vpnbot.reconcile --fix-orphans --fix-ghosts.
+    Заодно чистит дисковый кэш QR-кодов.
+    """
+    await qr_cache.prune()
+    reports = await reconcile_all(db, xui_clients, skip_servers=health_monitor.unavailable())
+    problems = [report for report in reports if report.error or report.has_drift]
+    if not problems:
+        return
+    text = "🔍 Расхождения базы и панелей:\n\n" + "\n".join(str(report) for report in problems)
+    for admin_id in ADMIN_IDS:
         try:
-            expires_dt = datetime.strptime(expires_at_str, '%Y-%m-%d %H:%M:%S')
-            message = f"🔔 Напоминаем, что ваша подписка на VPN истекает через 3 дня ({expires_dt.strftime('%d.%m.%Y в %H:%M')}).\n\nВы можете продлить ее в главном меню бота."
-            await context.bot.send_message(chat_id=user_id, text=message)
-            users_reminded.add(user_id)
-            await asyncio.sleep(0.2)
+            await context.bot.send_message(admin_id, text, rate_limit_args=TRANSACTIONAL)
         except Exception as e:
-            logger.warning(f"Не удалось отправить уведомление за 3 дня пользователю {user_id}: {e}")
-    
-    logger.info(f"Проверка подписок завершена. Отправлено {len(users_reminded)} напоминаний.")
+            logger.warning(f"Не удалось отправить отчет сверки админу {admin_id}: {e}")
 
 
 # ===      ГЛАВНАЯ ФУНКЦИЯ main       ===
 # =======================================
+async def startup(application):
+    global crypto_webhook, bot_application
+    bot_application = application
+    provisioning_worker.start()
+    broadcaster.start(application.bot)
+    if CRYPTO_WEBHOOK_PORT:
+        crypto_webhook = CryptoPayWebhook(CRYPTO_BOT_TOKEN, crypto_webhook_invoice_paid, CRYPTO_WEBHOOK_PATH)
+        await crypto_webhook.start(CRYPTO_WEBHOOK_HOST, CRYPTO_WEBHOOK_PORT)
+
+
+async def stop_background(application):
+    """Останавливает фоновые отправки, пока бот еще может отправлять сообщения."""
+    if crypto_webhook is not None:
+        await crypto_webhook.stop()
+    await provisioning_worker.stop()
+    await broadcaster.stop()
+    await delivery_tracker.flush()
+
+
+async def shutdown(application):
+    await xui_clients.close()
+    await cryptobot.close()
+    qr_cache.close()
+    db.close()
+
+
 def main():
     if not all([BOT_TOKEN, ADMIN_IDS, GROUP_ID, CRYPTO_BOT_TOKEN]):
         logger.critical("Одна или несколько ОБЯЗАТЕЛЬНЫХ переменных окружения не установлены. Проверьте .env файл.")
         return
 
-    init_db()
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
+    migrate(DB_PATH)
+    application = (
+        ApplicationBuilder().token(BOT_TOKEN)
+        .rate_limiter(outbound)
+        # Пользователи обрабатываются параллельно, а обновления одного - по порядку
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+        .post_init(startup).post_stop(stop_background).post_shutdown(shutdown)
+        .build()
+    )
 
-    # Добавляем фоновую задачу для отправки уведомлений (запускается раз в 6 часов)
+    # Добавляем фоновую задачу для отправки уведомлений
     job_queue = application.job_queue
-    job_queue.run_repeating(subscription_reminder_job, interval=timedelta(hours=6), first=10, name="subscription_reminder")
+    job_queue.run_repeating(subscription_reminder_job, interval=REMINDER_INTERVAL, first=10, name="subscription_reminder")
+    job_queue.run_repeating(exchange_rates_job, interval=cryptobot.rates_ttl, first=0, name="exchange_rates")
+    job_queue.run_repeating(
+        invoice_poll_job, interval=WEBHOOK_FALLBACK_INTERVAL if CRYPTO_WEBHOOK_PORT else POLL_INTERVAL,
+        first=5, name="invoice_poll"
+    )
+    job_queue.run_repeating(allocator_sync_job, interval=SYNC_INTERVAL, first=0, name="server_allocator_sync")
+    job_queue.run_repeating(server_health_job, interval=PROBE_INTERVAL, first=5, name="server_health_probe")
+    job_queue.run_repeating(panel_inventory_job, interval=TICK_INTERVAL, first=15, name="panel_inventory")
+    job_queue.run_repeating(delivery_flush_job, interval=FLUSH_INTERVAL, first=FLUSH_INTERVAL, name="delivery_flush")
+    job_queue.run_repeating(key_pool_job, interval=FILL_INTERVAL, first=20, name="key_pool")
+    job_queue.run_repeating(keyboard_cache_job, interval=KEYBOARD_CHECK_INTERVAL, first=0, name="keyboard_cache")
+    job_queue.run_repeating(pending_revoke_job, interval=REVOKE_RETRY_INTERVAL, first=60, name="pending_revoke")
+    job_queue.run_repeating(reconcile_job, interval=timedelta(days=1), first=timedelta(minutes=30), name="panel_reconcile")
 
     add_server_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(server_add_start, pattern="^server_add_start$")],
+        entry_points=[CallbackRoutes({"server_add_start": server_add_start})],
         states={
             STATE_ADMIN_ADD_SERVER_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, server_add_get_name)],
             STATE_ADMIN_ADD_SERVER_URL: [MessageHandler(filters.TEXT & ~filters.COMMAND, server_add_get_url)],
@@ -1897,86 +1884,112 @@ def main():
     )
 
     main_conv_handler = ConversationHandler(
-        entry_points=[CommandHandler("start", start), CallbackQueryHandler(start, pattern="^main_menu$")],
+        entry_points=[CommandHandler("start", start), CallbackRoutes({"main_menu": start})],
         states={
             STATE_MAIN_MENU: [
-                CallbackQueryHandler(select_tariff, pattern="^buy_vpn$"),
-                CallbackQueryHandler(my_vpn, pattern="^my_vpn$"),
-                CallbackQueryHandler(show_vpn_device, pattern="^vpn_device_"),
-                CallbackQueryHandler(instructions_menu, pattern="^instructions$"),
-                CallbackQueryHandler(referral_menu, pattern="^referral$"),
-                CallbackQueryHandler(support_start, pattern="^support$"),
-                CallbackQueryHandler(admin_panel, pattern="^admin_panel$"),
-                CallbackQueryHandler(balance_menu, pattern="^balance_menu$"),
+                CallbackRoutes({
+                    "buy_vpn": select_tariff,
+                    "my_vpn": my_vpn,
+                    "vpn_device_{profile_id:int}": show_vpn_device,
+                    "instructions": instructions_menu,
+                    "referral": referral_menu,
+                    "support": support_start,
+                    "admin_panel": admin_panel,
+                    "balance_menu": balance_menu,
+                }),
             ],
             STATE_SELECT_PAYMENT_METHOD: [
-                CallbackQueryHandler(select_payment_method, pattern="^tariff_"),
-                CallbackQueryHandler(select_tariff, pattern="^buy_vpn$"),
+                CallbackRoutes({
+                    "tariff_{tariff_key}": select_payment_method,
+                    "buy_vpn": select_tariff,
+                }),
             ],
             STATE_SELECT_CURRENCY: [
-                CallbackQueryHandler(select_currency, pattern="^pay_crypto$"),
-                CallbackQueryHandler(sbp_payment_info, pattern="^pay_sbp$"),
-                CallbackQueryHandler(support_start_sbp, pattern="^support_sbp$"),
-                CallbackQueryHandler(pay_from_balance, pattern="^pay_from_balance$"),
-                CallbackQueryHandler(select_payment_method, pattern="^tariff_"),
+                CallbackRoutes({
+                    "pay_crypto": select_currency,
+                    "pay_sbp": sbp_payment_info,
+                    "support_sbp": support_start_sbp,
+                    "pay_from_balance": pay_from_balance,
+                    "tariff_{tariff_key}": select_payment_method,
+                }),
             ],
             STATE_AWAIT_PAYMENT: [
-                CallbackQueryHandler(create_payment, pattern="^currency_"),
-                CallbackQueryHandler(check_payment, pattern="^check_"),
-                CallbackQueryHandler(select_currency, pattern="^pay_crypto$"),
+                CallbackRoutes({
+                    "currency_{currency}": create_payment,
+                    "check_{invoice_id:int}": check_payment,
+                    "pay_crypto": select_currency,
+                }),
             ],
             STATE_SUPPORT_CHAT: [
                 CommandHandler("close_chat", close_chat_user),
                 MessageHandler(filters.ALL & ~filters.COMMAND, forward_to_group),
             ],
             STATE_INSTRUCTIONS: [
-                CallbackQueryHandler(show_instruction, pattern="^instr_"),
-                CallbackQueryHandler(instructions_menu, pattern="^instructions$"),
+                CallbackRoutes({
+                    "instr_{platform}": show_instruction,
+                    "instructions": instructions_menu,
+                }),
             ],
             STATE_ADMIN_PANEL: [
-                CallbackQueryHandler(admin_stats, pattern="^admin_stats$"),
-                CallbackQueryHandler(grant_sub_start, pattern="^admin_grant_start$"),
-                CallbackQueryHandler(admin_servers_menu, pattern="^admin_servers_menu$"),
-                CallbackQueryHandler(broadcast_start, pattern="^admin_broadcast_start$"),
-                CallbackQueryHandler(revoke_sub_start, pattern="^admin_revoke_start$"),
-                CallbackQueryHandler(admin_find_by_key_start, pattern="^admin_find_by_key$"),
-                CallbackQueryHandler(admin_edit_text_list, pattern="^admin_edit_text$"),
-                CallbackQueryHandler(admin_find_user_start, pattern="^admin_find_user$"),
-                CallbackQueryHandler(admin_credit_balance_start, pattern="^admin_credit_balance"),
+                CallbackRoutes({
+                    "admin_stats": admin_stats,
+                    "admin_grant_start": grant_sub_start,
+                    "admin_servers_menu": admin_servers_menu,
+                    "admin_broadcast_start": broadcast_start,
+                    "admin_delivery": admin_delivery,
+                    "admin_delivery_reset_all": admin_delivery_reset_all,
+                    "admin_revoke_start": revoke_sub_start,
+                    "admin_bulk_revoke": bulk_revoke_start,
+                    "admin_find_by_key": admin_find_by_key_start,
+                    "admin_edit_text": admin_edit_text_list,
+                    "admin_find_user": admin_find_user_start,
+                    "admin_credit_balance": admin_credit_balance_start,
+                }),
             ],
             STATE_ADMIN_GRANT_ID: [MessageHandler(filters.TEXT & ~filters.COMMAND, grant_sub_get_id)],
-            STATE_ADMIN_GRANT_TARIFF: [CallbackQueryHandler(grant_sub_get_tariff_and_confirm, pattern="^grant_")],
+            STATE_ADMIN_GRANT_TARIFF: [CallbackRoutes({"grant_{tariff_key}": grant_sub_get_tariff_and_confirm})],
             STATE_ADMIN_BROADCAST_MESSAGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, broadcast_message)],
             STATE_ADMIN_REVOKE_ID: [MessageHandler(filters.TEXT & ~filters.COMMAND, revoke_sub_get_id)],
-            STATE_ADMIN_REVOKE_CONFIRM: [CallbackQueryHandler(revoke_sub_confirm, pattern="^revoke_confirm_yes")],
+            STATE_ADMIN_REVOKE_CONFIRM: [CallbackRoutes({"revoke_confirm_yes": revoke_sub_confirm})],
+            STATE_ADMIN_BULK_REVOKE_INPUT: [
+                MessageHandler((filters.TEXT & ~filters.COMMAND) | filters.Document.ALL, bulk_revoke_process),
+            ],
             STATE_ADMIN_FIND_BY_KEY_INPUT: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_find_by_key_process)],
-            STATE_ADMIN_EDIT_TEXT_LIST: [CallbackQueryHandler(admin_edit_text_start, pattern="^edittext_")],
+            STATE_ADMIN_EDIT_TEXT_LIST: [CallbackRoutes({"edittext_{text_key}": admin_edit_text_start})],
             STATE_ADMIN_EDIT_TEXT_INPUT: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_edit_text_save)],
             STATE_ADMIN_SERVERS_MENU: [
-                CallbackQueryHandler(admin_view_server, pattern=r"^server_view_\d+$"),
+                CallbackRoutes({"server_view_{server_id:int}": admin_view_server}),
                 add_server_handler,
             ],
             STATE_ADMIN_VIEW_SERVER: [
-                CallbackQueryHandler(admin_toggle_server_status, pattern=r"^server_toggle_\d+$"),
-                CallbackQueryHandler(admin_delete_server, pattern=r"^server_delete_\d+$"),
-                CallbackQueryHandler(admin_servers_menu, pattern="^admin_servers_menu$"),
+                CallbackRoutes({
+                    "server_toggle_{server_id:int}": admin_toggle_server_status,
+                    "server_delete_{server_id:int}": admin_delete_server,
+                    "admin_servers_menu": admin_servers_menu,
+                }),
             ],
             STATE_ADMIN_FIND_USER_INPUT: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_find_user_process)],
-            STATE_ADMIN_USER_PROFILE: [CallbackQueryHandler(admin_send_message_start, pattern="^admin_send_message$")],
+            STATE_ADMIN_USER_PROFILE: [
+                CallbackRoutes({
+                    "admin_send_message": admin_send_message_start,
+                    "admin_delivery_reset_user": admin_delivery_reset_user,
+                }),
+            ],
             STATE_ADMIN_SEND_MESSAGE_INPUT: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_send_message_process)],
             STATE_ADMIN_CREDIT_BALANCE_ID: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_credit_balance_get_id)],
             STATE_ADMIN_CREDIT_BALANCE_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_credit_balance_process)],
             STATE_BALANCE_MENU: [
-                CallbackQueryHandler(balance_ask_crypto_amount, pattern="^balance_crypto$"),
-                CallbackQueryHandler(balance_ask_rub_amount, pattern="^balance_rub$"),
+                CallbackRoutes({
+                    "balance_crypto": balance_ask_crypto_amount,
+                    "balance_rub": balance_ask_rub_amount,
+                }),
             ],
             STATE_BALANCE_CRYPTO_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, balance_create_crypto_invoice)],
-            STATE_BALANCE_AWAIT_CRYPTO_PAYMENT: [CallbackQueryHandler(check_balance_payment, pattern="^check_balance_")],
+            STATE_BALANCE_AWAIT_CRYPTO_PAYMENT: [CallbackRoutes({"check_balance_{invoice_id:int}": check_balance_payment})],
             STATE_BALANCE_RUB_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, balance_create_rub_ticket)],
         },
         fallbacks=[
-            CallbackQueryHandler(start, pattern="^main_menu$"),
-            CallbackQueryHandler(admin_panel, pattern="^admin_panel$"),
+            CallbackRoutes({"main_menu": start, "admin_panel": admin_panel}),
             CommandHandler("start", start),
             CommandHandler("cancel", cancel),
         ],
@@ -1984,11 +1997,18 @@ def main():
     )
 
     application.add_handler(main_conv_handler)
+    application.add_handler(CallbackRoutes({"broadcast_cancel_{broadcast_id:int}": broadcast_cancel}))
     application.add_handler(MessageHandler(filters.Chat(GROUP_ID) & ~filters.COMMAND, forward_to_user))
     application.add_handler(CommandHandler("close_ticket", close_chat_admin, filters=filters.Chat(GROUP_ID)))
 
-    logger.info("Бот запущен...")
-    application.run_polling()
+    if TELEGRAM_WEBHOOK_URL:
+        logger.info("Бот запущен в режиме вебхука...")
+        asyncio.run(serve_webhook(
+            application, TELEGRAM_WEBHOOK_URL, TELEGRAM_WEBHOOK_HOST, TELEGRAM_WEBHOOK_PORT, TELEGRAM_WEBHOOK_SECRET
+        ))
+    else:
+        logger.info("Бот запущен...")
+        application.run_polling()
 
 if __name__ == "__main__":
     main()
@@ -1,65 +1,50 @@
 #!/usr/bin/env python3
 """
-Скрипт для автоматического исправления пути к базе данных в боте
-Меняет vpn_bot.db на vpn_platform.db для синхронизации с веб-приложением
+Скрипт для приведения vpn_platform.db к общей схеме бота и веб-приложения
+Применяет миграции vpnbot.migrations; старая схема бота переносится автоматически
 """
 
-import re
-import shutil
+import sqlite3
+import sys
 from pathlib import Path
 
-def patch_bot_file():
-    bot_file = Path('attached_assets/bot_1761427044553.py')
-    
-    if not bot_file.exists():
-        print("❌ Файл бота не найден!")
-        return False
-    
-    # Создание резервной копии
-    backup_file = bot_file.with_suffix('.py.backup')
-    shutil.copy2(bot_file, backup_file)
-    print(f"✅ Создана резервная копия: {backup_file}")
-    
-    # Чтение файла
-    with open(bot_file, 'r', encoding='utf-8') as f:
-        content = f.read()
-    
-    # Подсчет замен
-    count_double = content.count('"vpn_bot.db"')
-    count_single = content.count("'vpn_bot.db'")
-    total_count = count_double + count_single
-    
-    if total_count == 0:
-        print("✅ База данных уже настроена на vpn_platform.db")
-        return True
-    
-    # Замена путей к базе данных
-    content = content.replace('"vpn_bot.db"', '"vpn_platform.db"')
-    content = content.replace("'vpn_bot.db'", "'vpn_platform.db'")
-    
-    # Сохранение изменений
-    with open(bot_file, 'w', encoding='utf-8') as f:
-        f.write(content)
-    
-    print(f"✅ Патч применен успешно!")
-    print(f"📝 Заменено вхождений: {total_count}")
-    print(f"📊 База данных изменена на vpn_platform.db")
-    print(f"💾 Резервная копия сохранена в: {backup_file}")
+from vpnbot.migrations import LATEST_VERSION, current_version, migrate
+
+DB_PATH = 'vpn_platform.db'
+
+
+def migrate_database():
+    if not Path(DB_PATH).exists():
+        print(f"ℹ️  {DB_PATH} не найден, будет создана новая база")
+
+    applied = migrate(DB_PATH)
+    if not applied:
+        print("✅ Схема базы данных уже актуальна")
+    else:
+        print(f"✅ Применены миграции: {', '.join(map(str, applied))}")
+
+    with sqlite3.connect(DB_PATH) as conn:
+        version = current_version(conn)
+    print(f"📊 Версия схемы: {version} из {LATEST_VERSION}")
     print("")
-    print("⚠️  ВАЖНО: После применения патча бот и веб-приложение используют ОДНУ базу данных")
-    print("✨ Теперь все данные синхронизированы между ботом и веб-интерфейсом!")
-    
+    print("⚠️  ВАЖНО: бот и веб-приложение используют ОДНУ базу данных vpn_platform.db")
     return True
 
+
 if __name__ == "__main__":
-    print("🔧 Применение патча синхронизации базы данных...")
+    print("🔧 Применение миграций базы данных...")
     print("")
-    
-    success = patch_bot_file()
-    
+
+    try:
+        success = migrate_database()
+    except sqlite3.Error as e:
+        print(f"❌ Ошибка миграции: {e}")
+        success = False
+
     if success:
         print("")
         print("✅ Готово! Теперь можно запускать бота.")
     else:
         print("")
-        print("❌ Произошла ошибка при применении патча.")
+        print("❌ Произошла ошибка при применении миграций.")
+        sys.exit(1)
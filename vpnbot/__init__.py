@@ -0,0 +1 @@
+"""Общие компоненты Telegram-ботов ARMT VPN."""
@@ -0,0 +1,132 @@
+"""Выбор наименее загруженного сервера для нового ключа.
+
+Состояние хранится в памяти: строки активных серверов, число клиентов на
+каждом и вес емкости (servers.capacity_weight). Нагрузка сервера - число
+клиентов, деленное на вес. Выбор идет по куче с ленивым удалением
+устаревших записей, поэтому занимает O(log n).
+
+Счетчики клиентов в базе отдельно не пишутся: каждый выданный ключ и так
+сохраняется строкой vpn_profiles. Периодическая задача refresh() заново
+считает клиентов по vpn_profiles и подхватывает изменения из
+веб-приложения и админ-панели.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+
+logger = logging.getLogger(__name__)
+
+SYNC_INTERVAL = 5 * 60
+
+LOAD_SERVERS_SQL = (
+    "SELECT s.*, (SELECT COUNT(*) FROM vpn_profiles p WHERE p.server_id = s.id) AS clients "
+    "FROM servers s WHERE s.is_active = 1"
+)
+
+
+class ServerAllocator:
+    def __init__(self):
+        self._servers = {}
+        self._clients = {}
+        self._pending = {}
+        self._versions = {}
+        self._heap = []
+        self._seq = itertools.count()
+        self._refresh_lock = asyncio.Lock()
+        self.loaded = False
+
+    def _weight(self, server_id):
+        weight = self._servers[server_id]['capacity_weight']
+        return 1.0 if weight is None else float(weight)
+
+    def load(self, server_id):
+        """Текущая нагрузка сервера с учетом ключей, которые еще выдаются."""
+        return (self._clients[server_id] + self._pending[server_id]) / self._weight(server_id)
+
+    def _push(self, server_id):
+        version = self._versions.get(server_id, 0) + 1
+        self._versions[server_id] = version
+        # Вес 0 выводит сервер из выдачи, не отключая его целиком
+        if self._weight(server_id) > 0:
+            heapq.heappush(self._heap, (self.load(server_id), next(self._seq), server_id, version))
+        # Устаревшие записи удаляются лениво; если их стало слишком много,
+        # перестраиваем кучу целиком.
+        if len(self._heap) > 4 * len(self._servers) + 16:
+            self._heap = [e for e in self._heap if self._versions.get(e[2]) == e[3]]
+            heapq.heapify(self._heap)
+
+    def set_servers(self, rows):
+        """Заменяет состояние строками servers с дополнительным столбцом clients."""
+        self._servers = {row['id']: row for row in rows}
+        self._clients = {row['id']: row['clients'] for row in rows}
+        # Ключи, которые выдаются прямо сейчас, в vpn_profiles еще не попали
+        self._pending = {server_id: self._pending.get(server_id, 0) for server_id in self._servers}
+        self._versions = {}
+        self._heap = []
+        for server_id in self._servers:
+            self._push(server_id)
+        self.loaded = True
+
+    async def refresh(self, db):
+        async with self._refresh_lock:
+            rows = await db.fetchall(LOAD_SERVERS_SQL)
+            self.set_servers(rows)
+        logger.debug(f"Аллокатор серверов обновлен: {len(rows)} активных")
+
+    async def ensure_loaded(self, db):
+        if not self.loaded:
+            await self.refresh(db)
+
+    def invalidate(self):
+        """Помечает состояние устаревшим; следующая выдача перечитает серверы."""
+        self.loaded = False
+
+    def has_servers(self):
+        """Есть ли серверы, на которые в принципе можно выдавать ключи (без учета exclude)."""
+        return any(self._weight(server_id) > 0 for server_id in self._servers)
+
+    def acquire(self, exclude=()):
+        """Резервирует место на наименее загруженном сервере и возвращает его строку.
+
+        После выдачи ключа нужно вызвать commit(), при ошибке - release().
+        Возвращает None, если подходящих серверов нет.
+        """
+        skipped, chosen = [], None
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            server_id, version = entry[2], entry[3]
+            if self._versions.get(server_id) != version:
+                continue
+            if server_id in exclude:
+                skipped.append(entry)
+                continue
+            chosen = server_id
+            break
+        for entry in skipped:
+            heapq.heappush(self._heap, entry)
+        if chosen is None:
+            return None
+        self._pending[chosen] += 1
+        self._push(chosen)
+        return self._servers[chosen]
+
+    def commit(self, server_id):
+        if server_id not in self._servers:
+            return
+        self._pending[server_id] = max(0, self._pending[server_id] - 1)
+        self._clients[server_id] += 1
+        self._push(server_id)
+
+    def release(self, server_id):
+        if server_id not in self._servers:
+            return
+        self._pending[server_id] = max(0, self._pending[server_id] - 1)
+        self._push(server_id)
+
+    def clients(self, server_id):
+        return self._clients.get(server_id)
+
+
+allocator = ServerAllocator()
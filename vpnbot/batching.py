@@ -0,0 +1,82 @@
+"""Объединение одновременных выдач ключей в один запрос addClient.
+
+Запросы на один сервер и inbound копятся LINGER секунд (или до MAX_BATCH
+штук) и уходят в панель одним вызовом add_vless_clients. Если панель
+отклоняет пачку целиком, клиенты создаются по одному, чтобы ошибка одного
+не срывала выдачу остальным.
+"""
+
+import asyncio
+import logging
+
+from vpnbot.inventory import PanelClient, panel_inventory
+from vpnbot.xui import xui_clients
+
+logger = logging.getLogger(__name__)
+
+LINGER = 0.05
+MAX_BATCH = 50
+
+
+class ProvisionBatcher:
+    def __init__(self, xui_clients, linger=LINGER, max_batch=MAX_BATCH):
+        self.xui_clients = xui_clients
+        self.linger = linger
+        self.max_batch = max_batch
+        self._pending = {}
+        self._timers = {}
+        self._tasks = set()
+
+    async def add_client(self, server, user_id, days, gb):
+        """Создает клиента на сервере; возвращает {"uuid", "email"} или None."""
+        key = (server['id'], server['vless_inbound_id'])
+        future = asyncio.get_running_loop().create_future()
+        spec = {"user_id": user_id, "days": days, "gb": gb, "flow": server['vless_flow']}
+        batch = self._pending.setdefault(key, [])
+        batch.append((spec, future))
+
+        if len(batch) >= self.max_batch:
+            self._flush(key, server)
+        elif key not in self._timers:
+            self._timers[key] = asyncio.get_running_loop().call_later(self.linger, self._flush, key, server)
+        return await future
+
+    def _flush(self, key, server):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(key, None)
+        if not batch:
+            return
+        task = asyncio.get_running_loop().create_task(self._send(server, batch))
+        # Держим ссылку, иначе задачу может собрать сборщик мусора
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, server, batch):
+        api = self.xui_clients.for_server(server)
+        inbound_id = server['vless_inbound_id']
+        specs = [spec for spec, _ in batch]
+        try:
+            results = await api.add_vless_clients(inbound_id, specs)
+            if results is None and len(batch) > 1:
+                logger.warning(f"Панель {server['name']} отклонила пачку из {len(batch)} клиентов, создаем по одному")
+                results = await asyncio.gather(*(
+                    api.add_vless_clients(inbound_id, [spec]) for spec in specs
+                ))
+                results = [result[0] if result else None for result in results]
+        except Exception as e:
+            logger.error(f"Ошибка пакетной выдачи на сервере {server['name']}: {e}")
+            results = None
+        if results is None:
+            results = [None] * len(batch)
+
+        for (spec, future), result in zip(batch, results):
+            if result:
+                panel_inventory.add(PanelClient(server['id'], inbound_id, result['uuid'], result['email'], spec['user_id']), local=True)
+            # Покупатель мог уже отменить ожидание
+            if not future.done():
+                future.set_result(result)
+
+
+provision_batcher = ProvisionBatcher(xui_clients)
@@ -0,0 +1,214 @@
+"""Рассылка сообщений всем пользователям бота.
+
+Рассылка записывается в таблицу broadcasts и выполняется фоновой задачей,
+поэтому админский диалог не ждет ее окончания. Получатели читаются
+страницами по telegram_id (курсор хранится в broadcasts.cursor), страница
+отправляется параллельно не более чем CONCURRENCY запросами класса BULK
+через общий планировщик vpnbot.outbound: он держит скорость в пределах
+лимита Telegram и пропускает вперед ответы пользователям. После каждой
+страницы курсор и счетчики сохраняются, так что после перезапуска
+рассылка продолжается с места остановки; повторно отправится не больше
+одной страницы.
+"""
+
+import asyncio
+import logging
+import time
+from datetime import datetime
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+
+from vpnbot.outbound import BULK, TRANSACTIONAL
+
+logger = logging.getLogger(__name__)
+
+CONCURRENCY = 20
+PAGE_SIZE = 200
+MAX_ATTEMPTS = 3
+PROGRESS_INTERVAL = 10
+
+# Пользователи с delivery_status (заблокировали бота и т.п.) пропускаются
+RECIPIENTS_SQL = (
+    "SELECT telegram_id FROM users WHERE telegram_id > ? AND delivery_status IS NULL ORDER BY telegram_id LIMIT ?"
+)
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def _now():
+    return datetime.now().strftime(DATE_FORMAT)
+
+
+def describe(broadcast, speed=None):
+    processed = broadcast['sent'] + broadcast['failed']
+    total = max(broadcast['total'], processed)
+    percent = f"{processed / total:.0%}" if total else "100%"
+    lines = [
+        f"📢 Рассылка #{broadcast['id']}: {processed} из {total} ({percent})",
+        f"Отправлено: {broadcast['sent']}, не доставлено: {broadcast['failed']}",
+    ]
+    if speed:
+        left = max(total - processed, 0) / speed
+        lines.append(f"Скорость: {speed:.1f} сообщ./с, осталось около {int(left // 60) + 1} мин")
+    return "\n".join(lines)
+
+
+class Broadcaster:
+    def __init__(self, db, concurrency=CONCURRENCY, page_size=PAGE_SIZE):
+        self.db = db
+        self.concurrency = concurrency
+        self.page_size = page_size
+        self.bot = None
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._stopping = False
+
+    async def create(self, text, parse_mode=None, created_by=None, progress_chat_id=None, progress_message_id=None):
+        """Ставит рассылку в очередь и возвращает ее номер."""
+        def insert(conn):
+            total = conn.execute("SELECT COUNT(*) FROM users WHERE telegram_id > 0 AND delivery_status IS NULL").fetchone()[0]
+            return conn.execute(
+                "INSERT INTO broadcasts (text, parse_mode, created_by, progress_chat_id, progress_message_id, total, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) RETURNING id",
+                (text, parse_mode, created_by, progress_chat_id, progress_message_id, total, _now())
+            ).fetchone()[0]
+
+        broadcast_id = await self.db.transaction(insert)
+        self._wakeup.set()
+        return broadcast_id
+
+    async def cancel(self, broadcast_id):
+        """Останавливает рассылку после текущей страницы. False, если она уже закончена."""
+        return bool(await self.db.execute(
+            "UPDATE broadcasts SET status = 'cancelled', finished_at = ? WHERE id = ? AND status IN ('pending', 'running')",
+            (_now(), broadcast_id)
+        ))
+
+    def start(self, bot):
+        self.bot = bot
+        self._stopping = False
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Дожидается отправки текущей страницы; незаконченная рассылка продолжится при следующем запуске."""
+        self._stopping = True
+        self._wakeup.set()
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while not self._stopping:
+            self._wakeup.clear()
+            try:
+                broadcast = await self.db.fetchone(
+                    "SELECT * FROM broadcasts WHERE status IN ('pending', 'running') ORDER BY id LIMIT 1"
+                )
+                if broadcast is not None:
+                    await self._process(broadcast)
+                    continue
+            except Exception:
+                logger.exception("Ошибка выполнения рассылки")
+                await asyncio.sleep(PROGRESS_INTERVAL)
+                continue
+            await self._wakeup.wait()
+
+    async def _process(self, broadcast):
+        broadcast_id = broadcast['id']
+        if broadcast['status'] == 'pending':
+            await self.db.execute(
+                "UPDATE broadcasts SET status = 'running', started_at = ? WHERE id = ? AND status = 'pending'",
+                (_now(), broadcast_id)
+            )
+            logger.info(f"Рассылка #{broadcast_id} начата, получателей: {broadcast['total']}")
+        else:
+            logger.info(f"Рассылка #{broadcast_id} продолжена после пользователя {broadcast['cursor']}")
+
+        state = dict(broadcast, status='running')
+        semaphore = asyncio.Semaphore(self.concurrency)
+        started, sent_at_start = time.monotonic(), state['sent'] + state['failed']
+        last_progress = 0
+
+        async def deliver(chat_id):
+            async with semaphore:
+                return await self._deliver(chat_id, state['text'], state['parse_mode'])
+
+        while not self._stopping:
+            status = await self.db.fetchval("SELECT status FROM broadcasts WHERE id = ?", (broadcast_id,))
+            if status != 'running':
+                state['status'] = status
+                logger.info(f"Рассылка #{broadcast_id} остановлена, отправлено {state['sent']}")
+                break
+            rows = await self.db.fetchall(RECIPIENTS_SQL, (state['cursor'], self.page_size))
+            if not rows:
+                await self.db.execute(
+                    "UPDATE broadcasts SET status = 'done', finished_at = ? WHERE id = ? AND status = 'running'",
+                    (_now(), broadcast_id)
+                )
+                state['status'] = 'done'
+                logger.info(f"Рассылка #{broadcast_id} завершена: отправлено {state['sent']}, не доставлено {state['failed']}")
+                break
+
+            results = await asyncio.gather(*(deliver(row[0]) for row in rows))
+            state['sent'] += sum(results)
+            state['failed'] += len(results) - sum(results)
+            state['cursor'] = rows[-1][0]
+            await self.db.execute(
+                "UPDATE broadcasts SET cursor = ?, sent = ?, failed = ? WHERE id = ?",
+                (state['cursor'], state['sent'], state['failed'], broadcast_id)
+            )
+
+            if time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+                last_progress = time.monotonic()
+                speed = (state['sent'] + state['failed'] - sent_at_start) / max(last_progress - started, 1e-3)
+                await self._report(state, speed)
+
+        if state['status'] != 'running':
+            await self._report(state)
+
+    async def _deliver(self, chat_id, text, parse_mode):
+        """True, если сообщение доставлено."""
+        attempt = 0
+        while True:
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode, rate_limit_args=BULK)
+                return True
+            except RetryAfter:
+                # Планировщик уже выждал паузу и исчерпал свои повторы; попытка не расходуется
+                continue
+            except (Forbidden, BadRequest) as e:
+                # Бот заблокирован, чат удален и т.п. - повтор не поможет
+                logger.debug(f"Рассылка: {chat_id} недоступен: {e}")
+                return False
+            except NetworkError as e:
+                attempt += 1
+                if attempt >= MAX_ATTEMPTS:
+                    logger.warning(f"Рассылка: не удалось отправить {chat_id}: {e}")
+                    return False
+                await asyncio.sleep(attempt)
+            except TelegramError as e:
+                logger.warning(f"Рассылка: не удалось отправить {chat_id}: {e}")
+                return False
+
+    async def _report(self, state, speed=None):
+        if not state['progress_chat_id'] or not state['progress_message_id']:
+            return
+        text = describe(state, speed)
+        reply_markup = None
+        if state['status'] == 'done':
+            text = "✅ " + text
+        elif state['status'] == 'cancelled':
+            text = "⛔ " + text + "\nОстановлена администратором."
+        else:
+            reply_markup = InlineKeyboardMarkup([[
+                InlineKeyboardButton("⛔ Остановить", callback_data=f"broadcast_cancel_{state['id']}")
+            ]])
+        try:
+            await self.bot.edit_message_text(
+                text, chat_id=state['progress_chat_id'], message_id=state['progress_message_id'], reply_markup=reply_markup,
+                rate_limit_args=TRANSACTIONAL
+            )
+        except TelegramError as e:
+            # "message is not modified" и удаленное сообщение рассылку не останавливают
+            logger.debug(f"Не удалось обновить прогресс рассылки #{state['id']}: {e}")
@@ -0,0 +1,189 @@
+"""Разбор callback_data кнопок и выбор обработчика без перебора регулярок.
+
+Маршрут задается шаблоном: постоянная часть, затем параметры через "_":
+
+    "vpn_device_{profile_id:int}"  ->  vpn_device_17  ->  {"profile_id": 17}
+    "edittext_{key}"               ->  edittext_welcome_text  ->  {"key": "welcome_text"}
+
+Последний параметр забирает остаток строки целиком, поэтому в строковых
+значениях допустимы подчеркивания. Маршруты без параметров ищутся в словаре
+по точному совпадению, с параметрами - по постоянной части: у callback_data
+перебираются префиксы, заканчивающиеся на "_", от длинного к короткому.
+Поиск стоит O(длины callback_data) и не зависит от числа маршрутов.
+
+CallbackRoutes - обработчик python-telegram-bot для одного состояния
+ConversationHandler вместо списка CallbackQueryHandler(pattern=...):
+
+    CallbackRoutes({"my_vpn": my_vpn, "vpn_device_{profile_id:int}": show_vpn_device})
+
+Разобранные параметры обработчик получает в context.callback_params.
+
+Сравнение с перебором CallbackQueryHandler:
+    python -m vpnbot.callbacks --handlers 10,100,1000
+"""
+
+import argparse
+import re
+import sys
+import time
+
+from telegram import CallbackQuery, Update, User
+from telegram.ext import BaseHandler, CallbackQueryHandler
+
+PARAM_RE = re.compile(r"\{(\w+)(?::(\w+))?\}")
+CONVERTERS = {"str": str, "int": int}
+
+
+class Route:
+    def __init__(self, template, callback):
+        self.template = template
+        self.callback = callback
+        first = template.find("{")
+        self.prefix = template if first < 0 else template[:first]
+        self.params = []
+        for match in PARAM_RE.finditer(template, max(first, 0)):
+            converter = CONVERTERS.get(match.group(2) or "str")
+            if converter is None:
+                raise ValueError(f"Неизвестный тип параметра в маршруте {template}: {match.group(2)}")
+            self.params.append((match.group(1), converter))
+        if self.params and (not self.prefix.endswith("_") or build_template(self) != template):
+            raise ValueError(f"Маршрут {template}: параметры должны идти в конце через '_'")
+
+    def parse(self, rest):
+        """Параметры из части callback_data после префикса или None, если не подходят."""
+        values = rest.split("_", len(self.params) - 1)
+        if len(values) != len(self.params):
+            return None
+        params = {}
+        for (name, converter), value in zip(self.params, values):
+            if not value:
+                return None
+            try:
+                params[name] = converter(value)
+            except ValueError:
+                return None
+        return params
+
+
+def build_template(route):
+    return route.prefix + "_".join(
+        "{%s}" % name if converter is str else "{%s:%s}" % (name, converter.__name__) for name, converter in route.params
+    )
+
+
+class CallbackRouter:
+    def __init__(self, routes=None):
+        self._exact = {}
+        self._prefixes = {}
+        for template, callback in (routes or {}).items():
+            self.add(template, callback)
+
+    def add(self, template, callback):
+        route = Route(template, callback)
+        table = self._prefixes if route.params else self._exact
+        if route.prefix in table:
+            raise ValueError(f"Маршрут {template} уже зарегистрирован")
+        table[route.prefix] = route
+        return route
+
+    def resolve(self, data):
+        """(маршрут, параметры) для callback_data или None."""
+        route = self._exact.get(data)
+        if route is not None:
+            return route, {}
+        if not self._prefixes:
+            return None
+        end = data.rfind("_")
+        while end >= 0:
+            route = self._prefixes.get(data[:end + 1])
+            if route is not None:
+                params = route.parse(data[end + 1:])
+                if params is not None:
+                    return route, params
+            end = data.rfind("_", 0, end)
+        return None
+
+
+class CallbackRoutes(BaseHandler):
+    """Обработчик нажатий кнопок по таблице маршрутов."""
+
+    def __init__(self, routes, block=True):
+        super().__init__(self._dispatch, block=block)
+        self.router = routes if isinstance(routes, CallbackRouter) else CallbackRouter(routes)
+
+    def check_update(self, update):
+        if not isinstance(update, Update) or update.callback_query is None:
+            return None
+        data = update.callback_query.data
+        if not isinstance(data, str):
+            return None
+        return self.router.resolve(data)
+
+    def collect_additional_context(self, context, update, application, check_result):
+        context.callback_params = check_result[1]
+
+    async def handle_update(self, update, application, check_result, context):
+        self.collect_additional_context(context, update, application, check_result)
+        return await check_result[0].callback(update, context)
+
+    async def _dispatch(self, update, context):
+        # Нужен только как self.callback для BaseHandler; вызов идет через handle_update
+        raise RuntimeError("CallbackRoutes вызывается через handle_update")
+
+
+# --- сравнение с перебором регулярок ---
+
+async def _noop(update, context):
+    pass
+
+
+def make_callback_update(data):
+    user = User(1, "bench", False)
+    return Update(1, callback_query=CallbackQuery("1", user, "bench", data=data))
+
+
+def time_per_call(func, updates, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for update in updates:
+            func(update)
+    return (time.perf_counter() - started) / (repeat * len(updates)) * 1e6
+
+
+def bench_once(count, repeat):
+    names = [f"action{i}" for i in range(count)]
+    # Как в боте: половина маршрутов с параметром
+    templates = [f"{name}_{{item_id:int}}" if i % 2 else name for i, name in enumerate(names)]
+    handlers = [
+        CallbackQueryHandler(_noop, pattern=f"^{name}_\\d+$" if i % 2 else f"^{name}$") for i, name in enumerate(names)
+    ]
+    routes = CallbackRoutes({template: _noop for template in templates})
+    samples = [names[0], f"{names[count // 2 | 1]}_17", f"{names[-1]}_42" if (count - 1) % 2 else names[-1]]
+    updates = [make_callback_update(data) for data in samples]
+
+    def scan(update):
+        # Так ConversationHandler выбирает обработчик: первый, чей check_update подошел
+        for handler in handlers:
+            if handler.check_update(update):
+                return handler
+        return None
+
+    for update in updates:
+        assert scan(update) is not None and routes.check_update(update) is not None
+    return time_per_call(scan, updates, repeat), time_per_call(routes.check_update, updates, repeat)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Стоимость выбора обработчика нажатия кнопки")
+    parser.add_argument("--handlers", default="10,100,1000", help="число маршрутов через запятую")
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args(argv)
+    print("маршрутов  регулярки, мкс  маршрутизатор, мкс")
+    for count in (int(value) for value in args.handlers.split(",")):
+        repeat = max(args.repeat * 10 // count, 20)
+        scan, routed = bench_once(count, repeat)
+        print(f"{count:>9}  {scan:>14.2f}  {routed:>18.2f}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
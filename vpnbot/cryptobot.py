@@ -0,0 +1,104 @@
+"""Клиент Crypto Pay API (@CryptoBot) с постоянной сессией и кешем курсов.
+
+Все запросы идут через одну keep-alive сессию aiohttp. Курсы обновляет
+фоновая задача раз в rates_ttl секунд, а счета считаются по курсам из
+памяти, поэтому создание счета - один HTTP-запрос, и сбой getExchangeRates
+не останавливает оплату, пока кеш не старше RATES_MAX_AGE.
+"""
+
+import asyncio
+import logging
+import os
+import time
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+BASE_URL = "https://pay.crypt.bot/api"
+REQUEST_TIMEOUT = 15
+# Срок жизни счета; по нему же фоновый опрос закрывает неоплаченные
+INVOICE_EXPIRES_IN = 3600
+RATES_TTL = int(os.getenv("CRYPTO_RATES_TTL", "60"))
+# Старше этого курсы для расчета суммы не используются
+RATES_MAX_AGE = 15 * 60
+
+
+class CryptoBotAPI:
+    def __init__(self, token, rates_ttl=RATES_TTL, rates_max_age=RATES_MAX_AGE):
+        self.base_url = BASE_URL
+        self.headers = {"Crypto-Pay-API-Token": token} if token else {}
+        self.rates_ttl = rates_ttl
+        self.rates_max_age = rates_max_age
+        self._session = None
+        # (source, target) -> курс
+        self._rates = {}
+        self._rates_at = None
+        self._rates_lock = asyncio.Lock()
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                headers=self.headers,
+                timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT),
+            )
+        return self._session
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+
+    async def _request(self, method, endpoint, **kwargs):
+        try:
+            async with self._get_session().request(method, f"{self.base_url}/{endpoint}", **kwargs) as r:
+                return await r.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logger.error(f"Ошибка запроса {endpoint} к CryptoBot: {e}")
+            return None
+
+    async def get_exchange_rates(self):
+        return await self._request("GET", "getExchangeRates")
+
+    async def create_invoice(self, asset, amount, params=None):
+        payload = {"asset": asset, "amount": amount, "expires_in": INVOICE_EXPIRES_IN}
+        if params:
+            payload.update(params)
+        return await self._request("POST", "createInvoice", json=payload)
+
+    async def get_invoices(self, invoice_ids, count=None):
+        params = {"invoice_ids": invoice_ids}
+        if count:
+            # По умолчанию getInvoices отдает не больше 100 счетов
+            params["count"] = count
+        return await self._request("GET", "getInvoices", params=params)
+
+    @property
+    def rates_age(self):
+        return None if self._rates_at is None else time.monotonic() - self._rates_at
+
+    async def refresh_rates(self):
+        """Перечитывает курсы; при ошибке оставляет прежние. Возвращает True при успехе."""
+        response = await self.get_exchange_rates()
+        if not response or not response.get("ok"):
+            logger.warning(f"Не удалось обновить курсы CryptoBot: {response}")
+            return False
+        self._rates = {
+            (rate["source"], rate["target"]): float(rate["rate"])
+            for rate in response["result"] if rate.get("is_valid", True)
+        }
+        self._rates_at = time.monotonic()
+        return True
+
+    async def get_rate(self, source, target):
+        """Курс source/target из кеша или None, если свежих курсов нет."""
+        age = self.rates_age
+        if age is None or age >= self.rates_max_age:
+            # Фоновая задача не успела или падает: одна загрузка на всех ждущих
+            async with self._rates_lock:
+                age = self.rates_age
+                if age is None or age >= self.rates_max_age:
+                    await self.refresh_rates()
+            age = self.rates_age
+            if age is None or age >= self.rates_max_age:
+                return None
+        return self._rates.get((source, target))
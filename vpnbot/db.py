@@ -0,0 +1,111 @@
+"""Асинхронный доступ к SQLite без блокировки event loop.
+
+Запросы выполняются в отдельном пуле потоков на небольшом наборе
+долгоживущих соединений. Соединения работают в режиме WAL с busy_timeout,
+поэтому запись из веб-приложения в тот же файл не останавливает бота, а
+кеш подготовленных выражений sqlite3 переживает отдельные запросы.
+"""
+
+import asyncio
+import logging
+import queue
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class Database:
+    def __init__(self, path, pool_size=4, busy_timeout_ms=5000, cached_statements=256):
+        self.path = path
+        self.pool_size = pool_size
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cached_statements = cached_statements
+        self._executor = None
+        self._connections = queue.LifoQueue()
+        self._opened = []
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.busy_timeout_ms / 1000,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _acquire(self):
+        try:
+            return self._connections.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+            self._opened.append(conn)
+            return conn
+
+    def _run(self, fn, args):
+        conn = self._acquire()
+        try:
+            return fn(conn, *args)
+        finally:
+            self._connections.put(conn)
+
+    def _get_executor(self):
+        if self._executor is None:
+            # Пул потоков не больше числа соединений: каждый поток держит
+            # одно соединение на время запроса.
+            self._executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="sqlite")
+        return self._executor
+
+    async def run(self, fn, *args):
+        """Выполняет fn(conn, *args) в потоке БД и возвращает результат."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_executor(), self._run, fn, args)
+
+    async def transaction(self, fn, *args):
+        """Выполняет fn(conn, *args) в одной транзакции BEGIN IMMEDIATE.
+
+        При исключении транзакция откатывается, исключение пробрасывается дальше.
+        """
+        return await self.run(_in_transaction, fn, *args)
+
+    async def fetchone(self, sql, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def fetchval(self, sql, params=(), default=None):
+        row = await self.fetchone(sql, params)
+        return row[0] if row is not None else default
+
+    async def execute(self, sql, params=()):
+        """Выполняет одиночное изменяющее выражение, возвращает rowcount."""
+        return await self.run(lambda conn: conn.execute(sql, params).rowcount)
+
+    async def executemany(self, sql, seq_of_params):
+        return await self.transaction(lambda conn: conn.executemany(sql, seq_of_params).rowcount)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        for conn in self._opened:
+            conn.close()
+        self._opened = []
+        self._connections = queue.LifoQueue()
+
+
+def _in_transaction(conn, fn, *args):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        result = fn(conn, *args)
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+    return result
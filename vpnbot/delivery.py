@@ -0,0 +1,96 @@
+"""Учет пользователей, которым бот не может писать.
+
+Планировщик исходящих сообщений сообщает о Forbidden (бот заблокирован,
+аккаунт удален) и "chat not found" при отправке в личный чат, а
+DeliveryTracker записывает причину в users.delivery_status. Рассылки и
+напоминания таких пользователей пропускают. Статус сбрасывается, когда
+пользователь снова нажимает /start, или вручную из админ-панели.
+
+Запись идет пачками: при рассылке по ушедшим пользователям отказы
+приходят десятками в секунду.
+"""
+
+import logging
+from datetime import datetime
+
+from telegram.error import BadRequest, Forbidden
+
+logger = logging.getLogger(__name__)
+
+BLOCKED = "blocked"
+DEACTIVATED = "deactivated"
+NOT_FOUND = "not_found"
+STATUS_NAMES = {
+    BLOCKED: "бот заблокирован",
+    DEACTIVATED: "аккаунт удален",
+    NOT_FOUND: "чат не найден",
+}
+
+FLUSH_SIZE = 100
+FLUSH_INTERVAL = 30
+
+
+def unreachable_status(error):
+    """Статус недоступности по ошибке Bot API или None, если ошибка временная."""
+    message = str(error).lower()
+    if isinstance(error, Forbidden):
+        return DEACTIVATED if "deactivated" in message else BLOCKED
+    if isinstance(error, BadRequest) and "chat not found" in message:
+        return NOT_FOUND
+    return None
+
+
+class DeliveryTracker:
+    def __init__(self, db, flush_size=FLUSH_SIZE):
+        self.db = db
+        self.flush_size = flush_size
+        # telegram_id -> (статус, время)
+        self._pending = {}
+
+    async def record(self, chat_id, status):
+        self._pending[chat_id] = (status, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        if len(self._pending) >= self.flush_size:
+            try:
+                await self.flush()
+            except Exception as e:
+                # Отметки остаются в памяти до следующей записи
+                logger.error(f"Не удалось записать статусы доставки: {e}")
+
+    async def flush(self):
+        if not self._pending:
+            return 0
+        pending, self._pending = self._pending, {}
+        try:
+            await self.db.executemany(
+                "UPDATE users SET delivery_status = ?, delivery_failed_at = ? WHERE telegram_id = ?",
+                [(status, failed_at, chat_id) for chat_id, (status, failed_at) in pending.items()]
+            )
+        except Exception:
+            self._pending = {**pending, **self._pending}
+            raise
+        logger.info(f"Отмечено недоступных пользователей: {len(pending)}")
+        return len(pending)
+
+    def forget(self, telegram_id):
+        """Убирает еще не записанную отметку пользователя: он снова пишет боту."""
+        self._pending.pop(telegram_id, None)
+
+    async def reset(self, telegram_id=None):
+        """Сбрасывает статус одного пользователя или всех; возвращает число сброшенных."""
+        if telegram_id is None:
+            self._pending.clear()
+            return await self.db.execute(
+                "UPDATE users SET delivery_status = NULL, delivery_failed_at = NULL WHERE delivery_status IS NOT NULL"
+            )
+        self.forget(telegram_id)
+        return await self.db.execute(
+            "UPDATE users SET delivery_status = NULL, delivery_failed_at = NULL "
+            "WHERE telegram_id = ? AND delivery_status IS NOT NULL",
+            (telegram_id,)
+        )
+
+    async def counts(self):
+        rows = await self.db.fetchall(
+            "SELECT delivery_status, COUNT(*) FROM users WHERE delivery_status IS NOT NULL GROUP BY delivery_status"
+        )
+        return {status: count for status, count in rows}
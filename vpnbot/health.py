@@ -0,0 +1,141 @@
+"""Фоновая проверка панелей 3X-UI и автомат защиты для выдачи ключей.
+
+Задача job_queue раз в PROBE_INTERVAL секунд параллельно логинится во все
+панели из servers, записывает задержку и ошибки. После FAILURE_THRESHOLD
+неудач подряд автомат сервера размыкается, и аллокатор перестает его
+выбирать. Через RESET_TIMEOUT сервер снова допускается к выдаче
+(полуоткрытое состояние): успешная проверка или выдача замыкает автомат,
+неудача размыкает его снова.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+PROBE_INTERVAL = 60
+PROBE_TIMEOUT = 10
+PROBE_CONCURRENCY = 20
+FAILURE_THRESHOLD = 3
+RESET_TIMEOUT = 120
+HISTORY_SIZE = 20
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return CLOSED
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return HALF_OPEN
+        return OPEN
+
+    def allow(self):
+        return self.state != OPEN
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            # Неудача в полуоткрытом состоянии снова размыкает автомат на полный срок
+            self.opened_at = time.monotonic()
+
+
+class ServerHealth:
+    def __init__(self):
+        self.breaker = CircuitBreaker()
+        # (время проверки, задержка в мс или None при ошибке)
+        self.history = deque(maxlen=HISTORY_SIZE)
+
+    def record(self, latency_ms):
+        self.history.append((time.time(), latency_ms))
+        if latency_ms is None:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+    @property
+    def error_rate(self):
+        if not self.history:
+            return 0.0
+        return sum(1 for _, latency in self.history if latency is None) / len(self.history)
+
+
+class HealthMonitor:
+    def __init__(self, concurrency=PROBE_CONCURRENCY):
+        self._servers = {}
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    def get(self, server_id):
+        health = self._servers.get(server_id)
+        if health is None:
+            health = self._servers[server_id] = ServerHealth()
+        return health
+
+    def unavailable(self):
+        """ID серверов с разомкнутым автоматом; аллокатор их пропускает."""
+        return {server_id for server_id, health in self._servers.items() if not health.breaker.allow()}
+
+    def record_success(self, server_id):
+        self.get(server_id).breaker.record_success()
+
+    def record_failure(self, server_id):
+        breaker = self.get(server_id).breaker
+        was_allowed = breaker.allow()
+        breaker.record_failure()
+        if was_allowed and not breaker.allow():
+            logger.warning(f"Сервер {server_id} исключен из выдачи ключей после {breaker.failures} ошибок подряд")
+
+    async def probe(self, xui_clients, server):
+        api = xui_clients.for_server(server)
+        async with self._semaphore:
+            started = time.monotonic()
+            try:
+                # Под login_lock, чтобы не перелогиниваться одновременно с выдачей ключа
+                async with api.login_lock:
+                    ok = await asyncio.wait_for(api.login(), PROBE_TIMEOUT)
+            except Exception as e:
+                logger.warning(f"Проверка панели {server['name']} завершилась ошибкой: {e}")
+                ok = False
+            latency_ms = round((time.monotonic() - started) * 1000)
+
+        health = self.get(server['id'])
+        was_allowed = health.breaker.allow()
+        health.record(latency_ms if ok else None)
+        if was_allowed and not health.breaker.allow():
+            logger.warning(f"Панель {server['name']} не отвечает, сервер исключен из выдачи ключей")
+        elif not was_allowed and health.breaker.allow():
+            logger.info(f"Панель {server['name']} снова доступна")
+
+    async def probe_all(self, db, xui_clients):
+        servers = await db.fetchall("SELECT * FROM servers")
+        known = {server['id'] for server in servers}
+        for server_id in list(self._servers):
+            if server_id not in known:
+                del self._servers[server_id]
+        await asyncio.gather(*(self.probe(xui_clients, server) for server in servers))
+
+    def describe(self, server_id):
+        """Строка с историей задержек для админ-панели."""
+        health = self._servers.get(server_id)
+        if health is None or not health.history:
+            return "проверок еще не было"
+        points = " ".join("✖" if latency is None else str(latency) for _, latency in list(health.history)[-10:])
+        states = {CLOSED: "в выдаче", OPEN: "исключен из выдачи", HALF_OPEN: "пробная выдача"}
+        return f"{points} мс; ошибок {health.error_rate:.0%}; {states[health.breaker.state]}"
+
+
+health_monitor = HealthMonitor()
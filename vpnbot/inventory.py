@@ -0,0 +1,183 @@
+"""Локальный индекс клиентов панелей 3X-UI.
+
+Задача job_queue по очереди забирает список inbound с каждого сервера и
+обновляет индекс по client_uuid, email и tgId. За один проход обновляются
+только серверы, чей снимок старше REFRESH_INTERVAL, и не больше
+SERVERS_PER_TICK штук, поэтому нагрузка на панели не зависит от трафика
+бота. Выдача и удаление ключей правят индекс сразу, не дожидаясь обновления.
+
+Отсутствие клиента в индексе что-то значит, только если снимок его
+сервера загружен (is_loaded).
+"""
+
+import json
+import logging
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+TICK_INTERVAL = 60
+REFRESH_INTERVAL = 10 * 60
+SERVERS_PER_TICK = 5
+
+UUID_RE = re.compile(r"^vless://([0-9a-fA-F-]{36})@")
+
+
+class PanelClient:
+    __slots__ = ("server_id", "inbound_id", "uuid", "email", "tg_id", "enable", "expiry_time", "up", "down", "total")
+
+    def __init__(self, server_id, inbound_id, uuid, email, tg_id, enable=True, expiry_time=0, up=0, down=0, total=0):
+        self.server_id = server_id
+        self.inbound_id = inbound_id
+        self.uuid = uuid
+        self.email = email
+        self.tg_id = tg_id
+        self.enable = enable
+        self.expiry_time = expiry_time
+        self.up = up
+        self.down = down
+        self.total = total
+
+    @property
+    def used_bytes(self):
+        return (self.up or 0) + (self.down or 0)
+
+
+def parse_inbounds(server_id, inbounds):
+    """Превращает ответ /panel/api/inbounds/list в список PanelClient."""
+    clients = []
+    for inbound in inbounds:
+        try:
+            settings = json.loads(inbound.get("settings") or "{}")
+        except ValueError:
+            logger.warning(f"Некорректные settings у inbound {inbound.get('id')} на сервере {server_id}")
+            continue
+        stats = {stat.get("email"): stat for stat in inbound.get("clientStats") or []}
+        for client in settings.get("clients") or []:
+            uuid = client.get("id")
+            if not uuid:
+                continue
+            email = client.get("email")
+            stat = stats.get(email, {})
+            tg_id = client.get("tgId")
+            clients.append(PanelClient(
+                server_id, inbound.get("id"), uuid, email,
+                int(tg_id) if str(tg_id or "").lstrip("-").isdigit() else None,
+                enable=client.get("enable", True),
+                expiry_time=client.get("expiryTime") or 0,
+                up=stat.get("up", 0), down=stat.get("down", 0), total=client.get("totalGB") or 0,
+            ))
+    return clients
+
+
+class PanelInventory:
+    def __init__(self):
+        self._by_uuid = {}
+        self._by_email = {}
+        self._by_tg_id = {}
+        self._by_server = {}
+        self._loaded_at = {}
+        # uuid -> время, когда выдача добавила клиента в индекс сама
+        self._added_locally = {}
+
+    def __len__(self):
+        return len(self._by_uuid)
+
+    def is_loaded(self, server_id):
+        return server_id in self._loaded_at
+
+    def get(self, client_uuid):
+        return self._by_uuid.get(client_uuid)
+
+    def by_email(self, email):
+        client_uuid = self._by_email.get(email)
+        return self._by_uuid.get(client_uuid) if client_uuid else None
+
+    def by_tg_id(self, tg_id):
+        return [self._by_uuid[client_uuid] for client_uuid in self._by_tg_id.get(tg_id, ())]
+
+    def by_config_link(self, config_link):
+        match = UUID_RE.match(config_link or "")
+        return self.get(match.group(1)) if match else None
+
+    def missing_on_panel(self, server_id, client_uuid):
+        """True, только если снимок сервера загружен и клиента в нем нет."""
+        return self.is_loaded(server_id) and client_uuid not in self._by_server.get(server_id, ())
+
+    def add(self, client, local=False):
+        self.remove(client.uuid)
+        if local:
+            self._added_locally[client.uuid] = time.monotonic()
+        self._by_uuid[client.uuid] = client
+        if client.email:
+            self._by_email[client.email] = client.uuid
+        if client.tg_id is not None:
+            self._by_tg_id.setdefault(client.tg_id, set()).add(client.uuid)
+        self._by_server.setdefault(client.server_id, set()).add(client.uuid)
+
+    def remove(self, client_uuid):
+        self._added_locally.pop(client_uuid, None)
+        client = self._by_uuid.pop(client_uuid, None)
+        if client is None:
+            return
+        if self._by_email.get(client.email) == client_uuid:
+            del self._by_email[client.email]
+        uuids = self._by_tg_id.get(client.tg_id)
+        if uuids is not None:
+            uuids.discard(client_uuid)
+            if not uuids:
+                del self._by_tg_id[client.tg_id]
+        self._by_server.get(client.server_id, set()).discard(client_uuid)
+
+    def replace_server(self, server_id, clients, started_at=None):
+        """Заменяет снимок сервера, трогая только изменившиеся записи.
+
+        Клиенты, добавленные выдачей после started_at (начала запроса к
+        панели), в снимок могли не попасть и не удаляются.
+        """
+        fresh = {client.uuid: client for client in clients}
+        for client_uuid in self._by_server.get(server_id, set()) - fresh.keys():
+            added_at = self._added_locally.get(client_uuid)
+            if started_at is not None and added_at is not None and added_at >= started_at:
+                continue
+            self.remove(client_uuid)
+        for client in fresh.values():
+            self.add(client)
+        self._loaded_at[server_id] = time.monotonic()
+
+    def forget_server(self, server_id):
+        for client_uuid in list(self._by_server.pop(server_id, ())):
+            self.remove(client_uuid)
+        self._loaded_at.pop(server_id, None)
+
+    async def refresh_server(self, xui_clients, server):
+        started_at = time.monotonic()
+        inbounds = await xui_clients.for_server(server).list_inbounds()
+        if inbounds is None:
+            return False
+        clients = parse_inbounds(server['id'], inbounds)
+        self.replace_server(server['id'], clients, started_at)
+        logger.debug(f"Индекс клиентов сервера {server['name']} обновлен: {len(clients)}")
+        return True
+
+    async def refresh_due(self, db, xui_clients, max_servers=SERVERS_PER_TICK, skip_servers=()):
+        """Обновляет самые старые снимки, не больше max_servers за вызов."""
+        servers = await db.fetchall("SELECT * FROM servers")
+        known = {server['id'] for server in servers}
+        for server_id in list(self._loaded_at):
+            if server_id not in known:
+                self.forget_server(server_id)
+
+        now = time.monotonic()
+        due = [
+            server for server in servers
+            if server['id'] not in skip_servers
+            and (server['id'] not in self._loaded_at or now - self._loaded_at[server['id']] >= REFRESH_INTERVAL)
+        ]
+        due.sort(key=lambda server: self._loaded_at.get(server['id'], float("-inf")))
+        for server in due[:max_servers]:
+            await self.refresh_server(xui_clients, server)
+
+
+panel_inventory = PanelInventory()
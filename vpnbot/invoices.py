@@ -0,0 +1,95 @@
+"""Фоновый опрос ожидающих счетов CryptoBot.
+
+Задача job_queue собирает все payments со статусом waiting и запрашивает
+их у CryptoBot пачками по INVOICES_PER_REQUEST через один getInvoices.
+Оплаченные счета обрабатываются параллельно (одновременные выдачи ключей
+на один сервер объединяет ProvisionBatcher), истекшие помечаются expired
+одним запросом. Счета старше срока жизни, которых CryptoBot не вернул,
+тоже закрываются, чтобы выборка waiting не росла.
+
+Пачка, на которую CryptoBot не ответил, остается как есть до следующего
+прохода: иначе оплаченный счет мог бы оказаться закрытым.
+"""
+
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+from vpnbot.cryptobot import INVOICE_EXPIRES_IN
+from vpnbot.revocation import chunked
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 20
+# Когда работает вебхук, опрос только подстраховывает его
+WEBHOOK_FALLBACK_INTERVAL = 5 * 60
+INVOICES_PER_REQUEST = 100
+# Запас на расхождение часов и задержку оплаты на стороне CryptoBot
+EXPIRE_GRACE = timedelta(minutes=5)
+
+WAITING_SQL = "SELECT invoice_id, created_at FROM payments WHERE status = 'waiting' ORDER BY created_at"
+PAYMENT_SQL = "SELECT user_id, tariff_key, amount, payment_type, status FROM payments WHERE invoice_id = ?"
+
+
+class PollReport:
+    def __init__(self):
+        self.waiting = 0
+        self.paid = 0
+        self.expired = 0
+        self.failed_requests = 0
+
+    def __str__(self):
+        return (
+            f"ожидают: {self.waiting}, оплачено: {self.paid}, закрыто: {self.expired}, "
+            f"ошибок запросов: {self.failed_requests}"
+        )
+
+
+def _is_overdue(created_at, cutoff):
+    return created_at is not None and created_at < cutoff
+
+
+async def poll_pending_invoices(db, cryptobot, on_paid, now=None):
+    """Проверяет все ожидающие счета; on_paid(invoice) вызывается для оплаченных."""
+    report = PollReport()
+    rows = await db.fetchall(WAITING_SQL)
+    report.waiting = len(rows)
+    if not rows:
+        return report
+
+    now = now or datetime.now()
+    cutoff = (now - timedelta(seconds=INVOICE_EXPIRES_IN) - EXPIRE_GRACE).strftime('%Y-%m-%d %H:%M:%S')
+    created = {row['invoice_id']: row['created_at'] for row in rows}
+
+    for ids in chunked(list(created), INVOICES_PER_REQUEST):
+        res = await cryptobot.get_invoices(",".join(map(str, ids)), count=len(ids))
+        if not res or not res.get("ok"):
+            logger.error(f"Ошибка пакетной проверки счетов CryptoBot: {res}")
+            report.failed_requests += 1
+            continue
+
+        items = {int(item['invoice_id']): item for item in res["result"]["items"]}
+        paid = [item for item in items.values() if item['status'] == 'paid']
+        expired = [
+            invoice_id for invoice_id in ids
+            if (invoice_id in items and items[invoice_id]['status'] == 'expired')
+            or (invoice_id not in items and _is_overdue(created[invoice_id], cutoff))
+        ]
+
+        results = await asyncio.gather(*(on_paid(item) for item in paid), return_exceptions=True)
+        for item, result in zip(paid, results):
+            if isinstance(result, Exception):
+                logger.error(f"Ошибка обработки оплаченного счета {item['invoice_id']}: {result}")
+            elif result:
+                report.paid += 1
+
+        if expired:
+            await db.executemany(
+                "UPDATE payments SET status = 'expired' WHERE invoice_id = ? AND status = 'waiting'",
+                [(invoice_id,) for invoice_id in expired]
+            )
+            report.expired += len(expired)
+
+    if report.paid or report.expired or report.failed_requests:
+        logger.info(f"Опрос счетов CryptoBot: {report}")
+    return report
@@ -0,0 +1,161 @@
+"""Пул заранее созданных ключей на каждом сервере.
+
+Фоновая задача держит на каждом активном сервере до POOL_SIZE отключенных
+клиентов без срока и лимита (email pool_<...>), записанных в key_pool.
+При покупке клиент забирается из пула одним DELETE ... RETURNING, а срок,
+лимит трафика, email и tgId выставляются одним вызовом updateClient.
+Если пул сервера пуст или панель отклонила обновление, ключ создается как
+раньше через ProvisionBatcher. Отклоненный клиент удаляется с панели, а если
+и это не удалось - возвращается в key_pool, чтобы не остаться на панели без
+записи в базе.
+
+Размер пула задает KEY_POOL_SIZE (0 - пул выключен).
+"""
+
+import logging
+import os
+import time
+import uuid
+from collections import deque
+from datetime import datetime
+
+from vpnbot.batching import provision_batcher
+from vpnbot.inventory import PanelClient, panel_inventory
+from vpnbot.xui import XUI_API, xui_clients
+
+logger = logging.getLogger(__name__)
+
+POOL_SIZE = int(os.getenv("KEY_POOL_SIZE", "5"))
+FILL_INTERVAL = 30
+# Не больше стольких клиентов за один addClient при пополнении
+REFILL_BATCH = 20
+# Окно для расчета скорости пополнения и доли выдач из пула
+METRICS_WINDOW = 60 * 60
+
+CLAIM_SQL = (
+    "DELETE FROM key_pool WHERE id = ("
+    "SELECT id FROM key_pool WHERE server_id = ? AND inbound_id = ? ORDER BY id LIMIT 1"
+    ") RETURNING client_uuid, email, created_at"
+)
+
+
+class KeyPool:
+    def __init__(self, xui_clients, batcher, size=POOL_SIZE):
+        self.xui_clients = xui_clients
+        self.batcher = batcher
+        self.size = size
+        # (время, сервер, число созданных клиентов)
+        self._refills = deque()
+        # (время, True - ключ из пула, False - создан напрямую)
+        self._issues = deque()
+
+    def _trim(self, events):
+        border = time.monotonic() - METRICS_WINDOW
+        while events and events[0][0] < border:
+            events.popleft()
+
+    async def issue(self, db, server, user_id, days, gb):
+        """Выдает ключ из пула или создает новый; возвращает {"uuid", "email"} или None."""
+        if self.size > 0:
+            client = await self._claim(db, server, user_id, days, gb)
+            if client is not None:
+                self._issues.append((time.monotonic(), True))
+                return client
+        self._issues.append((time.monotonic(), False))
+        return await self.batcher.add_client(server, user_id, days, gb)
+
+    async def _claim(self, db, server, user_id, days, gb):
+        inbound_id = server['vless_inbound_id']
+        row = await db.transaction(lambda conn: conn.execute(CLAIM_SQL, (server['id'], inbound_id)).fetchone())
+        if row is None:
+            return None
+
+        now = datetime.now()
+        email = XUI_API.client_email(user_id, now)
+        client = XUI_API.client_settings(row['client_uuid'], email, server['vless_flow'], user_id, days, gb, now=now)
+        api = self.xui_clients.for_server(server)
+        if not await api.update_client(inbound_id, client):
+            logger.warning(f"Не удалось активировать ключ из пула {row['client_uuid']} на сервере {server['name']}")
+            await self._discard(db, api, server, inbound_id, row)
+            return None
+        panel_inventory.add(PanelClient(server['id'], inbound_id, row['client_uuid'], email, user_id), local=True)
+        return {"uuid": row['client_uuid'], "email": email}
+
+    async def _discard(self, db, api, server, inbound_id, row):
+        """Убирает с панели клиент, который не удалось активировать, или возвращает его в пул."""
+        if panel_inventory.missing_on_panel(server['id'], row['client_uuid']):
+            return
+        if await api.delete_client(inbound_id, row['client_uuid']):
+            panel_inventory.remove(row['client_uuid'])
+            return
+        # Панель не ответила: клиент, скорее всего, на ней остался (отключенным)
+        await db.execute(
+            "INSERT INTO key_pool (server_id, inbound_id, client_uuid, email, created_at) VALUES (?, ?, ?, ?, ?)",
+            (server['id'], inbound_id, row['client_uuid'], row['email'], row['created_at'])
+        )
+        logger.warning(f"Ключ {row['client_uuid']} возвращен в пул сервера {server['name']}")
+
+    async def ready_counts(self, db):
+        rows = await db.fetchall("SELECT server_id, COUNT(*) FROM key_pool GROUP BY server_id")
+        return {server_id: count for server_id, count in rows}
+
+    async def refill_server(self, db, server, ready):
+        missing = min(self.size - ready, REFILL_BATCH)
+        if missing <= 0:
+            return 0
+        specs = [
+            {"user_id": None, "days": None, "gb": None, "flow": server['vless_flow'],
+             "email": f"pool_{server['id']}_{uuid.uuid4().hex[:12]}", "enable": False}
+            for _ in range(missing)
+        ]
+        inbound_id = server['vless_inbound_id']
+        results = await self.xui_clients.for_server(server).add_vless_clients(inbound_id, specs)
+        if not results:
+            return 0
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        await db.executemany(
+            "INSERT INTO key_pool (server_id, inbound_id, client_uuid, email, created_at) VALUES (?, ?, ?, ?, ?)",
+            [(server['id'], inbound_id, result['uuid'], result['email'], now) for result in results]
+        )
+        for result in results:
+            panel_inventory.add(PanelClient(server['id'], inbound_id, result['uuid'], result['email'], None, enable=False), local=True)
+        self._refills.append((time.monotonic(), server['id'], len(results)))
+        return len(results)
+
+    async def refill(self, db, skip_servers=()):
+        """Дополняет пулы активных серверов до size."""
+        if self.size <= 0:
+            return 0
+        servers = await db.fetchall("SELECT * FROM servers WHERE is_active = 1")
+        ready = await self.ready_counts(db)
+        created = 0
+        for server in servers:
+            if server['id'] in skip_servers:
+                continue
+            try:
+                created += await self.refill_server(db, server, ready.get(server['id'], 0))
+            except Exception as e:
+                logger.error(f"Ошибка пополнения пула ключей на сервере {server['name']}: {e}")
+        return created
+
+    async def pooled_uuids(self, db, server_id):
+        """UUID клиентов пула сервера; сверка не считает их сиротами."""
+        rows = await db.fetchall("SELECT client_uuid FROM key_pool WHERE server_id = ?", (server_id,))
+        return {row[0] for row in rows}
+
+    async def describe(self, db):
+        """Строка для админской статистики: размер пулов, пополнение, доля выдач из пула."""
+        self._trim(self._refills)
+        self._trim(self._issues)
+        ready = await self.ready_counts(db)
+        refilled = sum(count for _, _, count in self._refills)
+        hits = sum(1 for _, pooled in self._issues if pooled)
+        issued = len(self._issues)
+        hit_rate = f"{hits / issued:.0%}" if issued else "—"
+        return (
+            f"в пулах {sum(ready.values())} ключей на {len(ready)} серверах (цель {self.size} на сервер); "
+            f"создано за час {refilled}; выдано из пула {hit_rate} ({hits} из {issued})"
+        )
+
+
+key_pool = KeyPool(xui_clients, provision_batcher)
@@ -0,0 +1,123 @@
+"""Готовые клавиатуры бота.
+
+Большинство меню не меняются между вызовами или зависят от пары флагов
+(админ ли пользователь, брал ли он пробный период), а строить их заново -
+заметная часть работы самых частых обработчиков: start вызывается каждой
+кнопкой "Назад". KeyboardCache хранит готовые InlineKeyboardMarkup по ключу
+из названия меню и флагов; объекты python-telegram-bot неизменяемы, так что
+одну разметку можно отдавать всем пользователям.
+
+Меню, собранные из bot_texts и tariffs, нужно сбрасывать при изменении этих
+таблиц. Бот сбрасывает кэш сам после своих правок (invalidate), а правки
+веб-панели видит по счетчикам в cache_versions, которые увеличивают
+триггеры на этих таблицах: check() раз в CHECK_INTERVAL секунд сравнивает
+их с последними увиденными.
+
+Процессорное время start на вызов с кэшем и без:
+    python -m vpnbot.keyboards
+"""
+
+import argparse
+import sys
+import time
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.helpers import escape_markdown
+
+CHECK_INTERVAL = 30
+WATCHED_TABLES = ("bot_texts", "tariffs")
+
+
+def main_menu_keyboard(has_used_trial, is_admin):
+    keyboard = [
+        [InlineKeyboardButton("🛒 Купить VPN", callback_data="buy_vpn")],
+    ]
+    # Показываем кнопку триала, если пользователь ее не использовал
+    if not has_used_trial:
+        keyboard.append([InlineKeyboardButton("🚀 Попробовать бесплатно", callback_data="get_trial")])
+
+    keyboard.extend([
+        [InlineKeyboardButton("💰 Баланс", callback_data="balance_menu")],
+        [InlineKeyboardButton("🔑 Мой VPN", callback_data="my_vpn")],
+        [InlineKeyboardButton("📖 Инструкция", callback_data="instructions")],
+        [InlineKeyboardButton("💬 Поддержка", callback_data="support")]
+    ])
+    if is_admin:
+        keyboard.append([InlineKeyboardButton("👑 Админ-панель", callback_data="admin_panel")])
+    return InlineKeyboardMarkup(keyboard)
+
+
+class KeyboardCache:
+    def __init__(self, db):
+        self.db = db
+        self._markups = {}
+        self._versions = None
+        self.hits = 0
+        self.builds = 0
+
+    def get(self, key, build, *args):
+        """Разметка по ключу; при промахе строится вызовом build(*args)."""
+        markup = self._markups.get(key)
+        if markup is not None:
+            self.hits += 1
+            return markup
+        markup = self._markups[key] = build(*args)
+        self.builds += 1
+        return markup
+
+    async def get_async(self, key, build, *args):
+        """То же для меню, которым для сборки нужна база."""
+        markup = self._markups.get(key)
+        if markup is not None:
+            self.hits += 1
+            return markup
+        markup = self._markups[key] = await build(*args)
+        self.builds += 1
+        return markup
+
+    def main_menu(self, has_used_trial, is_admin):
+        has_used_trial, is_admin = bool(has_used_trial), bool(is_admin)
+        return self.get(("main_menu", has_used_trial, is_admin), main_menu_keyboard, has_used_trial, is_admin)
+
+    def invalidate(self):
+        self._markups.clear()
+
+    async def check(self):
+        """Сбрасывает кэш, если bot_texts или tariffs изменились извне; True, если сбросил."""
+        versions = dict(await self.db.fetchall(
+            "SELECT name, version FROM cache_versions WHERE name IN (?, ?)", WATCHED_TABLES
+        ))
+        changed = self._versions is not None and versions != self._versions
+        self._versions = versions
+        if changed:
+            self.invalidate()
+        return changed
+
+    def describe(self):
+        return f"из кэша {self.hits}, собрано {self.builds}, в кэше {len(self._markups)}"
+
+
+START_TEMPLATE = "👋 Привет, {first_name}!\n\nЯ помогу подключить быстрый и надежный VPN."
+
+
+def time_per_call(keyboard, repeat):
+    """Работа start без обращений к базе и Telegram: текст приветствия и клавиатура, мкс."""
+    started = time.perf_counter()
+    for i in range(repeat):
+        START_TEMPLATE.format(first_name=escape_markdown("Иван_Петров"))
+        keyboard(i % 2, i % 3 == 0)
+    return (time.perf_counter() - started) / repeat * 1e6
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Процессорное время обработчика start на вызов")
+    parser.add_argument("--repeat", type=int, default=20000)
+    args = parser.parse_args(argv)
+    cache = KeyboardCache(None)
+    build = time_per_call(main_menu_keyboard, args.repeat)
+    cached = time_per_call(cache.main_menu, args.repeat)
+    print(f"start: сборка клавиатуры {build:.2f} мкс, из кэша {cached:.2f} мкс ({cache.describe()})")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,520 @@
+"""Версионированные миграции схемы vpn_platform.db.
+
+Единственное описание схемы для обоих ботов. Таблицы веб-приложения
+совпадают с server/storage.ts, к ним добавлены таблицы и столбцы бота.
+Все ожидающие шаги применяются в одной транзакции, номер каждого
+записывается в schema_version. При старте выполняется одна проверка
+версии; если схема актуальна, база не трогается.
+
+Пропуск шагов: migrate(path, skip={3}) или переменная окружения
+VPNBOT_SKIP_MIGRATIONS="3,5". Пропущенный шаг отмечается в schema_version
+и больше не предлагается.
+"""
+
+import logging
+import os
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+SKIP_ENV = "VPNBOT_SKIP_MIGRATIONS"
+
+BASE_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        email TEXT UNIQUE,
+        password TEXT,
+        nickname TEXT,
+        telegram_id INTEGER UNIQUE,
+        telegram_username TEXT,
+        telegram_2fa_enabled INTEGER DEFAULT 0,
+        telegram_link_code TEXT,
+        telegram_link_expires_at TEXT,
+        twofactor_challenge_code TEXT,
+        twofactor_challenge_expires_at TEXT,
+        main_balance REAL DEFAULT 0,
+        referral_balance REAL DEFAULT 0,
+        subscription_type TEXT,
+        expires_at TEXT,
+        has_used_trial INTEGER DEFAULT 0,
+        referrer_id INTEGER,
+        is_admin INTEGER DEFAULT 0,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )""",
+    """CREATE TABLE IF NOT EXISTS servers (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        panel_url TEXT NOT NULL,
+        panel_username TEXT NOT NULL,
+        panel_password TEXT NOT NULL,
+        vless_address TEXT NOT NULL,
+        vless_port INTEGER NOT NULL,
+        vless_inbound_id INTEGER NOT NULL,
+        vless_sni TEXT NOT NULL,
+        vless_flow TEXT NOT NULL,
+        vless_public_key TEXT NOT NULL,
+        vless_short_id TEXT NOT NULL,
+        is_active INTEGER DEFAULT 1,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )""",
+    """CREATE TABLE IF NOT EXISTS tariffs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        key TEXT UNIQUE NOT NULL,
+        name TEXT NOT NULL,
+        price REAL NOT NULL,
+        days INTEGER NOT NULL,
+        gb INTEGER NOT NULL,
+        is_active INTEGER DEFAULT 1,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )""",
+    """CREATE TABLE IF NOT EXISTS promocodes (
+        code TEXT PRIMARY KEY,
+        discount_percent INTEGER NOT NULL,
+        max_uses INTEGER NOT NULL,
+        uses_count INTEGER DEFAULT 0,
+        is_active INTEGER DEFAULT 1,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )""",
+    """CREATE TABLE IF NOT EXISTS vpn_profiles (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        server_id INTEGER NOT NULL,
+        config_link TEXT NOT NULL,
+        client_uuid TEXT,
+        inbound_id INTEGER,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users(id),
+        FOREIGN KEY (server_id) REFERENCES servers(id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS referrals (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        referrer_id INTEGER NOT NULL,
+        referred_id INTEGER NOT NULL,
+        bonus_earned REAL DEFAULT 0,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (referrer_id) REFERENCES users(id),
+        FOREIGN KEY (referred_id) REFERENCES users(id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS transactions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        amount REAL NOT NULL,
+        description TEXT NOT NULL,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS site_settings (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL,
+        updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )""",
+    """CREATE TABLE IF NOT EXISTS support_tickets (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        subject TEXT NOT NULL,
+        status TEXT DEFAULT 'open',
+        priority TEXT DEFAULT 'medium',
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS support_messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ticket_id INTEGER NOT NULL,
+        is_admin INTEGER NOT NULL DEFAULT 0,
+        message TEXT NOT NULL,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (ticket_id) REFERENCES support_tickets(id) ON DELETE CASCADE
+    )""",
+    """CREATE TABLE IF NOT EXISTS bot_settings (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL,
+        updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )""",
+    """CREATE TABLE IF NOT EXISTS licenses (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        license_key TEXT UNIQUE NOT NULL,
+        user_id INTEGER NOT NULL,
+        machine_id TEXT,
+        activation_date TEXT,
+        expiration_date TEXT NOT NULL,
+        is_active INTEGER DEFAULT 1,
+        max_activations INTEGER DEFAULT 1,
+        current_activations INTEGER DEFAULT 0,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    )""",
+    # Таблицы бота. payments.user_id и support_threads.user_id - Telegram ID.
+    """CREATE TABLE IF NOT EXISTS payments (
+        invoice_id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        tariff_key TEXT,
+        amount REAL,
+        currency TEXT,
+        status TEXT DEFAULT 'waiting',
+        payment_type TEXT DEFAULT 'subscription'
+    )""",
+    "CREATE TABLE IF NOT EXISTS support_threads (user_id INTEGER PRIMARY KEY, thread_id INTEGER)",
+    "CREATE TABLE IF NOT EXISTS bot_texts (key TEXT PRIMARY KEY, value TEXT)",
+    "CREATE INDEX IF NOT EXISTS idx_users_telegram_id ON users(telegram_id)",
+    "CREATE INDEX IF NOT EXISTS idx_users_email ON users(email)",
+    "CREATE INDEX IF NOT EXISTS idx_vpn_profiles_user_id ON vpn_profiles(user_id)",
+    "CREATE INDEX IF NOT EXISTS idx_referrals_referrer_id ON referrals(referrer_id)",
+    "CREATE INDEX IF NOT EXISTS idx_transactions_user_id ON transactions(user_id)",
+    "CREATE INDEX IF NOT EXISTS idx_support_tickets_user_id ON support_tickets(user_id)",
+    "CREATE INDEX IF NOT EXISTS idx_support_tickets_status ON support_tickets(status)",
+    "CREATE INDEX IF NOT EXISTS idx_support_messages_ticket_id ON support_messages(ticket_id)",
+    "CREATE INDEX IF NOT EXISTS idx_licenses_license_key ON licenses(license_key)",
+    "CREATE INDEX IF NOT EXISTS idx_licenses_user_id ON licenses(user_id)",
+    "CREATE INDEX IF NOT EXISTS idx_licenses_machine_id ON licenses(machine_id)",
+)
+
+# Столбцы, которых может не быть в базах, созданных старыми версиями.
+# ALTER TABLE ... ADD COLUMN не принимает DEFAULT CURRENT_TIMESTAMP,
+# поэтому created_at здесь не добавляется.
+EXTRA_COLUMNS = (
+    ("users", "nickname", "TEXT"),
+    ("users", "telegram_2fa_enabled", "INTEGER DEFAULT 0"),
+    ("users", "telegram_link_code", "TEXT"),
+    ("users", "telegram_link_expires_at", "TEXT"),
+    ("users", "twofactor_challenge_code", "TEXT"),
+    ("users", "twofactor_challenge_expires_at", "TEXT"),
+    ("users", "has_used_trial", "INTEGER DEFAULT 0"),
+    ("users", "referrer_id", "INTEGER"),
+    ("vpn_profiles", "client_uuid", "TEXT"),
+    ("vpn_profiles", "inbound_id", "INTEGER"),
+)
+
+DEFAULT_TARIFFS = (
+    ("1_month", "1 Месяц", 130, 31, 1000),
+    ("3_months", "3 Месяца", 390, 93, 3000),
+    ("12_months", "1 Год", 1000, 366, 12000),
+)
+
+DEFAULT_BOT_TEXTS = {
+    "start_message": "👋 Привет, {first_name}!\nЭто бот для покупки ARMT-VPN.\nУ нас самые выгодные цены, качественные протоколы и огромные скорости.\nПо вопросам обращайтесь в поддержку.\nВыберите действие:",
+    "buy_vpn_header": "Выберите тариф:",
+    "select_payment_method_header": "Выберите способ оплаты:",
+    "sbp_info_text": "Для оплаты по СБП, пожалуйста, нажмите кнопку ниже. Мы создадим для вас тикет, и оператор вышлет реквизиты для оплаты тарифа *{tariff_name}*.",
+    "select_currency_header": "Выберите валюту для оплаты:",
+    "instructions_main": "Здесь вы найдете инструкции по установке и подключению нашего VPN на различных устройствах. Выберите вашу операционную систему:",
+    "instructions_ios": "Инструкция для iOS:\n1. Скачайте приложение v2raytun из App Store.\n2. Скопируйте ключ доступа или отсканируйте QR-код.\n3. Откройте v2raytun и добавьте сервер.\n4. Нажмите 'Подключить'. Готово!",
+    "instructions_android": "Инструкция для Android:\n1. Скачайте приложение v2rayNG из Google Play.\n2. Скопируйте ключ доступа или отсканируйте QR-код.\n3. Откройте v2rayNG и добавьте сервер.\n4. Нажмите 'Подключить'. Готово!",
+    "instructions_windows": "Инструкция для Windows:\n1. Скачайте клиент v2rayN.\n2. Скопируйте ключ доступа.\n3. Откройте v2rayN и добавьте сервер.\n4. Нажмите 'Подключить'. Готово!",
+    "instructions_macos": "Инструкция для macOS:\n1. Скачайте клиент v2rayU или V2Box.\n2. Скопируйте ключ доступа.\n3. Добавьте сервер в клиент.\n4. Нажмите 'Подключить'. Готово!",
+    "referral_message": "🤝 **Реферальная система**\n\nПриглашайте друзей и получайте *10%* с каждой их покупки на свой реферальный баланс!\n\n💰 Ваш реферальный баланс: *{balance}* ₽\n👥 Приглашено пользователей: *{count}*\n\n🔗 Ваша реферальная ссылка для приглашения:\n`{link}`",
+    "balance_menu_text": "💰 **Ваш баланс**\n\nОсновной баланс: *{main_balance:.2f} ₽*\nРеферальный баланс: *{ref_balance:.2f} ₽*\n\nОбщий доступный баланс для оплаты: **{total_balance:.2f} ₽**",
+}
+
+
+def table_columns(conn, table):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def add_column(conn, table, column, definition):
+    if column not in table_columns(conn, table):
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+def is_legacy_bot_schema(conn):
+    """Старая схема бота: users с user_id (Telegram ID) вместо telegram_id."""
+    columns = table_columns(conn, "users")
+    return "user_id" in columns and "telegram_id" not in columns
+
+
+def migration_1_set_aside_legacy_bot_tables(conn):
+    """Переименовывает таблицы старой схемы бота, чтобы создать на их месте общие."""
+    if not is_legacy_bot_schema(conn):
+        return
+    for table in ("users", "vpn_profiles", "referrals"):
+        if table_columns(conn, table):
+            conn.execute(f"ALTER TABLE {table} RENAME TO legacy_{table}")
+    # У бота support_tickets хранила только привязку пользователя к теме группы
+    if table_columns(conn, "support_tickets") == {"user_id", "thread_id"}:
+        conn.execute("ALTER TABLE support_tickets RENAME TO support_threads")
+
+
+def migration_2_base_schema(conn):
+    for statement in BASE_SCHEMA:
+        conn.execute(statement)
+    for table, column, definition in EXTRA_COLUMNS:
+        add_column(conn, table, column, definition)
+
+
+def migration_3_copy_legacy_bot_data(conn):
+    """Переносит пользователей, профили и рефералов из legacy_* в общие таблицы.
+
+    В старой схеме все ссылки на пользователя - Telegram ID, в общей -
+    users.id.
+    """
+    if not table_columns(conn, "legacy_users"):
+        return
+    conn.execute(
+        "INSERT OR IGNORE INTO users (telegram_id, telegram_username, subscription_type, expires_at, "
+        "referral_balance, main_balance, has_used_trial) "
+        "SELECT user_id, username, subscription_type, expires_at, "
+        "COALESCE(referral_balance, 0), COALESCE(main_balance, 0), COALESCE(has_used_trial, 0) FROM legacy_users"
+    )
+    conn.execute(
+        "UPDATE users SET referrer_id = ("
+        " SELECT r.id FROM legacy_users l JOIN users r ON r.telegram_id = l.referrer_id"
+        " WHERE l.user_id = users.telegram_id"
+        ") WHERE referrer_id IS NULL AND telegram_id IN (SELECT user_id FROM legacy_users WHERE referrer_id IS NOT NULL)"
+    )
+    if table_columns(conn, "legacy_vpn_profiles"):
+        conn.execute(
+            "INSERT INTO vpn_profiles (user_id, server_id, config_link, client_uuid, inbound_id, created_at) "
+            "SELECT u.id, p.server_id, p.config_link, p.client_uuid, p.inbound_id, p.created_at "
+            "FROM legacy_vpn_profiles p JOIN users u ON u.telegram_id = p.assigned_to_user_id"
+        )
+        conn.execute("DROP TABLE legacy_vpn_profiles")
+    if table_columns(conn, "legacy_referrals"):
+        conn.execute(
+            "INSERT INTO referrals (referrer_id, referred_id, created_at) "
+            "SELECT r.id, u.id, COALESCE(l.created_at, CURRENT_TIMESTAMP) FROM legacy_referrals l "
+            "JOIN users r ON r.telegram_id = l.referrer_id JOIN users u ON u.telegram_id = l.referred_id"
+        )
+        conn.execute("DROP TABLE legacy_referrals")
+    conn.execute("DROP TABLE legacy_users")
+
+
+def migration_4_seed_defaults(conn):
+    if conn.execute("SELECT COUNT(*) FROM tariffs").fetchone()[0] == 0:
+        conn.executemany("INSERT INTO tariffs (key, name, price, days, gb) VALUES (?, ?, ?, ?, ?)", DEFAULT_TARIFFS)
+    conn.executemany("INSERT OR IGNORE INTO bot_texts (key, value) VALUES (?, ?)", DEFAULT_BOT_TEXTS.items())
+
+
+def migration_5_hot_lookup_indexes(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vpn_profiles_config_link ON vpn_profiles (config_link)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_support_threads_thread_id ON support_threads (thread_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_expires_at ON users (expires_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_telegram_username ON users (telegram_username)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_payments_user_status ON payments (user_id, status)")
+
+
+def migration_6_server_allocator(conn):
+    """Вес емкости серверов вместо индекса round-robin в bot_texts."""
+    add_column(conn, "servers", "capacity_weight", "REAL DEFAULT 1")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vpn_profiles_server_id ON vpn_profiles (server_id)")
+    conn.execute("DELETE FROM bot_texts WHERE key = 'last_used_server_index'")
+
+
+def migration_7_reconcile_index(conn):
+    """Постраничное чтение профилей сервера в порядке client_uuid для сверки с панелями.
+
+    Индекс по (server_id, client_uuid) покрывает и выборки по server_id,
+    поэтому индекс из миграции 6 больше не нужен.
+    """
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vpn_profiles_server_uuid ON vpn_profiles (server_id, client_uuid)")
+    conn.execute("DROP INDEX IF EXISTS idx_vpn_profiles_server_id")
+
+
+def migration_8_payment_created_at(conn):
+    """Время создания счета, чтобы опрос CryptoBot мог закрывать просроченные."""
+    add_column(conn, "payments", "created_at", "TEXT")
+    # Для уже ожидающих счетов отсчитываем срок от момента миграции
+    conn.execute("UPDATE payments SET created_at = datetime('now', 'localtime') WHERE created_at IS NULL")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_payments_status_created ON payments (status, created_at)")
+
+
+def migration_9_provisioning_outbox(conn):
+    """Очередь выдачи ключей: пишется в одной транзакции с оплатой."""
+    conn.execute("""CREATE TABLE IF NOT EXISTS provisioning_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        idempotency_key TEXT NOT NULL UNIQUE,
+        kind TEXT NOT NULL DEFAULT 'subscription',
+        user_id INTEGER NOT NULL,
+        tariff_key TEXT,
+        amount REAL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at TEXT,
+        locked_until TEXT,
+        last_error TEXT,
+        result TEXT,
+        created_at TEXT,
+        updated_at TEXT
+    )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_provisioning_jobs_due ON provisioning_jobs (status, next_attempt_at)")
+
+
+def migration_10_provisioning_payload(conn):
+    """Данные задачи выдачи, нужные для ее завершения или отката (JSON)."""
+    add_column(conn, "provisioning_jobs", "payload", "TEXT")
+
+
+def migration_11_key_pool(conn):
+    """Заранее созданные отключенные клиенты панелей для мгновенной выдачи."""
+    conn.execute("""CREATE TABLE IF NOT EXISTS key_pool (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        server_id INTEGER NOT NULL,
+        inbound_id INTEGER NOT NULL,
+        client_uuid TEXT NOT NULL UNIQUE,
+        email TEXT NOT NULL,
+        created_at TEXT,
+        FOREIGN KEY (server_id) REFERENCES servers(id)
+    )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_key_pool_server_inbound ON key_pool (server_id, inbound_id)")
+
+
+def migration_12_broadcasts(conn):
+    """Рассылки с курсором по telegram_id, чтобы продолжать их после перезапуска."""
+    conn.execute("""CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT NOT NULL,
+        parse_mode TEXT,
+        status TEXT NOT NULL DEFAULT 'pending',
+        created_by INTEGER,
+        progress_chat_id INTEGER,
+        progress_message_id INTEGER,
+        cursor INTEGER NOT NULL DEFAULT 0,
+        total INTEGER NOT NULL DEFAULT 0,
+        sent INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        created_at TEXT,
+        started_at TEXT,
+        finished_at TEXT
+    )""")
+
+
+def migration_13_delivery_status(conn):
+    """Пользователи, заблокировавшие бота или удалившие аккаунт, для пропуска в рассылках."""
+    add_column(conn, "users", "delivery_status", "TEXT")
+    add_column(conn, "users", "delivery_failed_at", "TEXT")
+    # Недоступных немного, частичный индекс нужен только админ-панели
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_users_delivery_status ON users (delivery_status) WHERE delivery_status IS NOT NULL"
+    )
+
+
+def migration_14_subscription_reminders(conn):
+    """Какие напоминания уже отправлены по каждому сроку подписки.
+
+    Ключ начинается с expires_at: по нему же удаляются устаревшие отметки.
+    """
+    conn.execute("""CREATE TABLE IF NOT EXISTS subscription_reminders (
+        expires_at TEXT NOT NULL,
+        telegram_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        sent_at TEXT,
+        PRIMARY KEY (expires_at, telegram_id, kind)
+    ) WITHOUT ROWID""")
+
+
+def migration_15_qr_codes(conn):
+    """file_id загруженных в Telegram QR-кодов по sha256 ссылки."""
+    conn.execute("""CREATE TABLE IF NOT EXISTS qr_codes (
+        link_hash TEXT PRIMARY KEY,
+        file_id TEXT NOT NULL,
+        created_at TEXT
+    ) WITHOUT ROWID""")
+
+
+def migration_16_cache_versions(conn):
+    """Счетчики изменений bot_texts и tariffs для сброса кэшей бота.
+
+    Тарифы меняет и веб-панель, поэтому счетчик ведут триггеры, а не код бота.
+    """
+    conn.execute("""CREATE TABLE IF NOT EXISTS cache_versions (
+        name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID""")
+    for table in ("bot_texts", "tariffs"):
+        conn.execute("INSERT OR IGNORE INTO cache_versions (name) VALUES (?)", (table,))
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            conn.execute(
+                f"CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()}_version AFTER {event} ON {table} "
+                f"BEGIN UPDATE cache_versions SET version = version + 1 WHERE name = '{table}'; END"
+            )
+
+
+def migration_17_pending_revoke(conn):
+    """Профили отозванных подписок, которые еще не удалось удалить с панели."""
+    add_column(conn, "vpn_profiles", "pending_revoke", "INTEGER NOT NULL DEFAULT 0")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_vpn_profiles_pending_revoke ON vpn_profiles (server_id) WHERE pending_revoke = 1"
+    )
+
+
+MIGRATIONS = [
+    (1, "Старые таблицы бота переименованы в legacy_*", migration_1_set_aside_legacy_bot_tables),
+    (2, "Общая схема бота и веб-приложения", migration_2_base_schema),
+    (3, "Перенос данных из старой схемы бота", migration_3_copy_legacy_bot_data),
+    (4, "Тарифы и тексты бота по умолчанию", migration_4_seed_defaults),
+    (5, "Индексы для горячих запросов бота", migration_5_hot_lookup_indexes),
+    (6, "Вес емкости серверов для выбора наименее загруженного", migration_6_server_allocator),
+    (7, "Индекс профилей по серверу и UUID клиента", migration_7_reconcile_index),
+    (8, "Время создания счетов для фонового опроса CryptoBot", migration_8_payment_created_at),
+    (9, "Очередь выдачи ключей (outbox)", migration_9_provisioning_outbox),
+    (10, "Данные задач выдачи ключей", migration_10_provisioning_payload),
+    (11, "Пул заранее созданных ключей", migration_11_key_pool),
+    (12, "Рассылки", migration_12_broadcasts),
+    (13, "Статус доставки сообщений пользователю", migration_13_delivery_status),
+    (14, "Отправленные напоминания об окончании подписки", migration_14_subscription_reminders),
+    (15, "Кэш QR-кодов в Telegram", migration_15_qr_codes),
+    (16, "Счетчики изменений текстов и тарифов", migration_16_cache_versions),
+    (17, "Незавершенный отзыв ключей на панелях", migration_17_pending_revoke),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(conn):
+    try:
+        return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+    except sqlite3.OperationalError:
+        return 0
+
+
+def skipped_from_env():
+    value = os.getenv(SKIP_ENV, "")
+    return {int(part) for part in value.split(",") if part.strip()}
+
+
+def apply_migrations(conn, skip=()):
+    """Применяет ожидающие миграции в одной транзакции.
+
+    Соединение должно быть в режиме autocommit (isolation_level=None).
+    Возвращает список примененных номеров.
+    """
+    if current_version(conn) >= LATEST_VERSION:
+        return []
+    applied = []
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, description TEXT, "
+            "skipped INTEGER DEFAULT 0, applied_at TEXT DEFAULT CURRENT_TIMESTAMP)"
+        )
+        # Версию перечитываем под блокировкой записи: второй процесс мог
+        # успеть применить миграции, пока мы ждали BEGIN IMMEDIATE.
+        version = current_version(conn)
+        for number, description, step in MIGRATIONS:
+            if number <= version:
+                continue
+            if number in skip:
+                logger.warning(f"Миграция {number} пропущена: {description}")
+            else:
+                step(conn)
+                applied.append(number)
+            conn.execute(
+                "INSERT INTO schema_version (version, description, skipped) VALUES (?, ?, ?)",
+                (number, description, int(number in skip))
+            )
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+    for number in applied:
+        logger.info(f"Применена миграция {number}")
+    return applied
+
+
+def migrate(db_path, skip=None):
+    """Приводит схему базы к последней версии. Вызывается один раз при старте."""
+    if skip is None:
+        skip = skipped_from_env()
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        return apply_migrations(conn, skip)
+    finally:
+        conn.close()
@@ -0,0 +1,198 @@
+"""Общий планировщик исходящих запросов к Bot API.
+
+Подключается через ApplicationBuilder().rate_limiter(...), поэтому через
+него проходят все вызовы бота, кроме getUpdates. Класс запроса задается
+аргументом rate_limit_args метода бота:
+
+    await bot.send_message(chat_id, text, rate_limit_args=BULK)
+
+Без него запрос считается INTERACTIVE (ответ на действие пользователя).
+Общий бюджет - RATE запросов в секунду; свободный токен достается первому
+ждущему запросу самого срочного класса. Массовые отправки (BULK) сверх того
+ограничены долей BULK_SHARE бюджета, так что у ответов пользователям всегда
+остается запас. В группы - не больше GROUP_RATE сообщений в минуту на чат.
+
+RetryAfter останавливает все отправки на указанное Telegram время, после
+чего запрос повторяется до MAX_RETRIES раз. Об отказах отправки в личный
+чат, которые не пройдут и при повторе (vpnbot.delivery), сообщается
+on_unreachable(chat_id, status).
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from vpnbot.delivery import unreachable_status
+from vpnbot.outbox import StageTimings
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = 0
+TRANSACTIONAL = 1
+BULK = 2
+PRIORITY_NAMES = {INTERACTIVE: "interactive", TRANSACTIONAL: "transactional", BULK: "bulk"}
+
+RATE = float(os.getenv("OUTBOUND_RATE", "30"))
+BULK_SHARE = float(os.getenv("OUTBOUND_BULK_SHARE", "0.9"))
+GROUP_RATE = 20
+# Переписка в группе поддержки идет пачками; редкий RetryAfter дешевле задержки
+GROUP_BURST = 5
+MAX_RETRIES = 3
+# Запас токенов в секундах лимита: небольшой, чтобы после простоя не
+# отправить за секунду заметно больше RATE
+BURST_SECONDS = 0.1
+
+
+class RateBucket:
+    """Токены пополняются со скоростью rate в секунду, копятся не больше burst."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(rate * BURST_SECONDS, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now):
+        if now > self._updated:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    def delay(self, now):
+        """Сколько ждать до следующего токена."""
+        self._refill(now)
+        return 0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    def take(self, now):
+        """Забирает токен, при нехватке - в долг; возвращает время ожидания своей очереди."""
+        self._refill(now)
+        self._tokens -= 1
+        return 0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def drain(self, until):
+        """Обнуляет запас до момента until (после паузы от Telegram)."""
+        self._tokens = 0
+        self._updated = max(self._updated, until)
+
+
+class OutboundScheduler(BaseRateLimiter):
+    def __init__(self, rate=RATE, bulk_share=BULK_SHARE, group_rate=GROUP_RATE, max_retries=MAX_RETRIES,
+                 on_unreachable=None):
+        self.rate = rate
+        self.on_unreachable = on_unreachable
+        self.max_retries = max_retries
+        self.group_rate = group_rate
+        self._bucket = RateBucket(rate)
+        self._class_buckets = {BULK: RateBucket(rate * bulk_share)}
+        self._group_buckets = {}
+        self._queues = {priority: deque() for priority in PRIORITY_NAMES}
+        self._paused_until = 0
+        self._wakeup = asyncio.Event()
+        self._dispatcher = None
+        self.flood_waits = 0
+        self.stats = StageTimings()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+
+    def pause(self, seconds):
+        until = time.monotonic() + seconds
+        if until > self._paused_until:
+            self._paused_until = until
+            self._bucket.drain(until)
+            for bucket in self._class_buckets.values():
+                bucket.drain(until)
+
+    def depth(self):
+        return {PRIORITY_NAMES[priority]: len(queue) for priority, queue in self._queues.items()}
+
+    def describe(self):
+        """Строка для админской статистики: очереди и время ожидания по классам."""
+        depth = ", ".join(f"{name} {count}" for name, count in self.depth().items())
+        return f"в очереди: {depth}; пауз по флуд-лимиту: {self.flood_waits}\n{self.stats.describe()}"
+
+    async def _acquire(self, priority):
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.get_running_loop().create_task(self._dispatch())
+        future = asyncio.get_running_loop().create_future()
+        self._queues[priority].append((time.monotonic(), future))
+        self._wakeup.set()
+        await future
+
+    def _grant(self, now):
+        """Выдает токен первому запросу самого срочного класса; иначе возвращает время ожидания."""
+        if now < self._paused_until:
+            return self._paused_until - now
+        wait = None
+        for priority, queue in self._queues.items():
+            # Запросы, отмененные во время ожидания, пропускаем
+            while queue and queue[0][1].done():
+                queue.popleft()
+            if not queue:
+                continue
+            delay = self._bucket.delay(now)
+            class_bucket = self._class_buckets.get(priority)
+            if class_bucket is not None:
+                delay = max(delay, class_bucket.delay(now))
+            if delay <= 0:
+                self._bucket.take(now)
+                if class_bucket is not None:
+                    class_bucket.take(now)
+                enqueued, future = queue.popleft()
+                self.stats.record(PRIORITY_NAMES[priority], now - enqueued)
+                future.set_result(None)
+                return 0
+            wait = delay if wait is None else min(wait, delay)
+        return wait
+
+    async def _dispatch(self):
+        while True:
+            self._wakeup.clear()
+            wait = self._grant(time.monotonic())
+            if wait == 0:
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _wait_group(self, chat_id):
+        bucket = self._group_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._group_buckets[chat_id] = RateBucket(self.group_rate / 60, GROUP_BURST)
+        delay = bucket.take(time.monotonic())
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = rate_limit_args if rate_limit_args in PRIORITY_NAMES else INTERACTIVE
+        chat_id = data.get("chat_id")
+        is_group = isinstance(chat_id, str) or (isinstance(chat_id, int) and chat_id < 0)
+        for attempt in range(self.max_retries + 1):
+            if is_group and endpoint.startswith("send"):
+                await self._wait_group(chat_id)
+            await self._acquire(priority)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self.flood_waits += 1
+                self.pause(e.retry_after)
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f"Флуд-лимит Telegram на {endpoint}, пауза {e.retry_after} с")
+            except (Forbidden, BadRequest) as e:
+                if self.on_unreachable is not None and isinstance(chat_id, int) and chat_id > 0 and endpoint.startswith("send"):
+                    status = unreachable_status(e)
+                    if status is not None:
+                        await self.on_unreachable(chat_id, status)
+                raise
@@ -0,0 +1,254 @@
+"""Очередь выдачи ключей (transactional outbox).
+
+Задача выдачи записывается в provisioning_jobs в той же транзакции, что и
+смена статуса оплаты, поэтому оплата не теряется при падении бота между
+ними. idempotency_key уникален (например, invoice:<id>), и повторная
+постановка той же оплаты ничего не добавляет.
+
+Обработчики забирают задачи арендой на LEASE секунд; номер попытки служит
+маркером владельца. Обработчик отмечает задачу выполненной через
+complete_in_transaction в той же транзакции, что и запись профиля, так что
+профиль по одной задаче создается ровно один раз, даже если аренда
+истекла и задачу подхватил другой обработчик. Ошибки повторяются с
+экспоненциальной задержкой, после MAX_ATTEMPTS задача помечается failed;
+on_failed_in_transaction выполняется в той же транзакции (например, возврат
+средств), а on_failed - уже после нее (уведомления).
+
+provisioning_stats собирает длительность этапов выдачи (ожидание в
+очереди, панель, запись в базу, доставка ключа) для админской статистики.
+"""
+
+import asyncio
+import json
+import logging
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+WORKERS = 4
+POLL_INTERVAL = 5
+LEASE = 120
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 10
+BACKOFF_MAX = 10 * 60
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+CLAIM_SQL = (
+    "UPDATE provisioning_jobs SET status = 'running', attempts = attempts + 1, locked_until = ?, updated_at = ? "
+    "WHERE id = (SELECT id FROM provisioning_jobs "
+    "            WHERE (status = 'pending' AND next_attempt_at <= ?) OR (status = 'running' AND locked_until < ?) "
+    "            ORDER BY next_attempt_at LIMIT 1) "
+    "RETURNING *"
+)
+
+
+class JobAbandoned(Exception):
+    """Аренда задачи истекла, и ее уже выполняет другой обработчик."""
+
+
+def _fmt(dt):
+    return dt.strftime(DATE_FORMAT)
+
+
+class StageTimings:
+    """Последние STAGE_SAMPLES замеров по каждому этапу выдачи."""
+
+    STAGE_SAMPLES = 200
+
+    def __init__(self):
+        self._samples = defaultdict(lambda: deque(maxlen=self.STAGE_SAMPLES))
+
+    def record(self, stage, seconds):
+        self._samples[stage].append(seconds)
+
+    @contextmanager
+    def measure(self, stage):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(stage, time.monotonic() - started)
+
+    def summary(self):
+        """stage -> (число замеров, среднее, p95) в секундах."""
+        result = {}
+        for stage, samples in self._samples.items():
+            if samples:
+                ordered = sorted(samples)
+                p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+                result[stage] = (len(ordered), sum(ordered) / len(ordered), p95)
+        return result
+
+    def describe(self):
+        lines = [
+            f"{stage}: среднее {avg:.2f} с, p95 {p95:.2f} с ({count})"
+            for stage, (count, avg, p95) in self.summary().items()
+        ]
+        return "\n".join(lines) or "замеров еще нет"
+
+
+provisioning_stats = StageTimings()
+
+
+def enqueue(conn, idempotency_key, user_id, tariff_key, amount=None, kind="subscription", payload=None, now=None):
+    """Ставит задачу в очередь внутри транзакции вызывающего. False, если такая уже есть."""
+    now = _fmt(now or datetime.now())
+    cursor = conn.execute(
+        "INSERT OR IGNORE INTO provisioning_jobs "
+        "(idempotency_key, kind, user_id, tariff_key, amount, payload, next_attempt_at, created_at, updated_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (idempotency_key, kind, user_id, tariff_key, amount,
+         json.dumps(payload) if payload is not None else None, now, now, now)
+    )
+    return cursor.rowcount > 0
+
+
+def job_payload(job):
+    return json.loads(job['payload']) if job['payload'] else {}
+
+
+def complete_in_transaction(conn, job, result=None):
+    """Отмечает задачу выполненной; вызывается в транзакции, записывающей результат.
+
+    Бросает JobAbandoned (и тем откатывает транзакцию), если задача уже не
+    принадлежит этой попытке.
+    """
+    cursor = conn.execute(
+        "UPDATE provisioning_jobs SET status = 'done', result = ?, locked_until = NULL, updated_at = ? "
+        "WHERE id = ? AND status = 'running' AND attempts = ?",
+        (result, _fmt(datetime.now()), job['id'], job['attempts'])
+    )
+    if cursor.rowcount == 0:
+        raise JobAbandoned(f"Задача {job['idempotency_key']} уже выполняется другим обработчиком")
+
+
+def backoff(attempts):
+    return min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX)
+
+
+class OutboxWorker:
+    """Пул обработчиков provisioning_jobs.
+
+    handler(job) выполняет задачу и должен вызвать complete_in_transaction;
+    исключение или возврат без завершения означает неудачу и повтор.
+    Когда попытки исчерпаны, on_failed_in_transaction(conn, job) вызывается
+    в транзакции, помечающей задачу failed, а on_failed(job, error) - после нее.
+    """
+
+    def __init__(self, db, handler, on_failed=None, on_failed_in_transaction=None, workers=WORKERS,
+                 poll_interval=POLL_INTERVAL, lease=LEASE, stats=provisioning_stats):
+        self.db = db
+        self.handler = handler
+        self.on_failed = on_failed
+        self.on_failed_in_transaction = on_failed_in_transaction
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.stats = stats
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+        self._stopping = False
+
+    def notify(self):
+        """Будит обработчики сразу после постановки задачи."""
+        self._wakeup.set()
+
+    def start(self):
+        self._stopping = False
+        self._tasks = [asyncio.get_running_loop().create_task(self._run()) for _ in range(self.workers)]
+
+    async def stop(self):
+        self._stopping = True
+        self._wakeup.set()
+        # Начатые задачи доделываем, новых не берем
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def depth(self):
+        """Число задач по статусам: pending, running, failed."""
+        rows = await self.db.fetchall(
+            "SELECT status, COUNT(*) FROM provisioning_jobs WHERE status IN ('pending', 'running', 'failed') GROUP BY status"
+        )
+        depth = {"pending": 0, "running": 0, "failed": 0}
+        depth.update({status: count for status, count in rows})
+        return depth
+
+    async def _claim(self):
+        def claim(conn):
+            now = datetime.now()
+            return conn.execute(
+                CLAIM_SQL,
+                (_fmt(now + timedelta(seconds=self.lease)), _fmt(now), _fmt(now), _fmt(now))
+            ).fetchone()
+
+        return await self.db.transaction(claim)
+
+    async def _fail(self, job, error):
+        now = datetime.now()
+        failed = job['attempts'] >= MAX_ATTEMPTS
+        next_attempt = _fmt(now + timedelta(seconds=backoff(job['attempts'])))
+
+        def mark(conn):
+            cursor = conn.execute(
+                "UPDATE provisioning_jobs SET status = ?, next_attempt_at = ?, locked_until = NULL, last_error = ?, updated_at = ? "
+                "WHERE id = ? AND status = 'running' AND attempts = ?",
+                ("failed" if failed else "pending", next_attempt, error, _fmt(now), job['id'], job['attempts'])
+            )
+            if cursor.rowcount and failed and self.on_failed_in_transaction is not None:
+                self.on_failed_in_transaction(conn, job)
+            return cursor.rowcount
+
+        try:
+            updated = await self.db.transaction(mark)
+        except Exception as e:
+            # Аренда истечет, и задачу подхватят снова
+            logger.error(f"Не удалось записать неудачу задачи {job['idempotency_key']}: {e}")
+            return
+        if not updated:
+            return
+        if failed:
+            logger.critical(f"Задача выдачи {job['idempotency_key']} не выполнена после {job['attempts']} попыток: {error}")
+            if self.on_failed is not None:
+                try:
+                    await self.on_failed(job, error)
+                except Exception as e:
+                    logger.error(f"Ошибка обработки проваленной задачи {job['idempotency_key']}: {e}")
+        else:
+            logger.warning(f"Задача выдачи {job['idempotency_key']}, попытка {job['attempts']}: {error}. Повтор в {next_attempt}")
+
+    async def _execute(self, job):
+        due = datetime.strptime(job['next_attempt_at'], DATE_FORMAT)
+        self.stats.record("queue", max((datetime.now() - due).total_seconds(), 0))
+        try:
+            with self.stats.measure("total"):
+                await self.handler(job)
+        except JobAbandoned as e:
+            logger.warning(str(e))
+            return
+        except Exception as e:
+            await self._fail(job, f"{type(e).__name__}: {e}")
+            return
+        status = await self.db.fetchval("SELECT status FROM provisioning_jobs WHERE id = ?", (job['id'],))
+        if status == 'running':
+            await self._fail(job, "обработчик не завершил задачу")
+
+    async def _run(self):
+        while not self._stopping:
+            # Сбрасываем до выборки, чтобы не потерять notify, пришедший во время нее
+            self._wakeup.clear()
+            try:
+                job = await self._claim()
+            except Exception as e:
+                logger.error(f"Ошибка чтения очереди выдачи: {e}")
+                job = None
+            if job is not None:
+                await self._execute(job)
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
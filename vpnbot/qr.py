@@ -0,0 +1,184 @@
+"""QR-коды ключей подключения.
+
+Картинка зависит только от ссылки, поэтому рисуется один раз: PNG хранится
+в памяти (последние MEMORY_ITEMS) и на диске в CACHE_DIR, а file_id фото
+после первой загрузки в Telegram записывается в таблицу qr_codes. Повторный
+показ отправляет фото по file_id - без отрисовки и без загрузки файла.
+Отрисовка (qrcode + Pillow) идет в пуле потоков, а не в цикле событий.
+
+Файлы и записи называются sha256 от ссылки: в ней лежит ключ клиента.
+По той же причине при отзыве ключа его QR-код удаляется (evict), а prune
+убирает с диска файлы старше MAX_AGE и самые старые сверх MAX_FILES.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from io import BytesIO
+
+import qrcode
+from telegram.error import BadRequest
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.getenv("QR_CACHE_DIR", "qr_cache")
+MEMORY_ITEMS = 256
+RENDER_WORKERS = 2
+MAX_AGE = 30 * 24 * 60 * 60
+MAX_FILES = 5000
+
+
+def cache_key(link):
+    return hashlib.sha256(link.encode()).hexdigest()
+
+
+def render_png(link):
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_M,
+        box_size=10,
+        border=4,
+    )
+    qr.add_data(link)
+    qr.make(fit=True)
+    img = qr.make_image(fill_color="black", back_color="white")
+    bio = BytesIO()
+    img.save(bio, 'PNG')
+    return bio.getvalue()
+
+
+class QrCache:
+    def __init__(self, db, directory=CACHE_DIR, memory_items=MEMORY_ITEMS, workers=RENDER_WORKERS):
+        self.db = db
+        self.directory = directory
+        self.memory_items = memory_items
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="qr")
+        self._png = OrderedDict()
+        # Одновременные запросы одной ссылки ждут одну отрисовку
+        self._rendering = {}
+        self.hits = {"file_id": 0, "memory": 0, "disk": 0, "render": 0}
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.png")
+
+    def _remember_png(self, key, png):
+        self._png[key] = png
+        self._png.move_to_end(key)
+        while len(self._png) > self.memory_items:
+            self._png.popitem(last=False)
+
+    def _read_disk(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _write_disk(self, key, png):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = self._path(key) + ".tmp"
+        with open(tmp, 'wb') as f:
+            f.write(png)
+        os.replace(tmp, self._path(key))
+
+    async def png(self, link, key=None):
+        """PNG с QR-кодом ссылки: из памяти, с диска или новая отрисовка."""
+        key = key or cache_key(link)
+        png = self._png.get(key)
+        if png is not None:
+            self._png.move_to_end(key)
+            self.hits["memory"] += 1
+            return png
+        pending = self._rendering.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        pending = self._rendering[key] = asyncio.get_running_loop().create_task(self._load(link, key))
+        return await asyncio.shield(pending)
+
+    async def _load(self, link, key):
+        loop = asyncio.get_running_loop()
+        try:
+            png = await loop.run_in_executor(self._executor, self._read_disk, key)
+            if png is not None:
+                self.hits["disk"] += 1
+            else:
+                png = await loop.run_in_executor(self._executor, render_png, link)
+                self.hits["render"] += 1
+                try:
+                    await loop.run_in_executor(self._executor, self._write_disk, key, png)
+                except OSError as e:
+                    logger.warning(f"Не удалось сохранить QR-код на диск: {e}")
+            self._remember_png(key, png)
+            return png
+        finally:
+            self._rendering.pop(key, None)
+
+    async def reply(self, message, link, **kwargs):
+        """Отправляет QR-код ссылки ответом на message; kwargs - как у reply_photo."""
+        key = cache_key(link)
+        file_id = await self.db.fetchval("SELECT file_id FROM qr_codes WHERE link_hash = ?", (key,))
+        if file_id:
+            try:
+                sent = await message.reply_photo(photo=file_id, **kwargs)
+                self.hits["file_id"] += 1
+                return sent
+            except BadRequest as e:
+                # file_id устарел (например, сменился токен бота) - загрузим заново
+                logger.warning(f"QR-код по file_id не отправлен, загружаем файл: {e}")
+
+        sent = await message.reply_photo(photo=await self.png(link, key), **kwargs)
+        if sent.photo:
+            await self.db.execute(
+                "INSERT OR REPLACE INTO qr_codes (link_hash, file_id, created_at) VALUES (?, ?, ?)",
+                (key, sent.photo[-1].file_id, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+            )
+        return sent
+
+    def _remove_disk(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    async def evict(self, link):
+        """Забывает QR-код ссылки: в памяти, на диске и file_id в qr_codes."""
+        key = cache_key(link)
+        self._png.pop(key, None)
+        await self.db.execute("DELETE FROM qr_codes WHERE link_hash = ?", (key,))
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._remove_disk, key)
+
+    def _prune_disk(self, max_age, max_files):
+        try:
+            entries = [entry for entry in os.scandir(self.directory) if entry.name.endswith(".png")]
+        except FileNotFoundError:
+            return 0
+        entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+        border = time.time() - max_age
+        removed = 0
+        for index, entry in enumerate(entries):
+            if index >= max_files or entry.stat().st_mtime < border:
+                try:
+                    os.remove(entry.path)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+    async def prune(self, max_age=MAX_AGE, max_files=MAX_FILES):
+        """Удаляет с диска старые файлы; возвращает их число."""
+        removed = await asyncio.get_running_loop().run_in_executor(self._executor, self._prune_disk, max_age, max_files)
+        if removed:
+            logger.info(f"Удалено старых QR-кодов с диска: {removed}")
+        return removed
+
+    def describe(self):
+        return ", ".join(f"{source} {count}" for source, count in self.hits.items())
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
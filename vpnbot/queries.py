@@ -0,0 +1,18 @@
+"""SQL горячих запросов обработчиков бота.
+
+Запросы вынесены сюда, чтобы бот и python -m vpnbot.query_plan проверяли
+один и тот же текст. Запросы фоновых задач лежат в их модулях.
+"""
+
+TICKET_USER_SQL = "SELECT user_id FROM support_threads WHERE thread_id = ?"
+ACTIVE_SUBSCRIPTIONS_SQL = "SELECT COUNT(*) FROM users WHERE expires_at IS NOT NULL AND expires_at > ?"
+REFERRAL_COUNT_SQL = "SELECT COUNT(*) FROM referrals WHERE referrer_id = (SELECT id FROM users WHERE telegram_id = ?)"
+FIND_USER_BY_USERNAME_SQL = (
+    "SELECT telegram_id, telegram_username, subscription_type, expires_at, referrer_id, referral_balance, main_balance, "
+    "delivery_status, delivery_failed_at FROM users WHERE telegram_username = ?"
+)
+FIND_PROFILE_BY_KEY_SQL = (
+    "SELECT p.*, s.name as server_name, u.telegram_id "
+    "FROM vpn_profiles p JOIN servers s ON p.server_id = s.id JOIN users u ON p.user_id = u.id "
+    "WHERE p.config_link = ?"
+)
@@ -0,0 +1,93 @@
+"""Проверка планов горячих запросов бота через EXPLAIN QUERY PLAN.
+
+Запуск: python -m vpnbot.query_plan [путь к базе]
+
+Код возврата 1, если хотя бы один зарегистрированный запрос читает
+таблицу полным сканированием вместо поиска по индексу или не подготовился
+на схеме с примененными миграциями.
+"""
+
+import sqlite3
+import sys
+
+from vpnbot import broadcast, invoices, key_pool, outbox, queries, reconcile, reminders, revocation, users
+from vpnbot.migrations import apply_migrations
+
+NOW = "2024-01-01 00:00:00"
+
+# Имя -> (SQL, параметры). Параметры нужны только для подготовки запроса.
+# Текст запросов берется из тех же констант, что использует бот.
+HOT_QUERIES = {
+    "start.user": (users.USER_SQL, (1,)),
+    "my_vpn.profiles": (users.PROFILES_SQL, (1,)),
+    "revoke.profiles": (revocation.PROFILES_SQL.format("?"), (1,)),
+    "revoke.pending": (revocation.PENDING_SQL, ()),
+    "forward_to_user.ticket": (queries.TICKET_USER_SQL, (1,)),
+    "reminder.due": (reminders.DUE_SQL, (NOW, NOW, NOW, NOW)),
+    "reminder.cleanup": (reminders.CLEANUP_SQL, (NOW,)),
+    "admin_stats.active_subs": (queries.ACTIVE_SUBSCRIPTIONS_SQL, (NOW,)),
+    "invoices.waiting": (invoices.WAITING_SQL, ()),
+    "payments.by_invoice": (invoices.PAYMENT_SQL, (1,)),
+    "outbox.claim": (outbox.CLAIM_SQL, (NOW, NOW, NOW, NOW)),
+    "key_pool.claim": (key_pool.CLAIM_SQL, (1, 1)),
+    "broadcast.recipients": (broadcast.RECIPIENTS_SQL, (0, 200)),
+    "admin_find_user.username": (queries.FIND_USER_BY_USERNAME_SQL, ("name",)),
+    "admin_find_by_key.profile": (queries.FIND_PROFILE_BY_KEY_SQL, ("vless://",)),
+    "reconcile.profiles_page": (reconcile.PROFILES_PAGE_SQL, (1, 1, "", 0, 1000)),
+    "referral.count": (queries.REFERRAL_COUNT_SQL, (1,)),
+}
+
+
+def full_scans(plan_rows):
+    """Возвращает шаги плана с полным сканированием таблицы."""
+    scans = []
+    for row in plan_rows:
+        detail = row[3]
+        if detail.startswith("SCAN ") and "USING" not in detail and "CONSTANT ROW" not in detail:
+            scans.append(detail)
+    return scans
+
+
+def check_query_plans(conn, queries=HOT_QUERIES):
+    """Возвращает (нарушения, ошибки) для набора запросов.
+
+    Запрос, который не подготовился (нет таблицы или столбца), попадает в
+    ошибки: значит, он разошелся со схемой.
+    """
+    violations, errors = {}, {}
+    for name, (sql, params) in queries.items():
+        try:
+            plan = conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+        except sqlite3.OperationalError as e:
+            errors[name] = str(e)
+            continue
+        scans = full_scans(plan)
+        if scans:
+            violations[name] = scans
+    return violations, errors
+
+
+def main(argv):
+    db_path = argv[1] if len(argv) > 1 else "vpn_platform.db"
+    # Проверяем копию схемы в памяти с примененными миграциями,
+    # чтобы не трогать рабочую базу.
+    conn = sqlite3.connect(":memory:", isolation_level=None)
+    with sqlite3.connect(f"file:{db_path}?mode=ro", uri=True) as source:
+        for (sql,) in source.execute("SELECT sql FROM sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%'"):
+            conn.execute(sql)
+    apply_migrations(conn, skip=())
+
+    violations, errors = check_query_plans(conn)
+    conn.close()
+    for name in HOT_QUERIES:
+        if name in errors:
+            print(f"ERR  {name}: {errors[name]}")
+        elif name in violations:
+            print(f"FAIL {name}: {'; '.join(violations[name])}")
+        else:
+            print(f"OK   {name}")
+    return 1 if violations or errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
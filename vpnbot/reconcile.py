@@ -0,0 +1,258 @@
+"""Сверка vpn_profiles с клиентами панелей 3X-UI.
+
+Для каждого сервера клиенты панели сортируются по UUID, профили из базы
+читаются страницами по PAGE_SIZE в том же порядке (индекс server_id,
+client_uuid), и обе последовательности сливаются за один проход.
+Расхождения двух видов:
+
+- сирота: клиент есть на панели, но не в vpn_profiles (выдача упала после
+  addClient, отзыв удалил строку, а delClient не прошел);
+- призрак: профиль есть в базе, но клиента на панели нет.
+
+По умолчанию только отчет. Исправления копятся пачками по REPAIR_BATCH и
+применяются по ходу прохода: сироты, выданные ботом, удаляются с панели,
+призраки - из базы. Панель отдает список inbound только целиком, поэтому
+в памяти держится он, страница базы и текущая пачка исправлений.
+
+Запуск из консоли:
+    python -m vpnbot.reconcile                       # отчет по всем серверам
+    python -m vpnbot.reconcile --server 3 --fix-orphans --fix-ghosts
+"""
+
+import argparse
+import asyncio
+import logging
+import re
+import sys
+import time
+from datetime import datetime, timedelta
+from operator import attrgetter
+
+from vpnbot.db import Database
+from vpnbot.inventory import panel_inventory, parse_inbounds
+from vpnbot.key_pool import key_pool
+from vpnbot.revocation import PANEL_CONCURRENCY
+from vpnbot.xui import XUIClientRegistry
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 1000
+REPAIR_BATCH = 200
+SAMPLE_SIZE = 10
+# Клиент создается на панели раньше, чем профиль попадает в базу. Свежих
+# клиентов без профиля не трогаем: их выдача, скорее всего, еще идет.
+ORPHAN_GRACE = timedelta(minutes=10)
+
+# Email, который add_vless_clients дает клиентам бота: user_<tg id>_<ГГГГММДДЧЧММ>[_N]
+BOT_EMAIL_RE = re.compile(r"^user_-?\d+_(\d{12})(?:_\d+)?$")
+
+PROFILES_PAGE_SQL = (
+    "SELECT id, client_uuid, inbound_id FROM vpn_profiles "
+    "WHERE server_id = ? AND id <= ? AND client_uuid IS NOT NULL AND (client_uuid, id) > (?, ?) "
+    "ORDER BY client_uuid, id LIMIT ?"
+)
+
+
+class ReconcileReport:
+    def __init__(self, server):
+        self.server_id = server['id']
+        self.server_name = server['name']
+        self.panel_clients = 0
+        self.profiles = 0
+        self.orphans = 0
+        self.ghosts = 0
+        # Клиенты не от бота и только что выданные: в отчете, но не исправляются
+        self.foreign = 0
+        self.fresh = 0
+        self.orphans_deleted = 0
+        self.ghosts_deleted = 0
+        self.failed = 0
+        self.samples = []
+        self.error = None
+
+    @property
+    def has_drift(self):
+        return bool(self.orphans or self.ghosts or self.foreign)
+
+    def sample(self, kind, client_uuid):
+        if len(self.samples) < SAMPLE_SIZE:
+            self.samples.append(f"{kind} {client_uuid}")
+
+    def __str__(self):
+        if self.error:
+            return f"{self.server_name} (ID {self.server_id}): {self.error}"
+        text = (
+            f"{self.server_name} (ID {self.server_id}): на панели {self.panel_clients}, в базе {self.profiles}, "
+            f"сирот {self.orphans}, призраков {self.ghosts}, чужих {self.foreign}"
+        )
+        if self.orphans_deleted or self.ghosts_deleted or self.failed:
+            text += (
+                f"; удалено с панели {self.orphans_deleted}, из базы {self.ghosts_deleted}, "
+                f"ошибок {self.failed}"
+            )
+        return text
+
+
+def is_stale_bot_client(email, now):
+    """True для клиента бота старше ORPHAN_GRACE; None, если клиент не от бота."""
+    match = BOT_EMAIL_RE.match(email or "")
+    if not match:
+        return None
+    return datetime.strptime(match.group(1), '%Y%m%d%H%M') < now - ORPHAN_GRACE
+
+
+async def _delete_orphans(api, clients, report, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def delete(client):
+        async with semaphore:
+            if await api.delete_client(client.inbound_id, client.uuid):
+                report.orphans_deleted += 1
+                panel_inventory.remove(client.uuid)
+            else:
+                report.failed += 1
+
+    await asyncio.gather(*(delete(client) for client in clients))
+
+
+async def _delete_ghosts(db, profile_ids, report):
+    await db.executemany("DELETE FROM vpn_profiles WHERE id = ?", [(profile_id,) for profile_id in profile_ids])
+    report.ghosts_deleted += len(profile_ids)
+
+
+async def reconcile_server(db, xui_clients, server, fix_orphans=False, fix_ghosts=False,
+                           page_size=PAGE_SIZE, concurrency=PANEL_CONCURRENCY, now=None):
+    """Сверяет один сервер и возвращает ReconcileReport."""
+    report = ReconcileReport(server)
+    now = now or datetime.now()
+    api = xui_clients.for_server(server)
+
+    # Профили, созданные после снимка панели, в сверку не попадают: иначе
+    # только что выданный ключ выглядел бы призраком.
+    max_profile_id = await db.fetchval("SELECT MAX(id) FROM vpn_profiles", default=None) or 0
+    started_at = time.monotonic()
+    inbounds = await api.list_inbounds()
+    if inbounds is None:
+        report.error = "панель не ответила"
+        return report
+    panel = parse_inbounds(server['id'], inbounds)
+    del inbounds
+    # Свежий снимок заодно обновляет индекс клиентов
+    panel_inventory.replace_server(server['id'], panel, started_at)
+    panel.sort(key=attrgetter("uuid"))
+    report.panel_clients = len(panel)
+    # Отключенные клиенты из пула ключей ждут выдачи и профиля не имеют
+    pooled = await key_pool.pooled_uuids(db, server['id'])
+
+    orphans, ghosts = [], []
+
+    async def flush(force=False):
+        if orphans and (force or len(orphans) >= REPAIR_BATCH):
+            await _delete_orphans(api, orphans, report, concurrency)
+            orphans.clear()
+        if ghosts and (force or len(ghosts) >= REPAIR_BATCH):
+            await _delete_ghosts(db, ghosts, report)
+            ghosts.clear()
+
+    async def panel_only(client):
+        if client.uuid in pooled:
+            return
+        stale = is_stale_bot_client(client.email, now)
+        if stale is None:
+            report.foreign += 1
+            report.sample("чужой", client.uuid)
+        elif not stale:
+            report.fresh += 1
+        else:
+            report.orphans += 1
+            report.sample("сирота", client.uuid)
+            if fix_orphans:
+                orphans.append(client)
+                await flush()
+
+    async def db_only(profile):
+        report.ghosts += 1
+        report.sample("призрак", profile['client_uuid'])
+        if fix_ghosts:
+            ghosts.append(profile['id'])
+            await flush()
+
+    position, matched_uuid, last_key = 0, None, ("", 0)
+    while True:
+        page = await db.fetchall(PROFILES_PAGE_SQL, (server['id'], max_profile_id, *last_key, page_size))
+        if not page:
+            break
+        report.profiles += len(page)
+        for profile in page:
+            client_uuid = profile['client_uuid']
+            while position < len(panel) and panel[position].uuid < client_uuid:
+                if panel[position].uuid != matched_uuid:
+                    await panel_only(panel[position])
+                position += 1
+            if position < len(panel) and panel[position].uuid == client_uuid:
+                matched_uuid = client_uuid
+                position += 1
+            elif client_uuid != matched_uuid:
+                await db_only(profile)
+        last_key = (page[-1]['client_uuid'], page[-1]['id'])
+        if len(page) < page_size:
+            break
+    for client in panel[position:]:
+        if client.uuid != matched_uuid:
+            await panel_only(client)
+
+    await flush(force=True)
+    logger.info(f"Сверка сервера {report}")
+    return report
+
+
+async def reconcile_all(db, xui_clients, server_ids=None, skip_servers=(), **kwargs):
+    """Сверяет серверы по очереди, чтобы в памяти был снимок только одной панели."""
+    servers = await db.fetchall("SELECT * FROM servers ORDER BY id")
+    reports = []
+    for server in servers:
+        if server_ids and server['id'] not in server_ids:
+            continue
+        if server['id'] in skip_servers:
+            continue
+        try:
+            reports.append(await reconcile_server(db, xui_clients, server, **kwargs))
+        except Exception as e:
+            logger.error(f"Ошибка сверки сервера {server['name']}: {e}")
+            report = ReconcileReport(server)
+            report.error = f"ошибка сверки: {e}"
+            reports.append(report)
+    return reports
+
+
+async def _main(args):
+    db = Database(args.db)
+    xui_clients = XUIClientRegistry()
+    try:
+        reports = await reconcile_all(
+            db, xui_clients, server_ids=set(args.server or ()),
+            fix_orphans=args.fix_orphans, fix_ghosts=args.fix_ghosts, page_size=args.page_size
+        )
+        for report in reports:
+            print(report)
+            for sample in report.samples:
+                print(f"    {sample}")
+    finally:
+        await xui_clients.close()
+        db.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Сверка vpn_profiles с панелями 3X-UI")
+    parser.add_argument("--db", default="vpn_platform.db")
+    parser.add_argument("--server", type=int, action="append", help="ID сервера; можно указать несколько раз")
+    parser.add_argument("--fix-orphans", action="store_true", help="удалить с панелей клиентов бота без профиля в базе")
+    parser.add_argument("--fix-ghosts", action="store_true", help="удалить из базы профили без клиента на панели")
+    parser.add_argument("--page-size", type=int, default=PAGE_SIZE, help="профилей из базы за один запрос")
+    args = parser.parse_args(argv)
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    asyncio.run(_main(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
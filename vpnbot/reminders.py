@@ -0,0 +1,109 @@
+"""Напоминания об окончании подписки.
+
+Один проход по индексу users.expires_at выбирает всех, у кого подписка
+кончается в ближайшие WINDOWS[-1] дней, и сразу относит каждого к окну
+(за сутки или за три дня). Отправленные напоминания записываются в
+subscription_reminders по (пользователь, expires_at, окно), поэтому
+одно и то же напоминание не приходит дважды ни при повторных запусках, ни
+после перезапуска бота, а после продления (новый expires_at) приходит
+снова. Стоимость прохода пропорциональна числу пользователей в окнах, а
+не размеру таблицы.
+
+Сообщения уходят пачками по BATCH_SIZE с классом BULK через общий
+планировщик vpnbot.outbound.
+"""
+
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+from telegram.error import TelegramError
+
+from vpnbot.outbound import BULK
+from vpnbot.revocation import chunked
+
+logger = logging.getLogger(__name__)
+
+INTERVAL = 60 * 60
+BATCH_SIZE = 200
+CONCURRENCY = 20
+# Старые отметки нужны только пока expires_at в окне
+KEEP_SENT = timedelta(days=7)
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# (окно, дней до окончания) от ближнего к дальнему
+WINDOWS = (("1d", 1), ("3d", 3))
+TEXTS = {
+    "1d": (
+        "❗️ Ваша подписка на VPN истекает менее чем через 24 часа ({expires}).\n\n"
+        "Не забудьте продлить ее, чтобы не потерять доступ!"
+    ),
+    "3d": (
+        "🔔 Напоминаем, что ваша подписка на VPN истекает через 3 дня ({expires}).\n\n"
+        "Вы можете продлить ее в главном меню бота."
+    ),
+}
+
+DUE_SQL = (
+    "SELECT u.telegram_id, u.expires_at, "
+    "CASE WHEN u.expires_at <= ? THEN '1d' ELSE '3d' END AS kind "
+    "FROM users u "
+    "WHERE u.expires_at > ? AND u.expires_at <= ? AND u.telegram_id IS NOT NULL AND u.delivery_status IS NULL "
+    "AND NOT EXISTS (SELECT 1 FROM subscription_reminders r "
+    "                WHERE r.telegram_id = u.telegram_id AND r.expires_at = u.expires_at "
+    "                AND r.kind = CASE WHEN u.expires_at <= ? THEN '1d' ELSE '3d' END)"
+)
+CLEANUP_SQL = "DELETE FROM subscription_reminders WHERE expires_at < ?"
+
+
+class ReminderReport:
+    def __init__(self):
+        self.due = 0
+        self.sent = 0
+        self.failed = 0
+
+    def __str__(self):
+        return f"к отправке: {self.due}, отправлено: {self.sent}, не доставлено: {self.failed}"
+
+
+def due_params(now):
+    one_day, last = (now + timedelta(days=days) for _, days in WINDOWS)
+    return (one_day.strftime(DATE_FORMAT), now.strftime(DATE_FORMAT), last.strftime(DATE_FORMAT), one_day.strftime(DATE_FORMAT))
+
+
+async def send_expiry_reminders(db, bot, now=None):
+    now = now or datetime.now()
+    report = ReminderReport()
+    rows = await db.fetchall(DUE_SQL, due_params(now))
+    report.due = len(rows)
+
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async def remind(row):
+        expires = datetime.strptime(row['expires_at'], DATE_FORMAT).strftime('%d.%m.%Y в %H:%M')
+        async with semaphore:
+            try:
+                await bot.send_message(chat_id=row['telegram_id'], text=TEXTS[row['kind']].format(expires=expires), rate_limit_args=BULK)
+                return True
+            except TelegramError as e:
+                # Заблокировавших бота отмечает планировщик, остальные получат напоминание в следующий раз
+                logger.warning(f"Не удалось отправить напоминание {row['kind']} пользователю {row['telegram_id']}: {e}")
+                return False
+
+    for batch in chunked(rows, BATCH_SIZE):
+        results = await asyncio.gather(*(remind(row) for row in batch))
+        sent_at = datetime.now().strftime(DATE_FORMAT)
+        delivered = [(row['telegram_id'], row['expires_at'], row['kind'], sent_at) for row, ok in zip(batch, results) if ok]
+        if delivered:
+            await db.executemany(
+                "INSERT OR IGNORE INTO subscription_reminders (telegram_id, expires_at, kind, sent_at) VALUES (?, ?, ?, ?)",
+                delivered
+            )
+        report.sent += len(delivered)
+        report.failed += len(batch) - len(delivered)
+
+    await db.execute(CLEANUP_SQL, ((now - KEEP_SENT).strftime(DATE_FORMAT),))
+    if report.due:
+        logger.info(f"Напоминания об окончании подписки: {report}")
+    return report
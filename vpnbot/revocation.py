@@ -0,0 +1,257 @@
+"""Массовый отзыв подписок.
+
+Профили пользователей группируются по серверам, вызовы delClient к разным
+панелям идут параллельно, к одной панели - не больше PANEL_CONCURRENCY
+одновременно. Изменения в базе записываются одной транзакцией после того,
+как все панели ответили.
+
+Из vpn_profiles удаляются только профили, клиент которых удален с панели
+или точно на ней отсутствует. Профили, которые удалить не удалось (ошибка
+панели, разомкнутый автомат, отсечка после MAX_CONSECUTIVE_FAILURES),
+остаются с pending_revoke = 1, и retry_pending_revocations повторяет их
+удаление - иначе отозванный ключ продолжал бы работать, а база потеряла бы
+о нем запись.
+
+Запуск из консоли:
+    python -m vpnbot.revocation ids.txt          # Telegram ID через пробел, запятую или с новой строки
+    python -m vpnbot.revocation --expired        # все пользователи с истекшей подпиской
+    python -m vpnbot.revocation --retry-pending  # повторить удаление ключей с pending_revoke
+"""
+
+import argparse
+import asyncio
+import logging
+import re
+import sys
+from collections import defaultdict
+from datetime import datetime
+
+from vpnbot.db import Database
+from vpnbot.inventory import panel_inventory
+from vpnbot.xui import XUIClientRegistry
+
+logger = logging.getLogger(__name__)
+
+PANEL_CONCURRENCY = 8
+# Столько ошибок подряд от одной панели - и остальные ее профили не трогаем:
+# панель, скорее всего, недоступна, а каждая попытка ждет таймаут.
+MAX_CONSECUTIVE_FAILURES = 5
+# Ограничение SQLite на число параметров в одном запросе
+SQL_CHUNK = 500
+# Как часто повторять удаление ключей с pending_revoke, секунд
+RETRY_INTERVAL = 10 * 60
+
+PROFILES_SQL = (
+    "SELECT p.id, p.server_id, p.client_uuid, p.inbound_id, p.config_link, u.telegram_id, "
+    "s.panel_url, s.panel_username, s.panel_password "
+    "FROM vpn_profiles p JOIN users u ON p.user_id = u.id LEFT JOIN servers s ON p.server_id = s.id "
+    "WHERE u.telegram_id IN ({})"
+)
+PENDING_SQL = (
+    "SELECT p.id, p.server_id, p.client_uuid, p.inbound_id, p.config_link, u.telegram_id, "
+    "s.panel_url, s.panel_username, s.panel_password "
+    "FROM vpn_profiles p LEFT JOIN users u ON p.user_id = u.id LEFT JOIN servers s ON p.server_id = s.id "
+    "WHERE p.pending_revoke = 1"
+)
+
+
+class RevocationReport:
+    def __init__(self, users):
+        self.users = users
+        self.profiles = 0
+        self.deleted = 0
+        self.failed = 0
+        self.skipped_servers = set()
+        # Пользователи, у которых остались не удаленные с панели ключи
+        self.partial_users = set()
+        # Ссылки отозванных ключей: их QR-коды больше нельзя показывать
+        self.links = []
+
+    def __str__(self):
+        text = (
+            f"Пользователей: {self.users}, профилей: {self.profiles}, "
+            f"удалено с панелей: {self.deleted}, ошибок: {self.failed}"
+        )
+        if self.partial_users:
+            text += f"\nОстались ключи на панелях у пользователей: {len(self.partial_users)}"
+        return text
+
+
+def parse_user_ids(text):
+    """Достает Telegram ID из текста или содержимого файла."""
+    return sorted({int(token) for token in re.findall(r"-?\d+", text)})
+
+
+def chunked(items, size=SQL_CHUNK):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+async def load_profiles(db, telegram_ids):
+    profiles = []
+    for chunk in chunked(list(telegram_ids)):
+        sql = PROFILES_SQL.format(", ".join("?" * len(chunk)))
+        profiles.extend(await db.fetchall(sql, chunk))
+    return profiles
+
+
+async def _revoke_on_server(xui_clients, profiles, concurrency, report):
+    """Удаляет клиентов профилей с панели; возвращает id профилей, которых на панели больше нет."""
+    server = profiles[0]
+    api = xui_clients.for_server(server)
+    semaphore = asyncio.Semaphore(concurrency)
+    consecutive_failures = 0
+    removed = []
+
+    async def delete(profile):
+        nonlocal consecutive_failures
+        async with semaphore:
+            if consecutive_failures >= MAX_CONSECUTIVE_FAILURES:
+                report.skipped_servers.add(server['server_id'])
+                report.failed += 1
+                return
+            if panel_inventory.missing_on_panel(profile['server_id'], profile['client_uuid']):
+                # По свежему снимку клиента на панели уже нет
+                report.deleted += 1
+                removed.append(profile['id'])
+                return
+            if await api.delete_client(profile['inbound_id'], profile['client_uuid']):
+                consecutive_failures = 0
+                report.deleted += 1
+                removed.append(profile['id'])
+                panel_inventory.remove(profile['client_uuid'])
+            else:
+                consecutive_failures += 1
+                report.failed += 1
+
+    await asyncio.gather(*(delete(profile) for profile in profiles))
+    return removed
+
+
+async def _revoke_profiles(xui_clients, profiles, skip_servers, concurrency, report):
+    """Возвращает (id профилей для удаления из базы, id профилей, оставшихся на панелях)."""
+    removed = []
+    by_server = defaultdict(list)
+    for profile in profiles:
+        if not profile['client_uuid']:
+            # Профиль создан не ботом: удалить его на панели нечем, повтор не поможет
+            report.failed += 1
+            removed.append(profile['id'])
+            report.partial_users.add(profile['telegram_id'])
+        elif profile['panel_url'] is None:
+            # Сервер удален из базы: доступа к панели нет, повторять нечем
+            report.failed += 1
+            removed.append(profile['id'])
+            report.skipped_servers.add(profile['server_id'])
+            report.partial_users.add(profile['telegram_id'])
+        elif profile['server_id'] in skip_servers:
+            report.failed += 1
+            report.skipped_servers.add(profile['server_id'])
+        else:
+            by_server[profile['server_id']].append(profile)
+
+    results = await asyncio.gather(*(
+        _revoke_on_server(xui_clients, server_profiles, concurrency, report)
+        for server_profiles in by_server.values()
+    ))
+    for server_removed in results:
+        removed.extend(server_removed)
+    removed_ids = set(removed)
+    pending = []
+    for profile in profiles:
+        if profile['id'] not in removed_ids:
+            pending.append(profile['id'])
+            report.partial_users.add(profile['telegram_id'])
+    report.partial_users.discard(None)
+    return removed, pending
+
+
+def _apply_revocation(conn, removed, pending):
+    conn.executemany("DELETE FROM vpn_profiles WHERE id = ?", [(profile_id,) for profile_id in removed])
+    conn.executemany("UPDATE vpn_profiles SET pending_revoke = 1 WHERE id = ?", [(profile_id,) for profile_id in pending])
+
+
+async def revoke_users(db, xui_clients, telegram_ids, skip_servers=(), concurrency=PANEL_CONCURRENCY):
+    """Удаляет ключи пользователей с панелей и очищает их подписки в базе.
+
+    Профили на серверах из skip_servers (например, с разомкнутым автоматом)
+    и те, что панель не удалила, помечаются pending_revoke; такие
+    пользователи попадают в report.partial_users. Возвращает RevocationReport.
+    """
+    telegram_ids = list(telegram_ids)
+    report = RevocationReport(len(telegram_ids))
+    profiles = await load_profiles(db, telegram_ids)
+    report.profiles = len(profiles)
+    report.links = [profile['config_link'] for profile in profiles if profile['config_link']]
+    removed, pending = await _revoke_profiles(xui_clients, profiles, skip_servers, concurrency, report)
+
+    def clear_subscriptions(conn):
+        _apply_revocation(conn, removed, pending)
+        conn.executemany(
+            "UPDATE users SET expires_at = NULL, subscription_type = NULL WHERE telegram_id = ?",
+            [(telegram_id,) for telegram_id in telegram_ids]
+        )
+
+    await db.transaction(clear_subscriptions)
+    logger.info(f"Массовый отзыв подписок завершен. {report}")
+    return report
+
+
+async def retry_pending_revocations(db, xui_clients, skip_servers=(), concurrency=PANEL_CONCURRENCY):
+    """Повторяет удаление с панелей ключей, помеченных pending_revoke. Возвращает RevocationReport."""
+    profiles = await db.fetchall(PENDING_SQL)
+    report = RevocationReport(len({profile['telegram_id'] for profile in profiles}))
+    report.profiles = len(profiles)
+    if not profiles:
+        return report
+    removed, pending = await _revoke_profiles(xui_clients, profiles, skip_servers, concurrency, report)
+    await db.transaction(_apply_revocation, removed, [])
+    if removed:
+        logger.info(f"Повторный отзыв ключей: удалено {len(removed)}, осталось {len(pending)}")
+    return report
+
+
+async def expired_user_ids(db, now=None):
+    now = (now or datetime.now()).strftime('%Y-%m-%d %H:%M:%S')
+    rows = await db.fetchall(
+        "SELECT telegram_id FROM users WHERE telegram_id IS NOT NULL AND expires_at IS NOT NULL AND expires_at < ?", (now,)
+    )
+    return [row[0] for row in rows]
+
+
+async def _main(args):
+    db = Database(args.db)
+    xui_clients = XUIClientRegistry()
+    try:
+        if args.retry_pending:
+            print(await retry_pending_revocations(db, xui_clients, concurrency=args.concurrency))
+            return
+        if args.expired:
+            telegram_ids = await expired_user_ids(db)
+        else:
+            with open(args.file, encoding="utf-8") as f:
+                telegram_ids = parse_user_ids(f.read())
+        print(f"К отзыву: {len(telegram_ids)} пользователей")
+        report = await revoke_users(db, xui_clients, telegram_ids, concurrency=args.concurrency)
+        print(report)
+    finally:
+        await xui_clients.close()
+        db.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Массовый отзыв подписок")
+    parser.add_argument("file", nargs="?", help="файл со списком Telegram ID")
+    parser.add_argument("--expired", action="store_true", help="отозвать все истекшие подписки")
+    parser.add_argument("--retry-pending", action="store_true", help="повторить удаление ключей с незавершенным отзывом")
+    parser.add_argument("--db", default="vpn_platform.db")
+    parser.add_argument("--concurrency", type=int, default=PANEL_CONCURRENCY, help="запросов к одной панели одновременно")
+    args = parser.parse_args(argv)
+    if not args.file and not args.expired and not args.retry_pending:
+        parser.error("укажите файл с ID, --expired или --retry-pending")
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    asyncio.run(_main(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,278 @@
+"""Прием и параллельная обработка обновлений Telegram.
+
+PerUserUpdateProcessor подключается через
+ApplicationBuilder().concurrent_updates(...): обновления разных
+пользователей обрабатываются параллельно (не больше concurrency сразу), а
+обновления одного пользователя - строго по очереди, поэтому состояние
+ConversationHandler не ломается. Ожидающий своей очереди пользователь не
+занимает слот обработки.
+
+serve_webhook запускает бота в режиме вебхука на встроенном aiohttp-сервере
+вместо run_polling. Запросы проверяются по секретному токену из заголовка
+X-Telegram-Bot-Api-Secret-Token.
+
+Нагрузочная проверка против локального фейкового Bot API:
+    python -m vpnbot.updates --updates 640 --users 160 --latency 0.1
+"""
+
+import argparse
+import asyncio
+import hashlib
+import hmac
+import logging
+import signal
+import sys
+import time
+from collections import defaultdict
+from urllib.parse import urlparse
+
+import aiohttp
+from aiohttp import web
+from telegram import Update
+from telegram.ext import ApplicationBuilder, BaseUpdateProcessor, MessageHandler, filters
+
+logger = logging.getLogger(__name__)
+
+CONCURRENT_UPDATES = 32
+# Сколько обновлений может ждать обработки, прежде чем прием замедлится
+MAX_PENDING_UPDATES = 10000
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+# Одновременных соединений Telegram к вебхуку
+MAX_CONNECTIONS = 40
+
+
+def ordering_key(update):
+    """По чему упорядочивать обновление: пользователь, иначе чат."""
+    if isinstance(update, Update):
+        if update.effective_user is not None:
+            return ("user", update.effective_user.id)
+        if update.effective_chat is not None:
+            return ("chat", update.effective_chat.id)
+    return None
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, concurrency=CONCURRENT_UPDATES, max_pending=MAX_PENDING_UPDATES):
+        # Семафор базового класса ограничивает только число ждущих обновлений,
+        # а число одновременно обрабатываемых - self._running, который берется
+        # уже после очереди пользователя
+        super().__init__(max_pending)
+        self.concurrency = concurrency
+        self._running = asyncio.Semaphore(concurrency)
+        # ключ -> [блокировка, число обновлений в работе или в очереди]
+        self._locks = {}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_process_update(self, update, coroutine):
+        key = ordering_key(update)
+        if key is None:
+            async with self._running:
+                await coroutine
+            return
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            # asyncio.Lock отдает блокировку в порядке ожидания, то есть в порядке прихода обновлений
+            async with entry[0], self._running:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+
+def default_secret(token):
+    """Секрет вебхука по умолчанию: производный от токена бота, допустимые символы."""
+    return hashlib.sha256(f"webhook:{token}".encode()).hexdigest()[:64]
+
+
+class TelegramWebhook:
+    def __init__(self, application, path, secret_token):
+        self.application = application
+        self.path = path
+        self.secret_token = secret_token
+        self._runner = None
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        return app
+
+    async def handle(self, request):
+        secret = request.headers.get(SECRET_HEADER) or ""
+        if not hmac.compare_digest(secret, self.secret_token):
+            logger.warning(f"Вебхук Telegram с неверным секретом от {request.remote}")
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        await self.application.update_queue.put(Update.de_json(data, self.application.bot))
+        return web.Response()
+
+    async def start(self, host, port):
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info(f"Вебхук Telegram слушает {host}:{port}{self.path}")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+async def serve_webhook(application, url, host, port, secret_token=None, stop_signals=(signal.SIGINT, signal.SIGTERM)):
+    """Аналог application.run_polling() для вебхука: тот же порядок post_init/post_stop/post_shutdown."""
+    secret_token = secret_token or default_secret(application.bot.token)
+    webhook = TelegramWebhook(application, urlparse(url).path or "/", secret_token)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in stop_signals:
+        loop.add_signal_handler(sig, stop.set)
+
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await webhook.start(host, port)
+        await application.bot.set_webhook(
+            url, secret_token=secret_token, allowed_updates=Update.ALL_TYPES, max_connections=MAX_CONNECTIONS
+        )
+        await application.start()
+        logger.info(f"Бот принимает обновления через вебхук {url}")
+        await stop.wait()
+    finally:
+        await webhook.stop()
+        if application.running:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+# --- нагрузочная проверка ---
+
+BENCH_TOKEN = "123456:bench"
+
+
+def fake_bot_api():
+    """Минимальный Bot API: getMe, setWebhook и sendMessage без задержек."""
+    async def handle(request):
+        method = request.match_info['method']
+        if method == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method == "sendMessage":
+            data = await request.post() if request.content_type != "application/json" else await request.json()
+            result = {
+                "message_id": 1, "date": int(time.time()), "text": data.get("text", ""),
+                "chat": {"id": int(data["chat_id"]), "type": "private"},
+            }
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", handle)
+    return app
+
+
+def make_update(update_id, user_id, seq):
+    user = {"id": user_id, "is_bot": False, "first_name": f"u{user_id}"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": seq, "date": int(time.time()), "text": str(seq),
+            "chat": {"id": user_id, "type": "private"}, "from": user,
+        },
+    }
+
+
+async def bench_once(api_url, concurrency, updates, users, latency):
+    done = asyncio.Event()
+    processed = defaultdict(list)
+    count = 0
+
+    async def handler(update, context):
+        nonlocal count
+        # Медленный вызов панели или платежки
+        await asyncio.sleep(latency)
+        await context.bot.send_message(update.effective_chat.id, "ok")
+        processed[update.effective_user.id].append(int(update.message.text))
+        count += 1
+        if count == updates:
+            done.set()
+
+    application = (
+        ApplicationBuilder().token(BENCH_TOKEN).base_url(f"{api_url}/bot").updater(None)
+        .concurrent_updates(PerUserUpdateProcessor(concurrency)).build()
+    )
+    application.add_handler(MessageHandler(filters.TEXT, handler))
+    secret = default_secret(BENCH_TOKEN)
+    webhook = TelegramWebhook(application, "/telegram", secret)
+    async with application:
+        await application.start()
+        await webhook.start("127.0.0.1", 0)
+        port = webhook._runner.addresses[0][1]
+
+        async def deliver(session, connection):
+            # Как Telegram: несколько соединений, обновления одного пользователя - по порядку в одном
+            for update_id in range(updates):
+                if update_id % users % MAX_CONNECTIONS != connection:
+                    continue
+                body = make_update(update_id, 1000 + update_id % users, update_id // users)
+                async with session.post(f"http://127.0.0.1:{port}/telegram", json=body) as r:
+                    r.raise_for_status()
+
+        started = time.monotonic()
+        async with aiohttp.ClientSession(headers={SECRET_HEADER: secret}) as session:
+            await asyncio.gather(*(deliver(session, connection) for connection in range(MAX_CONNECTIONS)))
+        await done.wait()
+        elapsed = time.monotonic() - started
+        await webhook.stop()
+        await application.stop()
+    ordered = all(seq == sorted(seq) for seq in processed.values())
+    return elapsed, ordered
+
+
+async def bench(levels, updates, users, latency):
+    runner = web.AppRunner(fake_bot_api())
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    api_url = f"http://127.0.0.1:{runner.addresses[0][1]}"
+    base = None
+    print(f"{updates} обновлений от {users} пользователей, обработка {latency * 1000:.0f} мс")
+    print("параллельно  время, с  обн./с  ускорение  порядок")
+    try:
+        for concurrency in levels:
+            elapsed, ordered = await bench_once(api_url, concurrency, updates, users, latency)
+            rate = updates / elapsed
+            base = base or rate
+            print(f"{concurrency:>11}  {elapsed:>8.2f}  {rate:>6.0f}  {rate / base:>9.1f}  {'да' if ordered else 'НАРУШЕН'}")
+    finally:
+        await runner.cleanup()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочная проверка параллельной обработки обновлений")
+    parser.add_argument("--updates", type=int, default=640)
+    parser.add_argument("--users", type=int, default=160)
+    parser.add_argument("--latency", type=float, default=0.1, help="время обработки одного обновления, с")
+    parser.add_argument("--concurrency", default="1,4,16,32", help="уровни параллельности через запятую")
+    args = parser.parse_args(argv)
+    levels = [int(level) for level in args.concurrency.split(",")]
+    asyncio.run(bench(levels, args.updates, args.users, args.latency))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
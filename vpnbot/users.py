@@ -0,0 +1,139 @@
+"""Кэш строк users для меню бота.
+
+start, balance_menu и my_vpn на каждое нажатие читали одну и ту же строку
+пользователя, а start еще и переписывал telegram_username. UserCache держит
+в памяти последние MAX_USERS пользователей (баланс, срок подписки, флаг
+пробного периода, username и список устройств) не дольше TTL секунд, так
+что в обычной навигации по меню запросов к базе нет. Username пишется,
+только когда он изменился.
+
+Бот сам меняет эти строки при оплате, списании с баланса, выдаче и отзыве
+подписки - после таких записей вызывается update (известны новые значения)
+или invalidate. Правки веб-панели и фоновых задач видны не позже чем через
+TTL.
+"""
+
+import logging
+import os
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+MAX_USERS = 10000
+
+FIELDS = (
+    "id, telegram_id, telegram_username, main_balance, referral_balance, "
+    "expires_at, subscription_type, has_used_trial, delivery_status"
+)
+USER_SQL = f"SELECT {FIELDS} FROM users WHERE telegram_id = ?"
+PROFILES_SQL = "SELECT id, server_id, client_uuid FROM vpn_profiles WHERE user_id = ? AND pending_revoke = 0 ORDER BY id"
+
+
+class UserCache:
+    def __init__(self, db, ttl=TTL, max_users=MAX_USERS):
+        self.db = db
+        self.ttl = ttl
+        self.max_users = max_users
+        # telegram_id -> (время загрузки, поля пользователя)
+        self._entries = OrderedDict()
+        # Растет при каждом сбросе: загрузка, начатая до сброса, в кэш не попадает
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.username_writes = 0
+
+    def _cached(self, telegram_id):
+        entry = self._entries.get(telegram_id)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] > self.ttl:
+            del self._entries[telegram_id]
+            return None
+        self._entries.move_to_end(telegram_id)
+        return entry[1]
+
+    def _store(self, telegram_id, user, generation):
+        if generation != self._generation:
+            return
+        self._entries[telegram_id] = (time.monotonic(), user)
+        self._entries.move_to_end(telegram_id)
+        while len(self._entries) > self.max_users:
+            self._entries.popitem(last=False)
+
+    async def get(self, telegram_id):
+        """Поля пользователя (dict) или None, если его нет в базе."""
+        user = self._cached(telegram_id)
+        if user is not None:
+            self.hits += 1
+            return user
+        self.misses += 1
+        generation = self._generation
+        row = await self.db.fetchone(USER_SQL, (telegram_id,))
+        if row is None:
+            return None
+        user = dict(row)
+        self._store(telegram_id, user, generation)
+        return user
+
+    async def profiles(self, telegram_id):
+        """Устройства пользователя: [(id, server_id, client_uuid)]."""
+        user = await self.get(telegram_id)
+        if user is None:
+            return []
+        if 'profiles' not in user:
+            generation = self._generation
+            rows = await self.db.fetchall(PROFILES_SQL, (user['id'],))
+            profiles = [tuple(row) for row in rows]
+            if generation != self._generation:
+                return profiles
+            user['profiles'] = profiles
+        return user['profiles']
+
+    async def touch(self, telegram_id, username):
+        """Вход через /start: заводит пользователя, обновляет username и снимает отметку недоступности.
+
+        Если в кэше все уже совпадает, в базу не ходит.
+        """
+        user = await self.get(telegram_id)
+        if user is not None and user['telegram_username'] == username and user['delivery_status'] is None:
+            return user
+
+        generation = self._generation
+
+        def upsert(conn):
+            # /start после разблокировки бота снова включает пользователя в рассылки
+            return conn.execute(
+                "INSERT INTO users (telegram_id, telegram_username) VALUES (?, ?) "
+                "ON CONFLICT(telegram_id) DO UPDATE SET telegram_username = excluded.telegram_username, delivery_status = NULL "
+                f"RETURNING {FIELDS}",
+                (telegram_id, username)
+            ).fetchone()
+
+        user = dict(await self.db.transaction(upsert))
+        self.username_writes += 1
+        self._store(telegram_id, user, generation)
+        return user
+
+    def update(self, telegram_id, **fields):
+        """Записывает в кэш значения, которые только что сохранены в базе."""
+        self._generation += 1
+        user = self._cached(telegram_id)
+        if user is not None:
+            user.update(fields)
+
+    def invalidate(self, telegram_id=None):
+        self._generation += 1
+        if telegram_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(telegram_id, None)
+
+    def describe(self):
+        total = self.hits + self.misses
+        rate = f"{self.hits / total:.0%}" if total else "нет обращений"
+        return (
+            f"попаданий {rate} ({self.hits} из {total}), в кэше {len(self._entries)}, "
+            f"записей username: {self.username_writes}"
+        )
@@ -0,0 +1,143 @@
+"""Прием вебхуков Crypto Pay (@CryptoBot) об оплаченных счетах.
+
+Встроенный aiohttp-сервер принимает POST с обновлением invoice_paid,
+проверяет подпись из заголовка crypto-pay-api-signature (HMAC-SHA256
+тела запроса с ключом SHA256 от токена приложения) и сразу отвечает 200,
+а обработку счета запускает отдельной задачей. Повторная доставка того же
+update_id игнорируется; повторное зачисление исключает сама обработка
+(статус payments меняется только один раз).
+
+Проверка без CryptoBot - локальная отправка подписанного обновления:
+    python -m vpnbot.webhooks --url http://127.0.0.1:8081/cryptobot/webhook --invoice-id 123
+"""
+
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import sys
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+import aiohttp
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+SIGNATURE_HEADER = "crypto-pay-api-signature"
+WEBHOOK_PATH = "/cryptobot/webhook"
+# Сколько последних update_id помнить для отсева повторных доставок
+SEEN_UPDATES = 1000
+
+
+def sign(token, body):
+    secret = hashlib.sha256(token.encode()).digest()
+    return hmac.new(secret, body, hashlib.sha256).hexdigest()
+
+
+def verify_signature(token, body, signature):
+    return bool(token and signature) and hmac.compare_digest(sign(token, body), signature)
+
+
+class CryptoPayWebhook:
+    def __init__(self, token, on_invoice_paid, path=WEBHOOK_PATH):
+        self.token = token
+        self.on_invoice_paid = on_invoice_paid
+        self.path = path
+        self._seen = OrderedDict()
+        self._tasks = set()
+        self._runner = None
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        return app
+
+    async def handle(self, request):
+        body = await request.read()
+        if not verify_signature(self.token, body, request.headers.get(SIGNATURE_HEADER)):
+            logger.warning(f"Вебхук CryptoBot с неверной подписью от {request.remote}")
+            return web.Response(status=401)
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return web.Response(status=400)
+
+        if update.get("update_type") != "invoice_paid":
+            return web.json_response({"ok": True})
+        update_id = update.get("update_id")
+        if update_id in self._seen:
+            return web.json_response({"ok": True})
+        self._seen[update_id] = True
+        if len(self._seen) > SEEN_UPDATES:
+            self._seen.popitem(last=False)
+
+        # Отвечаем сразу: выдача ключа может занять секунды, а CryptoBot
+        # ждет ответ недолго и при таймауте присылает обновление повторно.
+        task = asyncio.get_running_loop().create_task(self._dispatch(update.get("payload") or {}))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.json_response({"ok": True})
+
+    async def _dispatch(self, invoice):
+        try:
+            await self.on_invoice_paid(invoice)
+        except Exception:
+            logger.exception(f"Ошибка обработки оплаченного счета {invoice.get('invoice_id')} из вебхука")
+
+    async def start(self, host, port):
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info(f"Вебхук CryptoBot слушает {host}:{port}{self.path}")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        # Начатые зачисления доводим до конца
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+def make_update(invoice_id, asset="USDT", amount="1", update_id=None):
+    """Обновление invoice_paid в формате Crypto Pay для локальной проверки."""
+    now = datetime.now(timezone.utc).isoformat()
+    return {
+        "update_id": update_id or int(datetime.now().timestamp() * 1000),
+        "update_type": "invoice_paid",
+        "request_date": now,
+        "payload": {
+            "invoice_id": invoice_id, "status": "paid", "asset": asset,
+            "amount": str(amount), "paid_at": now,
+        },
+    }
+
+
+async def send_update(url, token, update):
+    body = json.dumps(update).encode()
+    headers = {SIGNATURE_HEADER: sign(token, body), "Content-Type": "application/json"}
+    async with aiohttp.ClientSession() as session:
+        async with session.post(url, data=body, headers=headers) as r:
+            return r.status, await r.text()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Отправка подписанного вебхука invoice_paid на локальный бот")
+    parser.add_argument("--url", default=f"http://127.0.0.1:8081{WEBHOOK_PATH}")
+    parser.add_argument("--token", default=os.getenv("CRYPTO_BOT_TOKEN"), help="токен Crypto Pay (по умолчанию из CRYPTO_BOT_TOKEN)")
+    parser.add_argument("--invoice-id", type=int, required=True)
+    parser.add_argument("--asset", default="USDT")
+    parser.add_argument("--amount", default="1")
+    args = parser.parse_args(argv)
+    if not args.token:
+        parser.error("укажите --token или CRYPTO_BOT_TOKEN")
+    status, text = asyncio.run(send_update(args.url, args.token, make_update(args.invoice_id, args.asset, args.amount)))
+    print(status, text)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,262 @@
+"""Клиент API панелей 3X-UI с общим пулом соединений и кешем сессий."""
+
+import asyncio
+import json
+import logging
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+# Панель 3X-UI по умолчанию выдает cookie сессии примерно на час,
+# перелогиниваемся немного раньше, чтобы не ловить отказ посреди покупки.
+SESSION_TTL = 50 * 60
+LOGIN_TIMEOUT = 10
+REQUEST_TIMEOUT = 15
+
+
+class XUISessionExpired(Exception):
+    """Панель отклонила cookie сессии, нужна повторная авторизация."""
+
+
+class XUI_API:
+    def __init__(self, base_url, username, password, connector=None, session_ttl=SESSION_TTL):
+        self.base_url = base_url.rstrip('/')
+        self.username = username
+        self.password = password
+        self.session_ttl = session_ttl
+        self._connector = connector
+        self._session = None
+        self._logged_in_at = None
+        self.login_lock = asyncio.Lock()
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            # Отдельный cookie jar на каждую панель: jar не учитывает порт,
+            # а несколько панелей часто живут на одном IP. unsafe=True нужен,
+            # чтобы aiohttp принимал cookie от панелей, адресуемых по IP.
+            self._session = aiohttp.ClientSession(
+                connector=self._connector,
+                connector_owner=self._connector is None,
+                cookie_jar=aiohttp.CookieJar(unsafe=True),
+            )
+            self._logged_in_at = None
+        return self._session
+
+    @property
+    def is_logged_in(self):
+        return self._logged_in_at is not None and time.monotonic() - self._logged_in_at < self.session_ttl
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._logged_in_at = None
+
+    async def login(self):
+        """Авторизуется в панели и сохраняет cookie сессии. Возвращает True при успехе."""
+        session = self._get_session()
+        url = f"{self.base_url}/login"
+        login_payload = {"username": self.username, "password": self.password}
+        try:
+            async with session.post(url, data=login_payload, timeout=LOGIN_TIMEOUT) as response:
+                if response.status == 200 and 'session' in response.cookies:
+                    self._logged_in_at = time.monotonic()
+                    logger.info(f"Панель {self.base_url} доступна, авторизация успешна.")
+                    return True
+                else:
+                    self._logged_in_at = None
+                    logger.error(f"Панель {self.base_url} недоступна или данные неверны. Статус: {response.status}")
+                    return False
+        except Exception as e:
+            self._logged_in_at = None
+            logger.error(f"Не удалось подключиться к панели {self.base_url}: {e}")
+            return False
+
+    async def _ensure_login(self, force=False):
+        stale_at = self._logged_in_at
+        if self.is_logged_in and not force:
+            return True
+        async with self.login_lock:
+            # Пока ждали блокировку, другой запрос мог уже перелогиниться.
+            if self.is_logged_in and (not force or self._logged_in_at != stale_at):
+                return True
+            return await self.login()
+
+    async def _send(self, method, endpoint, **kwargs):
+        session = self._get_session()
+        url = f"{self.base_url}{endpoint}"
+        async with session.request(method, url, timeout=REQUEST_TIMEOUT, allow_redirects=False, **kwargs) as response:
+            # Без валидной сессии 3X-UI отвечает редиректом на страницу входа
+            # (или 401/404 в новых версиях) вместо JSON.
+            if response.status in (301, 302, 303, 307, 308, 401, 403):
+                raise XUISessionExpired()
+            if response.status == 404 and 'json' not in response.content_type:
+                raise XUISessionExpired()
+            if response.status != 200:
+                logger.error(f"Ошибка в API запросе к {endpoint} на {self.base_url}: {response.status}, {await response.text()}")
+                return None
+            if 'json' not in response.content_type:
+                raise XUISessionExpired()
+            return await response.json()
+
+    async def _api_request(self, method, endpoint, **kwargs):
+        try:
+            if not await self._ensure_login():
+                return None
+            try:
+                return await self._send(method, endpoint, **kwargs)
+            except XUISessionExpired:
+                logger.info(f"Сессия панели {self.base_url} истекла, повторная авторизация.")
+                if not await self._ensure_login(force=True):
+                    return None
+                return await self._send(method, endpoint, **kwargs)
+        except XUISessionExpired:
+            self._logged_in_at = None
+            logger.error(f"Панель {self.base_url} отклонила запрос к {endpoint} сразу после авторизации.")
+            return None
+        except Exception as e:
+            logger.error(f"Исключение при выполнении API запроса к {endpoint} на {self.base_url}: {e}")
+            return None
+
+    @staticmethod
+    def client_email(user_id, now):
+        return f"user_{user_id}_{now.strftime('%Y%m%d%H%M')}"
+
+    @staticmethod
+    def client_settings(client_uuid, email, flow, user_id, days, gb, enable=True, now=None):
+        """Описание клиента для addClient/updateClient; days или gb = None - без ограничения."""
+        now = now or datetime.now()
+        return {
+            "id": client_uuid, "email": email, "flow": flow,
+            "totalGB": gb * 1024 * 1024 * 1024 if gb else 0,
+            "expiryTime": int((now + timedelta(days=days)).timestamp() * 1000) if days else 0,
+            "enable": enable, "tgId": str(user_id) if user_id is not None else "", "subId": ""
+        }
+
+    async def add_vless_client(self, inbound_id: int, user_id: int, days: int, gb: int, flow: str = "xtls-rprx-vision"):
+        results = await self.add_vless_clients(inbound_id, [{"user_id": user_id, "days": days, "gb": gb, "flow": flow}])
+        return results[0] if results else None
+
+    async def add_vless_clients(self, inbound_id: int, specs):
+        """Создает несколько VLESS клиентов одним запросом addClient.
+
+        specs - список словарей с ключами user_id, days, gb и необязательными
+        flow, email и enable. Возвращает список {"uuid", "email"} в порядке
+        specs или None, если панель отклонила запрос: addClient применяет
+        список целиком.
+        """
+        now = datetime.now()
+        clients, results, emails = [], [], set()
+        for spec in specs:
+            client_uuid = str(uuid.uuid4())
+            email = spec.get('email') or self.client_email(spec['user_id'], now)
+            # Панель требует уникальный email, а один пользователь может
+            # попасть в пачку дважды
+            suffix = 2
+            base_email = email
+            while email in emails:
+                email = f"{base_email}_{suffix}"
+                suffix += 1
+            emails.add(email)
+            clients.append(self.client_settings(
+                client_uuid, email, spec.get('flow', "xtls-rprx-vision"), spec['user_id'],
+                spec['days'], spec['gb'], enable=spec.get('enable', True), now=now
+            ))
+            results.append({"uuid": client_uuid, "email": email})
+
+        settings = {"clients": clients}
+        payload = {"id": inbound_id, "settings": json.dumps(settings)}
+
+        response = await self._api_request("POST", "/panel/api/inbounds/addClient", json=payload)
+
+        user_ids = ", ".join(str(spec['user_id']) for spec in specs)
+        if response and response.get("success"):
+            logger.info(f"Успешно созданы VLESS клиенты ({len(clients)}) для пользователей {user_ids} в inbound {inbound_id} на {self.base_url}")
+            return results
+        else:
+            logger.error(f"Не удалось создать VLESS клиентов для {user_ids} на {self.base_url}. Ответ панели: {response}")
+            return None
+
+    async def update_client(self, inbound_id: int, client):
+        """Заменяет настройки клиента (срок, трафик, email, enable) одним запросом."""
+        payload = {"id": inbound_id, "settings": json.dumps({"clients": [client]})}
+        response = await self._api_request("POST", f"/panel/api/inbounds/updateClient/{client['id']}", json=payload)
+        if response and response.get("success"):
+            return True
+        logger.error(f"Не удалось обновить клиента {client['id']} на {self.base_url}. Ответ панели: {response}")
+        return False
+
+    async def list_inbounds(self):
+        """Список inbound с клиентами (settings) и статистикой трафика (clientStats)."""
+        response = await self._api_request("GET", "/panel/api/inbounds/list")
+        if response and response.get("success"):
+            return response.get("obj") or []
+        logger.error(f"Не удалось получить список inbound на {self.base_url}. Ответ панели: {response}")
+        return None
+
+    async def delete_client(self, inbound_id: int, client_uuid: str):
+        endpoint = f"/panel/api/inbounds/{inbound_id}/delClient/{client_uuid}"
+        response = await self._api_request("POST", endpoint)
+
+        if response and response.get("success"):
+            logger.info(f"Успешно удален клиент {client_uuid} из inbound {inbound_id} на {self.base_url}")
+            return True
+        else:
+            logger.error(f"Не удалось удалить клиента {client_uuid} на {self.base_url}. Ответ панели: {response}")
+            return False
+
+
+class XUIClientRegistry:
+    """Реестр клиентов панелей на весь процесс.
+
+    Все клиенты используют один keep-alive коннектор с лимитом соединений
+    на хост, а cookie сессии живут между вызовами, поэтому выдача ключа
+    обходится одним запросом к панели вместо логина и запроса.
+    """
+
+    def __init__(self, limit=100, limit_per_host=8, keepalive_timeout=60, session_ttl=SESSION_TTL):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.session_ttl = session_ttl
+        self._connector = None
+        self._clients = {}
+
+    def _get_connector(self):
+        if self._connector is None or self._connector.closed:
+            self._connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+        return self._connector
+
+    def get(self, base_url, username, password) -> XUI_API:
+        key = base_url.rstrip('/')
+        client = self._clients.get(key)
+        if client is not None and (client.username, client.password) == (username, password):
+            return client
+        if client is not None:
+            # Данные входа сменились — старую сессию закроем в фоне.
+            asyncio.get_running_loop().create_task(client.close())
+        client = XUI_API(base_url, username, password, connector=self._get_connector(), session_ttl=self.session_ttl)
+        self._clients[key] = client
+        return client
+
+    def for_server(self, server) -> XUI_API:
+        """Возвращает клиент для строки из таблицы servers."""
+        return self.get(server['panel_url'], server['panel_username'], server['panel_password'])
+
+    async def close(self):
+        clients, self._clients = list(self._clients.values()), {}
+        for client in clients:
+            await client.close()
+        if self._connector is not None and not self._connector.closed:
+            await self._connector.close()
+        self._connector = None
+
+
+xui_clients = XUIClientRegistry()